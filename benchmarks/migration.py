@@ -0,0 +1,169 @@
+'''
+End-to-end benchmark of bitbucket_api.main() against the local stand-ins in benchmarks/standins.py.
+
+Run from the repository root:
+
+        python3 -m benchmarks.migration --repos 4 --prs 50 --attachments 3 --latency 0.02
+        python3 -m benchmarks.migration --setting pipeline_mode=True --setting streaming_mode=True
+
+Reports throughput, requests sent per attachment and peak memory. Nothing outside a temporary
+directory is touched, the stand-ins run in their own process so they don't count towards memory.
+'''
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import tracemalloc
+from argparse import ArgumentParser, Namespace
+from ast import literal_eval
+from pathlib import Path
+from time import perf_counter
+from types import ModuleType
+from urllib.request import urlopen
+
+from benchmarks.standins import DataSet, PROJECT_NAME, WORKSPACE, run_standins
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is then left out
+    resource = None
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+def parse_args(argv: list[str]=None) -> Namespace:
+    defaults = DataSet()
+    parser = ArgumentParser(description='Benchmarks a full migration against local Bitbucket Server and Cloud stand-ins')
+    parser.add_argument('--repos', type=int, default=defaults.repos)
+    parser.add_argument('--prs', type=int, default=defaults.prs, help='pull requests per repo')
+    parser.add_argument('--attachments', type=int, default=defaults.attachments, help='attachments per pull request')
+    parser.add_argument('--attachment-size', type=int, default=defaults.attachment_size, help='bytes per attachment')
+    parser.add_argument('--padding-activities', type=int, default=defaults.padding_activities,
+                        help='non comment activities per pull request')
+    parser.add_argument('--latency', type=float, default=defaults.latency, help='seconds added to every response')
+    parser.add_argument('--throttle-rate', type=float, default=defaults.throttle_rate,
+                        help='share of requests (0 to 1) answered with a 429')
+    parser.add_argument('--retry-after', type=float, default=defaults.retry_after,
+                        help='Retry-After seconds of an injected 429')
+    parser.add_argument('--setting', action='append', default=[], metavar='NAME=VALUE',
+                        help='env.py setting for the run, ex: pipeline_mode=True (may be repeated)')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='also measure peak python heap, slows the run down noticeably')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    return parser.parse_args(argv)
+
+
+def build_env(server_port: int, cloud_port: int, settings: list[str]) -> ModuleType:
+    '''
+    Stands in for the user's env.py
+    '''
+    env = ModuleType('env')
+    env.server_username = env.server_password = 'benchmark'
+    env.server_url = f'http://127.0.0.1:{server_port}'
+    env.cloud_username = env.cloud_password = 'benchmark'
+    env.cloud_workspace = WORKSPACE
+    env.cloud_api_url = f'http://127.0.0.1:{cloud_port}'
+    env.server_project_name = PROJECT_NAME
+    # The stand-ins pace themselves through --throttle-rate, the client side limits would only hide the tool's own speed
+    env.server_rate_limit = env.cloud_rate_limit = None
+    for setting in settings:
+        name, _, value = setting.partition('=')
+        try:
+            value = literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        setattr(env, name.strip(), value)
+    return env
+
+
+def run_main(env: ModuleType) -> None:
+    sys.modules['env'] = env
+    sys.argv = ['bitbucket_api.py']
+    if str(REPO_ROOT) not in sys.path:
+        sys.path.insert(0, str(REPO_ROOT))
+    import bitbucket_api
+    from resources.logger import log
+    for handler in log.handlers:
+        if not isinstance(handler, logging.FileHandler):
+            handler.setLevel(logging.WARNING)
+    try:
+        bitbucket_api.main()
+    except SystemExit:
+        pass
+
+
+def stats(port: int) -> dict:
+    with urlopen(f'http://127.0.0.1:{port}/_stats') as r:
+        return json.load(r)
+
+
+def report(data: DataSet, elapsed: float, server: dict, cloud: dict, peak_rss: int, peak_heap: int) -> dict:
+    attachments = data.total_attachments
+    total_requests = server['total_requests'] + cloud['total_requests']
+    return {
+        'attachments': attachments,
+        'seconds': round(elapsed, 3),
+        'attachments_per_second': round(attachments / elapsed, 2),
+        'megabytes_per_second': round(server['bytes_out'] / elapsed / 1e6, 2),
+        'requests': total_requests,
+        'requests_per_attachment': round(total_requests / attachments, 2),
+        'throttled_requests': server['throttled'] + cloud['throttled'],
+        'not_modified_responses': server['not_modified'] + cloud['not_modified'],
+        'uploaded_files': cloud['uploaded_files'],
+        'comments': cloud['comments'],
+        'peak_rss_mb': round(peak_rss / 1e6, 1) if peak_rss is not None else None,
+        'peak_python_heap_mb': round(peak_heap / 1e6, 1) if peak_heap is not None else None,
+        'server_requests': server['requests'],
+        'cloud_requests': cloud['requests'],
+    }
+
+
+def peak_rss() -> int:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def main(argv: list[str]=None) -> dict:
+    args = parse_args(argv)
+    data = DataSet(args.repos, args.prs, args.attachments, args.attachment_size, args.padding_activities,
+                   args.latency, args.throttle_rate, args.retry_after)
+
+    ports, stop = multiprocessing.Queue(), multiprocessing.Event()
+    standins = multiprocessing.Process(target=run_standins, args=(data, ports, stop), daemon=True)
+    standins.start()
+    server_port, cloud_port = ports.get(timeout=30)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='bitbucket-benchmark-') as workdir:
+        # Downloads, the checkpoint file and the log all land in the working directory
+        os.chdir(workdir)
+        try:
+            if args.tracemalloc:
+                tracemalloc.start()
+            started = perf_counter()
+            run_main(build_env(server_port, cloud_port, args.setting))
+            elapsed = perf_counter() - started
+            peak_heap = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+            tracemalloc.stop()
+        finally:
+            os.chdir(cwd)
+    results = report(data, elapsed, stats(server_port), stats(cloud_port), peak_rss(), peak_heap)
+    stop.set()
+    standins.join(timeout=10)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for key, value in results.items():
+            print(f'{key:>24}: {value}')
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+'''
+Local stand-ins for the Bitbucket Server and Bitbucket Cloud endpoints this tool uses, serving
+a generated data set so a whole migration can run without touching a real instance.
+
+Every request is counted per host and per endpoint, and the counts are served from /_stats.
+'''
+import hashlib
+import json
+import random
+from collections import Counter
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import sleep
+from urllib.parse import parse_qs, urlsplit, urlencode
+from uuid import UUID
+
+PROJECT_KEY = 'BENCH'
+PROJECT_NAME = 'Benchmark'
+WORKSPACE = 'bench'
+
+
+@dataclass
+class DataSet:
+    '''
+    repos = repos in the server project, every one of them also exists in cloud
+    prs = pull requests per repo
+    attachments = attachments per pull request, each in its own comment
+    attachment_size = bytes per attachment
+    padding_activities = extra non comment activities per pull request (ex: RESCOPED), as real activity pages are mostly noise
+    latency = seconds added to every response
+    throttle_rate = share of requests (0 to 1) answered with a 429
+    retry_after = Retry-After seconds sent with an injected 429
+    '''
+    repos: int = 4
+    prs: int = 25
+    attachments: int = 3
+    attachment_size: int = 64 * 1024
+    padding_activities: int = 5
+    latency: float = 0.0
+    throttle_rate: float = 0.0
+    retry_after: float = 1.0
+
+    @property
+    def total_attachments(self) -> int:
+        return self.repos * self.prs * self.attachments
+
+    @staticmethod
+    def repo_slug(repo: int) -> str:
+        return f'repo-{repo}'
+
+    def attachment_id(self, pr: int, number: int) -> int:
+        return pr * self.attachments + number
+
+    def attachment_content(self, repo: int, attachment_id: int) -> bytes:
+        # Unique per attachment so deduplication doesn't skip any transfers
+        seed = f'{repo}/{attachment_id}/'.encode()
+        return (seed * (self.attachment_size // len(seed) + 1))[:self.attachment_size]
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.requests = Counter()
+        self.throttled = 0
+        self.not_modified = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.uploaded_files = 0
+        self.comments = 0
+        self._lock = Lock()
+
+    def count(self, endpoint: str, bytes_in: int=0) -> None:
+        with self._lock:
+            self.requests[endpoint] += 1
+            self.bytes_in += bytes_in
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {'requests': dict(self.requests), 'total_requests': sum(self.requests.values()),
+                    'throttled': self.throttled, 'not_modified': self.not_modified, 'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+                    'uploaded_files': self.uploaded_files, 'comments': self.comments}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send headers and body together, small separate writes would add delayed ACK stalls to every request
+    wbufsize = 1 << 16
+    disable_nagle_algorithm = True
+    data: DataSet = None
+    stats: Stats = None
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self._dispatch('GET')
+
+    def do_POST(self) -> None:
+        self._dispatch('POST')
+
+    def do_HEAD(self) -> None:
+        self._dispatch('HEAD')
+
+    def _dispatch(self, method: str) -> None:
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if parts == ['_stats']:
+            return self._json(200, self.stats.as_dict(), count=False)
+        endpoint = self.endpoint(method, parts)
+        self.stats.count(endpoint, len(body))
+        if self.data.latency:
+            sleep(self.data.latency)
+        if self.data.throttle_rate and random.random() < self.data.throttle_rate:
+            with self.stats._lock:
+                self.stats.throttled += 1
+            return self._send(429, b'{"error": "rate limited"}', {'Retry-After': str(self.data.retry_after)})
+        self.handle_request(method, endpoint, parts, query, body)
+
+    def endpoint(self, method: str, parts: list[str]) -> str:
+        raise NotImplementedError
+
+    def handle_request(self, method: str, endpoint: str, parts: list[str], query: dict, body: bytes) -> None:
+        raise NotImplementedError
+
+    def _json(self, status: int, payload: dict, count: bool=True) -> None:
+        body = json.dumps(payload).encode()
+        headers = {'Content-Type': 'application/json'}
+        if self.command == 'GET' and status == 200:
+            # Lets conditional requests be answered with a 304, as the real hosts do
+            headers['ETag'] = f'"{hashlib.sha1(body).hexdigest()}"'
+            if self.headers.get('If-None-Match') == headers['ETag']:
+                with self.stats._lock:
+                    self.stats.not_modified += 1
+                return self._send(304, b'', headers, count)
+        self._send(status, body, headers, count)
+
+    def _send(self, status: int, body: bytes, headers: dict=None, count: bool=True) -> None:
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        self.wfile.write(body)
+        if count:
+            with self.stats._lock:
+                self.stats.bytes_out += len(body)
+
+    def _not_found(self) -> None:
+        self._json(404, {'error': {'message': f'No stand-in for {self.path}'}})
+
+
+class ServerHandler(_Handler):
+    '''
+    Bitbucket Server REST 1.0, paged by start/limit
+    '''
+
+    def endpoint(self, method: str, parts: list[str]) -> str:
+        tail = parts[3:]
+        if parts == ['status']:
+            return 'status'
+        if tail == ['projects']:
+            return 'projects'
+        if len(tail) == 3 and tail[2] == 'repos':
+            return 'repos'
+        if len(tail) == 5 and tail[4] == 'pull-requests':
+            return 'pull-requests'
+        if len(tail) == 7 and tail[6] == 'activities':
+            return 'activities'
+        if len(tail) == 6 and tail[4] == 'attachments':
+            return 'attachment'
+        return 'other'
+
+    def handle_request(self, method: str, endpoint: str, parts: list[str], query: dict, body: bytes) -> None:
+        data = self.data
+        if endpoint == 'status':
+            return self._json(200, {'state': 'RUNNING'})
+        if endpoint == 'projects':
+            return self._page(query, [{'key': PROJECT_KEY, 'name': PROJECT_NAME, 'id': 1,
+                                       'description': '', 'public': False}])
+        if endpoint == 'repos':
+            return self._page(query, [{'slug': data.repo_slug(repo), 'id': repo + 1, 'name': data.repo_slug(repo),
+                                       'description': ''} for repo in range(data.repos)])
+        if endpoint == 'pull-requests':
+            # Newest first, as requested by incremental runs
+            prs = [{'id': pr, 'title': f'PR {pr}', 'description': '', 'state': 'MERGED',
+                    'createdDate': 1600000000000 + pr, 'updatedDate': 1600000000000 + pr}
+                   for pr in range(data.prs, 0, -1)]
+            return self._page(query, prs)
+        if endpoint == 'activities':
+            repo_id = int(parts[6].split('-')[-1]) + 1
+            pr = int(parts[8])
+            activities = [{'action': 'RESCOPED', 'commits': [{'id': f'{number:040x}'} for number in range(20)]}
+                          for _ in range(data.padding_activities)]
+            for number in range(data.attachments):
+                attachment_id = data.attachment_id(pr, number)
+                text = f'Screenshot ![image-{attachment_id}.png](attachment:{repo_id}/{attachment_id})'
+                activities.append({'action': 'COMMENTED', 'comment': {'id': attachment_id, 'text': text}})
+            return self._page(query, activities)
+        if endpoint == 'attachment':
+            repo = int(parts[6].split('-')[-1])
+            return self._ranged(data.attachment_content(repo, int(parts[8])))
+        self._not_found()
+
+    def _ranged(self, content: bytes) -> None:
+        '''
+        Serves content, or the single "bytes=first-last" range asked for
+        '''
+        headers = {'Content-Type': 'application/octet-stream', 'Accept-Ranges': 'bytes'}
+        byte_range = self.headers.get('Range', '')
+        if not byte_range.startswith('bytes='):
+            return self._send(200, content, headers)
+        first, _, last = byte_range[len('bytes='):].partition('-')
+        first, last = int(first), min(int(last or len(content) - 1), len(content) - 1)
+        if first >= len(content):
+            return self._send(416, b'', {'Content-Range': f'bytes */{len(content)}'})
+        headers['Content-Range'] = f'bytes {first}-{last}/{len(content)}'
+        self._send(206, content[first:last + 1], headers)
+
+    def _page(self, query: dict, values: list) -> None:
+        start = int(query.get('start', 0))
+        limit = int(query.get('limit', 25))
+        page = values[start:start + limit]
+        last = start + limit >= len(values)
+        payload = {'size': len(page), 'limit': limit, 'start': start, 'isLastPage': last, 'values': page}
+        if not last:
+            payload['nextPageStart'] = start + limit
+        self._json(200, payload)
+
+
+class CloudHandler(_Handler):
+    '''
+    Bitbucket Cloud REST 2.0, paged by page/pagelen with a full "next" url
+    '''
+    comments: dict = None
+
+    def endpoint(self, method: str, parts: list[str]) -> str:
+        tail = parts[1:]
+        if tail[:1] == ['user']:
+            return 'user-permissions'
+        if tail[:1] == ['workspaces']:
+            return 'workspace'
+        if len(tail) == 2:
+            return 'repositories'
+        if len(tail) == 3:
+            return 'repository'
+        if len(tail) == 4 and tail[3] == 'pullrequests':
+            return 'pullrequests'
+        if len(tail) == 4 and tail[3] == 'downloads':
+            return 'downloads'
+        if len(tail) == 5:
+            return 'pullrequest'
+        if len(tail) == 6 and tail[5] == 'comments':
+            return f'comments-{method.lower()}'
+        return 'other'
+
+    def handle_request(self, method: str, endpoint: str, parts: list[str], query: dict, body: bytes) -> None:
+        data = self.data
+        if endpoint == 'workspace':
+            return self._json(200, {'uuid': '{%s}' % UUID(int=1), 'slug': WORKSPACE, 'name': 'Benchmark'})
+        if endpoint == 'user-permissions':
+            # Answers the way Cloud filters on q, only the benchmark workspace's uuid matches
+            workspace = 'workspace.uuid="{%s}"' % UUID(int=1)
+            return self._page(query, [{'permission': 'owner'}] if query.get('q') == workspace else [])
+        if endpoint == 'repositories':
+            return self._page(query, [{'name': data.repo_slug(repo), 'full_name': f'{WORKSPACE}/{data.repo_slug(repo)}',
+                                       'uuid': '{%s}' % UUID(int=repo + 1), 'is_private': True,
+                                       'project': {'name': PROJECT_NAME, 'key': PROJECT_KEY}}
+                                      for repo in range(data.repos)])
+        if endpoint == 'repository':
+            return self._json(200, {'uuid': '{%s}' % UUID(int=1)})
+        if endpoint == 'pullrequests':
+            return self._page(query, [{'id': pr} for pr in range(1, data.prs + 1)])
+        if endpoint == 'pullrequest':
+            return self._json(200, {'id': int(parts[5])})
+        if endpoint == 'downloads':
+            with self.stats._lock:
+                self.stats.uploaded_files += body.count(b'name="files"')
+            return self._send(201, b'')
+        if endpoint in ('comments-get', 'comments-post'):
+            key = tuple(parts[3:6])
+            with self.stats._lock:
+                comments = self.comments.setdefault(key, [])
+                if endpoint == 'comments-post':
+                    comments.append(json.loads(body).get('content', {}).get('raw', ''))
+                    self.stats.comments += 1
+                values = [{'deleted': False, 'content': {'raw': raw}} for raw in comments]
+            if endpoint == 'comments-post':
+                return self._json(201, {'id': len(values)})
+            return self._page(query, values)
+        self._not_found()
+
+    def _page(self, query: dict, values: list) -> None:
+        page = int(query.get('page', 1))
+        pagelen = int(query.get('pagelen', 10))
+        start = (page - 1) * pagelen
+        payload = {'page': page, 'pagelen': pagelen, 'size': len(values), 'values': values[start:start + pagelen]}
+        if start + pagelen < len(values):
+            host, port = self.server.server_address[:2]
+            payload['next'] = f'http://{host}:{port}{urlsplit(self.path).path}?' + urlencode({**query, 'page': page + 1})
+        self._json(200, payload)
+
+
+def serve(handler: type, data: DataSet, stats: Stats=None, **attributes) -> ThreadingHTTPServer:
+    '''
+    Starts a stand-in on a free local port in a background thread, returns the server
+    '''
+    handler = type(handler.__name__, (handler,), {'data': data, 'stats': stats or Stats(), **attributes})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_standins(data: DataSet, ports, stop) -> None:
+    '''
+    Process entry point: serves both stand-ins, sends their ports through the ports queue and
+    runs until the stop event is set
+    '''
+    server = serve(ServerHandler, data)
+    cloud = serve(CloudHandler, data, comments={})
+    ports.put((server.server_address[1], cloud.server_address[1]))
+    stop.wait()
+    server.shutdown()
+    cloud.shutdown()
@@ -1,13 +1,38 @@
-from requests import Session
+import asyncio
+import subprocess
+import sys
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass
 from pathlib import Path
+from time import perf_counter, sleep, time
 
 from resources.cloud_api import Cloud
 from resources import cloud_objects as CO
-from resources.server_api import Server
+from resources.server_api import Server, ServerUtils
 from resources import server_objects as SO
-from resources.logger import log
+from resources.settings import Settings
+from resources.pipeline import Pipeline
+from resources.rate_limit import RateLimiter
+from resources.transport import Transport
+from resources.dedup import AttachmentDedup, HashingIterator, file_digest
+from resources.checkpoint import CheckpointStore, Stage
+from resources.cloud_index import CloudIndex
+from resources.incremental import SyncTracker
+from resources.comment_batch import CommentBatch
+from resources.upload_batch import UploadBatcher
+from resources.sharding import Shard, ShardProgress, read_progress
+from resources.metrics import Metrics, MetricsExporter
+from resources.tracing import Tracer
+from resources.http_cache import HTTPCache
+from resources.spool import ByteBudget
+from resources.preflight import ProbeCache, preflight
+from resources.scheduler import ProjectFilter, RepoWork, balance, schedule
+from resources.manifest import ManifestWriter, estimate_seconds, index_manifest, read_manifest, read_summary
+from resources.logger import configure_logging, log, stop_logging
 
-def init() -> tuple[Cloud, Server]:
+def init(args: Namespace=None) -> tuple[Cloud, Server, Settings]:
     try:
         import env
         cloud_username = env.cloud_username
@@ -17,56 +42,944 @@ def init() -> tuple[Cloud, Server]:
         server_username = env.server_username
         server_password = env.server_password
         server_url = env.server_url
-        server_project_name_select = env.server_project_name
-        server_repo_name_select = env.server_repo_name
+        settings = load_settings(args)
 
 
-    except [ImportError, NameError]:
+    except (ImportError, AttributeError):
         log.critical('The "env.py" file could not be found or one of the template variables is missing. '
                     'Please copy the "env_template.py" file to "env.py" and fill in your credentials '
                     'for either or both platforms before proceeding.')
         exit()
-    cloud_session = Session()
-    cloud_session.auth = (cloud_username, cloud_password)
+    configure_logging(settings.async_logging, settings.log_json, settings.log_file_level,
+                      settings.log_rate_limit_interval, settings.log_rate_limit_burst)
+    cloud_transport = build_transport(settings)
+    cloud_session = cloud_transport.build_session((cloud_username, cloud_password))
 
-    server_session = Session()
-    server_session.auth = (server_username, server_password)
+    server_transport = build_transport(settings)
+    server_session = server_transport.build_session((server_username, server_password))
 
-    cloud = Cloud(cloud_session, cloud_workspace)
-    server = Server(server_session, server_url)
-    return cloud, server, server_project_name_select, server_repo_name_select
+    probes = ProbeCache(settings.preflight_cache_file, settings.preflight_cache_ttl)
+
+    def connect_cloud() -> Cloud:
+        workspace_key = f'cloud_workspace|{settings.cloud_api_url}|{cloud_workspace}'
+        cached = probes.get(workspace_key) if cloud_workspace is not None else None
+        workspace = CO.Workspace(cached['uuid'], cached['slug'], cached['name']) if cached else cloud_workspace
+        cloud = Cloud(cloud_session, workspace,
+                      rate_limiter=RateLimiter(settings.cloud_rate_limit, settings.rate_limit_burst),
+                      transport=cloud_transport, base_url=settings.cloud_api_url)
+        if cloud_workspace is not None and not cached:
+            probes.set(workspace_key, {'uuid': str(cloud.workspace.uuid), 'slug': cloud.workspace.slug,
+                                       'name': cloud.workspace.name})
+        permission = probes.probe(f'cloud_access|{settings.cloud_api_url}|{cloud_username}|{cloud.workspace.uuid}',
+                                  lambda: cloud.check_access(cloud.workspace))
+        if permission == 'member':
+            log.warning(f'You are only a member of cloud workspace "{cloud.workspace.slug}", uploads will fail '
+                        'on repos you can\'t write to')
+        return cloud
+
+    def connect_server() -> Server:
+        ssl_key = f'server_ssl|{server_url}'
+        ssl_verify = probes.get(ssl_key)
+        server = Server(server_session, server_url,
+                        rate_limiter=RateLimiter(settings.server_rate_limit, settings.rate_limit_burst),
+                        transport=server_transport, ssl_verify=ssl_verify)
+        if ssl_verify is None:
+            probes.set(ssl_key, server.ssl_verify)
+        project_name = None if settings.all_projects else settings.server_project_name
+        probes.probe(f'server_access|{server_url}|{server_username}|{project_name}',
+                     lambda: server.check_access(project_name))
+        return server
+
+    # Both hosts are probed and checked at the same time, any problem ends the run before work starts
+    cloud, server = preflight(connect_cloud, connect_server)
+    cloud.prefetch_pages = server.prefetch_pages = settings.page_prefetch
+    cloud.stream_pages = server.stream_pages = settings.stream_pages
+    server.download_chunk_size = settings.download_chunk_size
+    server.download_chunk_workers = settings.download_chunk_workers
+    server.spool_dir = settings.spool_dir
+    return cloud, server, settings
+
+def load_settings(args: Namespace=None) -> Settings:
+    import env
+    settings = Settings.from_env(env)
+    if args is not None and args.shard is not None:
+        settings.shard_index, settings.shard_count = args.shard.index, args.shard.count
+    return settings
+
+def build_transport(settings: Settings) -> Transport:
+    pool_size = settings.http_pool_size
+    if pool_size is None:
+        # One connection per worker that may be talking to the host at the same time
+        pool_size = sum(settings.pipeline_workers.values()) if settings.pipeline_mode else 1
+    return Transport(pool_size=max(pool_size, 10),
+                     connect_timeout=settings.connect_timeout,
+                     read_timeout=settings.read_timeout,
+                     max_retries=settings.max_retries)
 
 def remove_attachment_local_copy(attachment: Path):
     Path.unlink(attachment)
 
-def main():
-    cloud, server, server_project_name_select, server_repo_name_select = init()
-    for server_project in server.get_projects_by_name(server_project_name_select):
+@dataclass
+class RunContext:
+    '''
+    Everything a migration step needs, shared by every worker in a run
+    '''
+    cloud: Cloud
+    server: Server
+    settings: Settings
+    dedup: AttachmentDedup = None
+    checkpoints: CheckpointStore = None
+    cloud_index: CloudIndex = None
+    sync: SyncTracker = None
+    uploads: UploadBatcher = None
+    shard: Shard = None
+    progress: ShardProgress = None
+    metrics: Metrics = None
+    tracer: Tracer = None
+
+def trace_ids(server_repo: SO.Repository=None, server_pr: SO.PullRequest=None,
+              attachment: SO.Attachment=None, attachments: list[SO.Attachment]=None) -> dict:
+    if attachment is not None:
+        server_pr = attachment.pr
+    if server_pr is not None:
+        server_repo = server_pr.repo
+    ids = {'project': server_repo.project.key, 'repo': server_repo.slug}
+    if server_pr is not None:
+        ids['pr'] = server_pr.id
+    if attachment is not None:
+        ids['attachment'] = attachment.id
+    if attachments is not None:
+        ids['attachments'] = [(attachment.pr.id, attachment.id) for attachment in attachments]
+    return ids
+
+def span(ctx: RunContext, name: str, **objects):
+    '''
+    Times a step in the trace file, tagged with the ids of the repo/pr/attachment it worked on
+    '''
+    if ctx.tracer is None:
+        return nullcontext()
+    return ctx.tracer.span(name, **trace_ids(**objects))
+
+def traced(ctx: RunContext, name: str, iterable, **objects):
+    '''
+    Times fetching every item of a lazy listing in the trace file, see Tracer.iterate
+    '''
+    if ctx.tracer is None:
+        return iterable
+    return ctx.tracer.iterate(name, iterable, **trace_ids(**objects))
+
+def cloud_repo_exists(ctx: RunContext, server_repo: SO.Repository) -> bool:
+    if ctx.cloud_index is not None:
+        return ctx.cloud_index.repo_exists(server_repo)
+    return ctx.cloud.repo_exists(ctx.cloud.workspace, server_repo)
+
+def cloud_pr_exists(ctx: RunContext, server_repo: SO.Repository, pr_id: int) -> bool:
+    if ctx.cloud_index is not None:
+        return ctx.cloud_index.pr_exists(server_repo, pr_id)
+    return ctx.cloud.pr_exists(ctx.cloud.workspace, server_repo, pr_id)
+
+def discover_repos(ctx: RunContext):
+    if ctx.settings.all_projects:
+        yield from schedule_repos(ctx)
+        return
+    server = ctx.server
+    for server_project in server.get_projects_by_name(ctx.settings.server_project_name):
         for server_repo in server.get_repos(server_project):
-            if not cloud.repo_exists(cloud.workspace, server_repo):
-                log.info(f'Skipping repo "{server_repo.name}" as it is not present in your Cloud workspace')
+            if not wanted_repo(ctx, server_repo):
                 continue
 #            if server_repo_select != server_repo:
 #                log.info(f'Skipping repo "{server_repo.name}" as it is not select repo')
 #                continue
             log.info(f'Scanning PRs from repo "{server_repo.name}"')
+            yield server_project, server_repo
 
-            for server_pr in server.get_pull_requests(server_project, server_repo):
+def wanted_repo(ctx: RunContext, server_repo: SO.Repository) -> bool:
+    if ctx.shard is not None and not ctx.shard.owns(repo_key(server_repo)):
+        return False
+    if not cloud_repo_exists(ctx, server_repo):
+        log.info(f'Skipping repo "{server_repo.name}" as it is not present in your Cloud workspace')
+        return False
+    return True
 
-                if not cloud.pr_exists(cloud.workspace, server_repo, server_pr.id):
-                    log.info(f'Skipping pr "{server_pr.id}" from repo "{server_repo.name}" as is it not present in your Cloud workspace')
-                    continue
-                log.info(f'Scaning pr "{server_pr.id}" within repo "{server_repo.name}" for attachments')
-                for attachment_id, filename in server.get_pull_request_attachments(server_project, server_repo, server_pr):
-                    attachment = server.download_repo_attachment(server_project, server_repo, attachment_id, filename)
-                    if attachment is None:
+def schedule_repos(ctx: RunContext):
+    '''
+    Every repo of every selected server project, highest priority and largest (by PR count) first
+    so the worker pools start on the longest repos, see resources.scheduler
+    '''
+    server, settings = ctx.server, ctx.settings
+    projects = ProjectFilter.from_settings(settings)
+    repos = []
+    for server_project in server.get_projects():
+        if not projects.selects(server_project):
+            log.info(f'Skipping project "{server_project.key}" as it is filtered out')
+            continue
+        priority = projects.priority(server_project)
+        repos += [(server_project, server_repo, priority) for server_repo in server.get_repos(server_project)
+                  if wanted_repo(ctx, server_repo)]
+
+    def estimate(project_repo_priority) -> RepoWork:
+        server_project, server_repo, priority = project_repo_priority
+        return RepoWork(server_project, server_repo, server.count_pull_requests(server_project, server_repo),
+                        priority=priority)
+
+    with ThreadPoolExecutor(settings.pipeline_workers['discovery'], thread_name_prefix='estimate') as executor:
+        works = schedule(executor.map(estimate, repos), settings)
+    log.info(f'Scheduled {len(works)} repos with {sum(work.prs for work in works)} PRs')
+    for work in works:
+        log.info(f'Scanning PRs from repo "{work.repo.name}" of project "{work.project.key}" ({work.prs} PRs)')
+        yield work.project, work.repo
+
+def repo_key(server_repo: SO.Repository) -> tuple:
+    return (server_repo.project.key, server_repo.slug)
+
+def discover_pull_requests(ctx: RunContext, server_project: SO.Project, server_repo: SO.Repository):
+    # Incremental runs list the most recently updated PRs first and stop at the first unchanged one
+    order = 'NEWEST' if ctx.sync is not None else None
+    listing = ctx.server.get_pull_requests(server_project, server_repo, order=order)
+    for server_pr in traced(ctx, 'pr_discovery', listing, server_repo=server_repo):
+        if ctx.sync is not None:
+            if ctx.sync.is_unchanged(repo_key(server_repo), server_pr):
+                log.info(f'Remaining PRs in repo "{server_repo.name}" are unchanged since the last sync')
+                break
+            ctx.sync.seen(repo_key(server_repo), server_pr)
+        if not cloud_pr_exists(ctx, server_repo, server_pr.id):
+            log.info('Skipping pr "%s" from repo "%s" as is it not present in your Cloud workspace', server_pr.id, server_repo.name)
+            continue
+        yield server_pr
+    if ctx.sync is not None:
+        ctx.sync.completed(repo_key(server_repo))
+    if ctx.cloud_index is not None:
+        ctx.cloud_index.forget(server_repo)
+    if ctx.progress is not None:
+        ctx.progress.repo_done()
+
+def extract_attachments(ctx: RunContext, server_pr: SO.PullRequest, listing: list[tuple[int, str, int]]=None):
+    '''
+    listing = the PR's [(attachment id, filename, source comment id), ...] if already known (ex: from a manifest), otherwise
+    its activities are scanned for them
+    '''
+    log.info('Scaning pr "%s" within repo "%s" for attachments', server_pr.id, server_pr.repo.name)
+    batch = CommentBatch(server_pr) if ctx.settings.consolidate_comments else None
+    try:
+        if listing is None:
+            listing = ctx.server.get_pull_request_attachments(server_pr.repo.project, server_pr.repo, server_pr)
+            listing = traced(ctx, 'get_pull_request_attachments', listing, server_pr=server_pr)
+        for attachment_id, filename, comment_id in listing:
+            attachment = SO.Attachment(attachment_id, filename, server_pr, comment_id=comment_id)
+            if resume_attachment(ctx, attachment):
+                if batch is not None:
+                    batch.add()
+                    attachment.comment_batch = batch
+                yield attachment
+    except Exception:
+        mark_failed(ctx, server_pr)
+        raise
+    finally:
+        # Attachments yielded so far still get their comment even if listing the rest failed
+        if batch is not None and batch.close():
+            comment_batch(ctx, batch)
+
+def mark_failed(ctx: RunContext, server_pr: SO.PullRequest) -> None:
+    '''
+    Keeps incremental sync from marking the PR as done so the next run picks it up again
+    '''
+    if ctx.sync is not None:
+        ctx.sync.failed(repo_key(server_pr.repo), server_pr)
+
+def checkpoint_key(attachment: SO.Attachment) -> tuple:
+    repo = attachment.pr.repo
+    return (repo.project.key, repo.slug, attachment.pr.id, attachment.id)
+
+def record_stage(ctx: RunContext, attachment: SO.Attachment, stage: Stage) -> None:
+    attachment.stage = stage
+    if stage == Stage.COMMENTED:
+        if ctx.progress is not None:
+            ctx.progress.attachment_done()
+        if ctx.metrics is not None:
+            ctx.metrics.attachment_done()
+    if ctx.checkpoints is None:
+        return
+    local_path = str(attachment.local_path) if attachment.local_path is not None else None
+    ctx.checkpoints.mark(checkpoint_key(attachment), attachment.pr.repo.id, stage, local_path,
+                         attachment.cloud_filename, attachment.digest)
+
+def resume_attachment(ctx: RunContext, attachment: SO.Attachment) -> bool:
+    '''
+    Restores attachment to the stage a previous run left it at.
+    returns False if there is nothing left to do for it
+    '''
+    checkpoint = ctx.checkpoints.get(checkpoint_key(attachment)) if ctx.checkpoints is not None else None
+    if checkpoint is None:
+        record_stage(ctx, attachment, Stage.DISCOVERED)
+        return True
+    if checkpoint.stage >= Stage.COMMENTED:
+        log.debug('Skipping "%s" on pr "%s" as it was already migrated', attachment.filename, attachment.pr.id)
+        return False
+    if checkpoint.stage >= Stage.UPLOADED:
+        attachment.stage = checkpoint.stage
+        attachment.cloud_filename = checkpoint.cloud_filename
+        attachment.digest = checkpoint.digest
+    elif checkpoint.stage >= Stage.DOWNLOADED and checkpoint.local_path and Path(checkpoint.local_path).exists():
+        attachment.stage = checkpoint.stage
+        attachment.local_path = Path(checkpoint.local_path)
+        attachment.cloud_filename = checkpoint.cloud_filename
+        attachment.digest = checkpoint.digest
+    else:
+        attachment.stage = Stage.DISCOVERED
+    log.debug('Resuming "%s" on pr "%s" from stage %s', attachment.filename, attachment.pr.id, attachment.stage.name)
+    return True
+
+def discard_local_copy(ctx: RunContext, attachment: SO.Attachment) -> None:
+    if attachment.local_path is not None:
+        remove_attachment_local_copy(attachment.local_path)
+        ctx.server.release_download(attachment.local_path)
+        attachment.local_path = None
+
+def claim_attachment(ctx: RunContext, attachment: SO.Attachment) -> bool:
+    '''
+    returns True if this attachment was already uploaded to its cloud repo, in which case
+    attachment.cloud_filename points at the existing download and no transfer is needed
+    '''
+    if ctx.dedup is None:
+        return False
+    source_key = ctx.dedup.source_key(attachment.pr.repo.id, attachment.id)
+    cloud_filename = ctx.dedup.claim(source_key, unblock_uploads(ctx, attachment.pr.repo))
+    if cloud_filename is not None:
+        log.debug('Reusing "%s" for attachment "%s" on pr "%s"', cloud_filename, attachment.filename, attachment.pr.id)
+        attachment.cloud_filename = cloud_filename
+        discard_local_copy(ctx, attachment)
+        record_stage(ctx, attachment, Stage.UPLOADED)
+        return True
+    attachment.dedup_keys.append(source_key)
+    return False
+
+def unblock_uploads(ctx: RunContext, server_repo: SO.Repository):
+    '''
+    With batched uploads, the attachment holding a dedup claim may be sitting in its repo's
+    upload batch. The returned callback sends that batch straight away so waiting on the claim
+    can't stall the run.
+    '''
+    if ctx.uploads is None:
+        return None
+    def send_batch():
+        for attachment in upload_batch(ctx, ctx.uploads.pop(server_repo.id)):
+            comment_attachment(ctx, attachment)
+    return send_batch
+
+def resolve_attachment(ctx: RunContext, attachment: SO.Attachment) -> None:
+    '''
+    Publishes the outcome of a transfer (cloud_filename or None on failure) to every claimed dedup key
+    '''
+    if ctx.dedup is None:
+        return
+    for key in attachment.dedup_keys:
+        ctx.dedup.resolve(key, attachment.cloud_filename)
+    attachment.dedup_keys.clear()
+
+def download_attachment(ctx: RunContext, attachment: SO.Attachment) -> bool:
+    if attachment.stage >= Stage.UPLOADED or claim_attachment(ctx, attachment):
+        return True
+    repo = attachment.pr.repo
+    if attachment.stage < Stage.DOWNLOADED:
+        with span(ctx, 'download_repo_attachment', attachment=attachment):
+            attachment.local_path = ctx.server.download_repo_attachment(repo.project, repo, attachment.id,
+                                                                        attachment.filename, attachment.pr.id)
+        if attachment.local_path is None:
+            log.warning('Skipping upload attempt for "%s" since download failed.', attachment.filename)
+            resolve_attachment(ctx, attachment)
+            mark_failed(ctx, attachment.pr)
+            return False
+        attachment.digest = file_digest(attachment.local_path)
+        # Name by content instead of a random hash so a rerun uploads to the same name
+        attachment.cloud_filename = ServerUtils.unique_filename(attachment.filename, attachment.pr.id, attachment.digest)
+        record_stage(ctx, attachment, Stage.DOWNLOADED)
+    if ctx.dedup is None:
+        return True
+
+    content_key = ctx.dedup.content_key(repo.slug, attachment.digest)
+    cloud_filename = ctx.dedup.claim(content_key, unblock_uploads(ctx, repo))
+    if cloud_filename is not None:
+        log.debug('Content of "%s" on pr "%s" matches "%s", reusing it', attachment.filename, attachment.pr.id, cloud_filename)
+        attachment.cloud_filename = cloud_filename
+        discard_local_copy(ctx, attachment)
+        resolve_attachment(ctx, attachment)
+        record_stage(ctx, attachment, Stage.UPLOADED)
+        return True
+    attachment.dedup_keys.append(content_key)
+    return True
+
+def upload_attachment(ctx: RunContext, attachment: SO.Attachment) -> bool:
+    if attachment.stage >= Stage.UPLOADED:
+        # Deduplicated or resumed, the upload already exists
+        return True
+    cloud = ctx.cloud
+    with span(ctx, 'upload_attachment_to_downloads', attachment=attachment):
+        uploaded = cloud.upload_attachment_to_downloads(cloud.workspace, attachment.pr.repo, attachment.local_path,
+                                                        attachment.cloud_filename)
+    return finish_upload(ctx, attachment, uploaded)
+
+def finish_upload(ctx: RunContext, attachment: SO.Attachment, uploaded: bool) -> bool:
+    if uploaded:
+        resolve_attachment(ctx, attachment)
+        discard_local_copy(ctx, attachment)
+        record_stage(ctx, attachment, Stage.UPLOADED)
+        return True
+    log.warning('Unable to upload %s to %s under the download section', attachment.local_path, attachment.pr.repo.name)
+    discard_local_copy(ctx, attachment)
+    attachment.cloud_filename = None
+    resolve_attachment(ctx, attachment)
+    mark_failed(ctx, attachment.pr)
+    return False
+
+def queue_upload(ctx: RunContext, attachment: SO.Attachment) -> list[SO.Attachment]:
+    '''
+    Adds a downloaded attachment to its repo's upload batch, sending any batch that is full.
+    returns the attachments uploaded by this call, which may be earlier ones, or none yet
+    '''
+    if attachment.stage >= Stage.UPLOADED:
+        return [attachment]
+    repo = attachment.pr.repo
+    batches = ctx.uploads.add(repo.id, attachment, attachment.local_path.stat().st_size)
+    if not batches and ctx.dedup is not None and ctx.dedup.has_waiters(attachment.dedup_keys):
+        # A duplicate is already waiting for this upload, don't hold it back
+        batches = [ctx.uploads.pop(repo.id)]
+    elif not batches and ctx.server.download_budget is not None and ctx.server.download_budget.waiting:
+        # Downloads are waiting for the bytes this batch holds
+        batches = [ctx.uploads.pop(repo.id)]
+    return [uploaded for batch in batches for uploaded in upload_batch(ctx, batch)]
+
+def upload_batch(ctx: RunContext, batch: list[SO.Attachment]) -> list[SO.Attachment]:
+    '''
+    returns the attachments of batch that were uploaded, the others are marked failed
+    '''
+    if not batch:
+        return []
+    cloud = ctx.cloud
+    repo = batch[0].pr.repo
+    try:
+        with span(ctx, 'upload_attachments_to_downloads', server_repo=repo, attachments=batch):
+            results = cloud.upload_attachments_to_downloads(cloud.workspace, repo,
+                                                            [(attachment.local_path, attachment.cloud_filename)
+                                                             for attachment in batch])
+    except Exception:
+        log.exception(f'Failed to upload a batch of {len(batch)} attachments to repo "{repo.name}"')
+        results = {}
+    uploaded = []
+    for attachment in batch:
+        if finish_upload(ctx, attachment, results.get(attachment.cloud_filename, False)):
+            uploaded.append(attachment)
+        else:
+            settle_attachment(ctx, attachment, False)
+    return uploaded
+
+def drain_uploads(ctx: RunContext) -> list[SO.Attachment]:
+    '''
+    Sends every batch still waiting, returns the attachments that were uploaded
+    '''
+    return [attachment for batch in ctx.uploads.drain() for attachment in upload_batch(ctx, batch)]
+
+def free_download_budget(ctx: RunContext):
+    '''
+    Attachments sitting in partly filled upload batches hold download budget without making
+    progress. The returned callback sends those batches so waiting on the budget can't stall the run.
+    '''
+    if ctx.uploads is None:
+        return None
+    def send_batches():
+        for attachment in drain_uploads(ctx):
+            comment_attachment(ctx, attachment)
+    return send_batches
+
+def stream_attachment(ctx: RunContext, attachment: SO.Attachment) -> bool:
+    '''
+    Download and upload in one step, relaying the server response straight into the cloud upload
+    '''
+    if attachment.stage >= Stage.UPLOADED or claim_attachment(ctx, attachment):
+        return True
+    cloud, server = ctx.cloud, ctx.server
+    repo = attachment.pr.repo
+    cloud_filename = ServerUtils.unique_filename(attachment.filename, attachment.pr.id)
+    hashed_chunks: list[HashingIterator] = []
+
+    def open_stream():
+        opened = server.stream_repo_attachment(repo.project, repo, attachment.id, attachment.filename)
+        if opened is None:
+            return None
+        chunks, length = opened
+        hashed_chunks.append(HashingIterator(chunks))
+        return hashed_chunks[-1], length
+
+    with span(ctx, 'stream_attachment', attachment=attachment):
+        streamed = cloud.upload_stream_to_downloads(cloud.workspace, repo, cloud_filename, open_stream)
+    if streamed:
+        attachment.cloud_filename = cloud_filename
+        attachment.digest = hashed_chunks[-1].hexdigest
+        if ctx.dedup is not None:
+            # Content is only known after streaming, so later duplicates can still reuse this upload
+            ctx.dedup.remember(ctx.dedup.content_key(repo.slug, attachment.digest), cloud_filename)
+        resolve_attachment(ctx, attachment)
+        record_stage(ctx, attachment, Stage.UPLOADED)
+        return True
+    log.warning('Unable to stream %s to %s under the download section', attachment.filename, repo.name)
+    resolve_attachment(ctx, attachment)
+    mark_failed(ctx, attachment.pr)
+    return False
+
+def comment_attachment(ctx: RunContext, attachment: SO.Attachment) -> bool:
+    if attachment.comment_batch is not None:
+        # Linked from the PR's consolidated comment once the rest of the PR is done
+        settle_attachment(ctx, attachment, True)
+        return True
+    cloud = ctx.cloud
+    with span(ctx, 'add_pr_comment', attachment=attachment):
+        commented = cloud.add_pr_comment(cloud.workspace, attachment.pr.repo, attachment.pr.id, attachment.cloud_filename)
+    if commented:
+        record_stage(ctx, attachment, Stage.COMMENTED)
+        return True
+    mark_failed(ctx, attachment.pr)
+    return False
+
+def settle_attachment(ctx: RunContext, attachment: SO.Attachment, uploaded: bool) -> None:
+    '''
+    Reports an attachment as done to its PR's comment batch, posting the comment if it was the last one
+    '''
+    batch, attachment.comment_batch = attachment.comment_batch, None
+    if batch is not None and batch.finish(attachment, uploaded):
+        comment_batch(ctx, batch)
+
+def comment_batch(ctx: RunContext, batch: CommentBatch) -> bool:
+    if not batch.uploaded:
+        return True
+    cloud = ctx.cloud
+    server_pr = batch.pr
+    cloud_filenames = [attachment.cloud_filename for attachment in batch.uploaded]
+    with span(ctx, 'add_pr_attachments_comment', server_pr=server_pr, attachments=batch.uploaded):
+        commented = cloud.add_pr_attachments_comment(cloud.workspace, server_pr.repo, server_pr.id, cloud_filenames)
+    if commented:
+        for attachment in batch.uploaded:
+            record_stage(ctx, attachment, Stage.COMMENTED)
+        return True
+    mark_failed(ctx, server_pr)
+    return False
+
+def load_checkpoints(ctx: RunContext) -> None:
+    '''
+    Opens the checkpoint store and seeds the dedup map with everything a previous run uploaded
+    '''
+    ctx.checkpoints = CheckpointStore(ctx.settings.checkpoint_file)
+    if ctx.dedup is None:
+        return
+    for checkpoint in ctx.checkpoints:
+        if checkpoint.stage < Stage.UPLOADED or not checkpoint.cloud_filename:
+            continue
+        _project_key, repo_slug, _pr_id, attachment_id = checkpoint.key
+        ctx.dedup.remember(ctx.dedup.source_key(checkpoint.repo_id, attachment_id), checkpoint.cloud_filename)
+        if checkpoint.digest:
+            ctx.dedup.remember(ctx.dedup.content_key(repo_slug, checkpoint.digest), checkpoint.cloud_filename)
+
+def discover_work(ctx: RunContext):
+    '''
+    Yields (repo, [(pr, None), ...]) for every repo and PR to migrate, None leaving the PR's
+    attachments to be scanned for, the same shape manifest_work() yields from a plan
+    '''
+    for server_project, server_repo in discover_repos(ctx):
+        yield server_repo, ((server_pr, None) for server_pr in discover_pull_requests(ctx, server_project, server_repo))
+
+def manifest_work(ctx: RunContext, manifest_path: str):
+    '''
+    Yields (repo, [(pr, [(attachment id, filename, source comment id), ...]), ...]) from a manifest written by
+    plan_migration(), without asking either host again
+    '''
+    settings = ctx.settings
+    projects = ProjectFilter.from_settings(settings)
+    works = schedule([RepoWork(entry.repo.project, entry.repo, entry.prs, entry.attachments, entry.size,
+                               projects.priority(entry.repo.project), entry.offset)
+                      for entry in index_manifest(manifest_path) if projects.selects(entry.repo.project)], settings)
+    if ctx.shard is not None:
+        # Sizes are known, so shards get an even share of the work rather than of the repos
+        shards = balance(works, settings, ctx.shard.count)
+        works = [work for work, shard in zip(works, shards) if shard == ctx.shard.index]
+    for server_repo, pull_requests in read_manifest(manifest_path, [work.offset for work in works]):
+        log.info(f'Migrating PRs of repo "{server_repo.name}" from the manifest')
+        yield server_repo, manifest_pull_requests(ctx, pull_requests)
+
+def manifest_pull_requests(ctx: RunContext, pull_requests):
+    yield from pull_requests
+    if ctx.progress is not None:
+        ctx.progress.repo_done()
+
+def run_serial(ctx: RunContext, work=None):
+    '''
+    work = (repo, [(pr, attachments or None), ...]) items to migrate, see discover_work() (the default)
+    and manifest_work()
+    '''
+    if work is None:
+        work = discover_work(ctx)
+    for server_repo, pull_requests in work:
+        for server_pr, listing in pull_requests:
+            for attachment in extract_attachments(ctx, server_pr, listing):
+                for transferred in transfer_attachment(ctx, attachment):
+                    comment_attachment(ctx, transferred)
+        if ctx.uploads is not None:
+            # The repo's last, partly filled, batch
+            for transferred in upload_batch(ctx, ctx.uploads.pop(server_repo.id)):
+                comment_attachment(ctx, transferred)
+
+def transfer_attachment(ctx: RunContext, attachment: SO.Attachment) -> list[SO.Attachment]:
+    '''
+    Gets the attachment into its cloud repo's downloads.
+    returns the attachments now uploaded, with batched uploads these may be earlier ones, or none yet
+    '''
+    if ctx.settings.streaming_mode:
+        transferred = stream_attachment(ctx, attachment)
+    elif ctx.uploads is not None:
+        if download_attachment(ctx, attachment):
+            return queue_upload(ctx, attachment)
+        transferred = False
+    else:
+        transferred = download_attachment(ctx, attachment) and upload_attachment(ctx, attachment)
+    if not transferred:
+        settle_attachment(ctx, attachment, False)
+        return []
+    return [attachment]
+
+def run_pipeline(ctx: RunContext, work=None):
+    '''
+    Same work as run_serial but every stage runs on its own worker pool, joined by bounded
+    queues so discovery can't get too far ahead of the downloads/uploads.
+    With work from a manifest the discovery stage is left out and its PRs go straight to extraction.
+    '''
+    def guarded(step):
+        # Adapts a step into a stage that cleans up after an attachment whose step raised
+        def stage(attachment: SO.Attachment):
+            try:
+                return step(ctx, attachment)
+            except Exception:
+                # Release any dedup claims so duplicates of this attachment aren't left waiting
+                attachment.cloud_filename = None
+                resolve_attachment(ctx, attachment)
+                mark_failed(ctx, attachment.pr)
+                settle_attachment(ctx, attachment, False)
+                raise
+        return stage
+
+    def keep_if(check):
+        # Adapts a bool returning step into a stage that only forwards successful items
+        def step(ctx: RunContext, attachment: SO.Attachment):
+            if check(ctx, attachment):
+                return [attachment]
+            settle_attachment(ctx, attachment, False)
+            return None
+        return guarded(step)
+
+    settings = ctx.settings
+    workers = settings.pipeline_workers
+    pipeline = Pipeline()
+    if work is None:
+        pipeline.add_stage('discovery',
+                           lambda project_repo: ((server_pr, None) for server_pr in discover_pull_requests(ctx, *project_repo)),
+                           workers['discovery'], settings.pipeline_queue_size)
+    pipeline.add_stage('extraction', lambda pr_listing: extract_attachments(ctx, *pr_listing),
+                       workers['extraction'], settings.pipeline_queue_size)
+    if settings.streaming_mode:
+        # Download and upload happen together, so the download workers do both
+        pipeline.add_stage('transfer', keep_if(stream_attachment),
+                           workers['download'], settings.pipeline_queue_size)
+    else:
+        pipeline.add_stage('download', keep_if(download_attachment),
+                           workers['download'], settings.pipeline_queue_size)
+        if ctx.uploads is not None:
+            pipeline.add_stage('upload', guarded(queue_upload),
+                               workers['upload'], settings.pipeline_queue_size,
+                               drain=lambda: drain_uploads(ctx))
+        else:
+            pipeline.add_stage('upload', keep_if(upload_attachment),
+                               workers['upload'], settings.pipeline_queue_size)
+    pipeline.add_stage('comment', keep_if(comment_attachment),
+                       workers['comment'], settings.pipeline_queue_size)
+    if ctx.metrics is not None:
+        ctx.metrics.gauge('bitbucket_pipeline_queue_depth', 'Items waiting on each pipeline stage', 'stage',
+                          lambda: {stage.name: stage.queue.qsize() for stage in pipeline.stages})
+    if work is None:
+        pipeline.run(discover_repos(ctx))
+    else:
+        pipeline.run(pr_listing for server_repo, pull_requests in work for pr_listing in pull_requests)
+
+async def run_async_driver(ctx: RunContext):
+    '''
+    Same work as run_serial on a single event loop. Up to settings.async_max_in_flight
+    requests run concurrently without needing a thread per request.
+    '''
+    cloud, server, settings = ctx.cloud, ctx.server, ctx.settings
+    from aiohttp import ClientSession, TCPConnector, BasicAuth
+    from resources.async_cloud_api import AsyncCloud
+    from resources.async_server_api import AsyncServer
+
+    connector_limit = settings.async_max_in_flight
+    cloud_session = ClientSession(auth=BasicAuth(*cloud.session.auth), connector=TCPConnector(limit=connector_limit))
+    server_session = ClientSession(auth=BasicAuth(*server.session.auth), connector=TCPConnector(limit=connector_limit))
+    async with cloud_session, server_session:
+        async_cloud = AsyncCloud(cloud_session, cloud.workspace, cloud.base_url, cloud.rate_limiter)
+        async_server = AsyncServer(server_session, server.base_url, server.ssl_verify, server.rate_limiter)
+        # Bounds how many PRs are worked on at once so tasks don't pile up faster than they finish
+        pr_slots = asyncio.Semaphore(settings.async_max_in_flight)
+
+        async def process_attachment(server_pr: SO.PullRequest, attachment_id: int, filename: str, comment_id: int):
+            repo = server_pr.repo
+            attachment = SO.Attachment(attachment_id, filename, server_pr, comment_id=comment_id)
+            if not resume_attachment(ctx, attachment):
+                return
+            if attachment.stage < Stage.UPLOADED:
+                if attachment.local_path is None:
+                    attachment.local_path = await async_server.download_repo_attachment(repo.project, repo, attachment_id,
+                                                                                        filename, server_pr.id)
+                    if attachment.local_path is None:
                         log.warning(f'Skipping upload attempt for "{filename}" since download failed.')
-                        continue
-                    if cloud.upload_attachment_to_downloads(cloud.workspace, server_repo, attachment):
-                        cloud.add_pr_comment(cloud.workspace, server_repo, server_pr.id, attachment)
-                    else:
-                        log.warning(f'Unable to upload {attachment} to {server_repo.name} under the download section')
-                    remove_attachment_local_copy(attachment)
+                        return
+                    attachment.cloud_filename = attachment.local_path.name
+                    record_stage(ctx, attachment, Stage.DOWNLOADED)
+                local_path = attachment.local_path
+                try:
+                    uploaded = await async_cloud.upload_attachment_to_downloads(async_cloud.workspace, repo, local_path)
+                finally:
+                    discard_local_copy(ctx, attachment)
+                if not uploaded:
+                    log.warning(f'Unable to upload {local_path} to {repo.name} under the download section')
+                    return
+                record_stage(ctx, attachment, Stage.UPLOADED)
+            if await async_cloud.add_pr_comment(async_cloud.workspace, repo, server_pr.id, attachment.cloud_filename):
+                record_stage(ctx, attachment, Stage.COMMENTED)
+
+        async def process_pr(server_pr: SO.PullRequest):
+            try:
+                repo = server_pr.repo
+                if not await async_cloud.pr_exists(async_cloud.workspace, repo, server_pr.id):
+                    log.info(f'Skipping pr "{server_pr.id}" from repo "{repo.name}" as is it not present in your Cloud workspace')
+                    return
+                log.info('Scaning pr "%s" within repo "%s" for attachments', server_pr.id, repo.name)
+                transfers = [process_attachment(server_pr, *listed)
+                             async for listed in async_server.get_pull_request_attachments(repo.project, repo, server_pr)]
+                for result in await asyncio.gather(*transfers, return_exceptions=True):
+                    if isinstance(result, Exception):
+                        log.error(f'Attachment transfer for pr "{server_pr.id}" in repo "{repo.name}" failed: {result!r}')
+            finally:
+                pr_slots.release()
+
+        tasks = set()
+        async for server_project in async_server.get_projects_by_name(settings.server_project_name):
+            async for server_repo in async_server.get_repos(server_project):
+                if ctx.shard is not None and not ctx.shard.owns(repo_key(server_repo)):
+                    continue
+                if not await async_cloud.repo_exists(async_cloud.workspace, server_repo):
+                    log.info(f'Skipping repo "{server_repo.name}" as it is not present in your Cloud workspace')
+                    continue
+                log.info(f'Scanning PRs from repo "{server_repo.name}"')
+                async for server_pr in async_server.get_pull_requests(server_project, server_repo):
+                    await pr_slots.acquire()
+                    task = asyncio.create_task(process_pr(server_pr))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+
+def plan_migration(ctx: RunContext, manifest_path: str) -> dict:
+    '''
+    Walks projects -> repos -> PRs -> attachments like a run would, asking the server for every
+    attachment's size instead of transferring it, and writes it all to manifest_path for --execute.
+    returns the manifest summary, totals and estimated_seconds
+    '''
+    settings = ctx.settings
+    writer = ManifestWriter(manifest_path)
+    head_seconds, head_requests = 0.0, 0
+    # PRs of a repo are planned concurrently in pipeline mode, map() keeps them in order
+    workers = settings.pipeline_workers['extraction'] if settings.pipeline_mode else 1
+    try:
+        with ThreadPoolExecutor(workers, thread_name_prefix='plan') as executor:
+            for server_project, server_repo in discover_repos(ctx):
+                writer.repo(server_repo)
+                pull_requests = discover_pull_requests(ctx, server_project, server_repo)
+                for server_pr, attachments, seconds in executor.map(lambda server_pr: plan_pull_request(ctx, server_pr),
+                                                                    pull_requests):
+                    writer.pull_request(server_pr, attachments)
+                    head_seconds += seconds
+                    head_requests += len(attachments)
+    except BaseException:
+        writer.close(complete=False)
+        raise
+    latency = head_seconds / head_requests if head_requests else 0.0
+    estimate = estimate_seconds(settings, writer.attachments, writer.prs, writer.bytes, latency,
+                                settings.estimate_bandwidth)
+    summary = writer.close(complete=True, request_seconds=round(latency, 4), estimated_seconds=round(estimate))
+    log.info(f'Planned {summary["attachments"]} attachments ({summary["bytes"] / 1e6:.1f} MB, '
+             f'{summary["unknown_sizes"]} of unknown size) in {summary["prs"]} PRs of {summary["repos"]} repos, '
+             f'estimated to take {estimate / 60:.0f} minutes. Manifest written to "{manifest_path}"')
+    return summary
+
+def plan_pull_request(ctx: RunContext, server_pr: SO.PullRequest) -> tuple[SO.PullRequest, list, float]:
+    '''
+    returns (pr, [(attachment id, filename, source comment id, size or None), ...], seconds spent on the size requests)
+    '''
+    server, repo = ctx.server, server_pr.repo
+    log.info('Scaning pr "%s" within repo "%s" for attachments', server_pr.id, repo.name)
+    attachments, seconds = [], 0.0
+    listing = server.get_pull_request_attachments(repo.project, repo, server_pr)
+    for attachment_id, filename, comment_id in traced(ctx, 'get_pull_request_attachments', listing, server_pr=server_pr):
+        started = perf_counter()
+        try:
+            size = server.get_repo_attachment_size(repo.project, repo, attachment_id)
+        except Exception as e:
+            log.warning('Unable to get the size of attachment "%s" in repo "%s": %r', attachment_id, repo.name, e)
+            size = None
+        seconds += perf_counter() - started
+        attachments.append((attachment_id, filename, comment_id, size))
+    return server_pr, attachments, seconds
+
+def parse_args(argv: list[str]=None) -> Namespace:
+    parser = ArgumentParser(description='Copies pull request attachments from Bitbucket Server to Bitbucket Cloud')
+    parser.add_argument('--shard', type=Shard.parse, metavar='INDEX/COUNT',
+                        help='only migrate the repos of this shard, ex: "0/4" on the first of four workers')
+    parser.add_argument('--workers', type=int, metavar='COUNT',
+                        help='start COUNT sharded worker processes on this machine and report their progress')
+    parser.add_argument('--progress', action='store_true',
+                        help='report the progress recorded in checkpoint_file by sharded workers and exit')
+    modes = parser.add_mutually_exclusive_group()
+    modes.add_argument('--plan', metavar='MANIFEST',
+                       help='list every attachment to migrate and its size in MANIFEST, with totals and a time estimate, then exit')
+    modes.add_argument('--execute', metavar='MANIFEST',
+                       help='migrate the attachments listed in MANIFEST (see --plan) without discovering them again')
+    args = parser.parse_args(argv)
+    if args.plan and (args.shard or args.workers):
+        # --execute splits a manifest between shards itself, so it has to list every shard's work
+        parser.error('--plan writes one manifest for all shards, run it without --shard and --workers '
+                     'then pass the manifest to --execute with them')
+    return args
+
+def report_progress(checkpoint_file: str) -> None:
+    shards, stages = read_progress(checkpoint_file)
+    for shard_index, shard_count, status, repos_done, attachments_done, updated_at in shards:
+        log.info(f'Shard {shard_index}/{shard_count} {status}: {repos_done} repos and {attachments_done} '
+                 f'attachments done, last update {time() - updated_at:.0f} seconds ago')
+    in_progress = sum(count for stage, count in stages.items() if stage < Stage.COMMENTED)
+    log.info(f'Overall: {sum(shard[3] for shard in shards)} repos finished, {stages.get(Stage.COMMENTED, 0)} '
+             f'attachments migrated, {in_progress} in progress or failed')
+
+def coordinate(worker_count: int, worker_args: list[str]=(), report_interval: float=10.0) -> None:
+    '''
+    Runs worker_count copies of this script, each with its own --shard (and worker_args, ex: --execute MANIFEST),
+    and reports their combined progress until all of them have exited
+    '''
+    # Checked once up front so a bad setup fails here instead of in every worker, which then start from the cached probes
+    _, _, settings = init()
+    if not settings.checkpoint_file:
+        log.warning('Progress can only be reported when "checkpoint_file" is set')
+    script = Path(__file__).resolve()
+    workers = [subprocess.Popen([sys.executable, str(script), '--shard', f'{index}/{worker_count}', *worker_args])
+               for index in range(worker_count)]
+    log.info(f'Started {worker_count} sharded workers')
+    while any(worker.poll() is None for worker in workers):
+        sleep(report_interval)
+        if settings.checkpoint_file:
+            report_progress(settings.checkpoint_file)
+    failed = [f'{index}/{worker_count}' for index, worker in enumerate(workers) if worker.returncode]
+    if failed:
+        log.error(f'Shards {", ".join(failed)} exited with an error, rerun them with --shard to resume')
+    log.info('All sharded workers have exited.')
+
+def main():
+    args = parse_args()
+    if args.workers:
+        coordinate(args.workers, ['--execute', args.execute] if args.execute else [])
+        exit()
+    if args.progress:
+        report_progress(load_settings().checkpoint_file)
+        exit()
+
+    cloud, server, settings = init(args)
+    ctx = RunContext(cloud, server, settings)
+    if settings.shard_count > 1 and args.plan:
+        log.warning('--plan lists the work of every shard, "shard_count" only applies to --execute')
+    elif settings.shard_count > 1:
+        ctx.shard = Shard(settings.shard_index, settings.shard_count)
+        log.info(f'Running shard {ctx.shard}')
+        # Workers started from the same env.py would otherwise fight over one port and file
+        if settings.metrics_port:
+            settings.metrics_port += ctx.shard.index
+        if settings.metrics_textfile:
+            settings.metrics_textfile = ctx.shard.path(settings.metrics_textfile)
+        if settings.trace_file:
+            settings.trace_file = ctx.shard.path(settings.trace_file)
+    if settings.deduplicate_attachments:
+        ctx.dedup = AttachmentDedup()
+    if settings.checkpoint_file:
+        load_checkpoints(ctx)
+    if settings.cloud_index:
+        ctx.cloud_index = CloudIndex(cloud)
+    if settings.upload_batch_size > 1 and not settings.streaming_mode:
+        ctx.uploads = UploadBatcher(settings.upload_batch_size, settings.upload_batch_bytes)
+    if settings.download_budget_bytes:
+        server.download_budget = ByteBudget(settings.download_budget_bytes, free_download_budget(ctx))
+    if args.execute:
+        summary = read_summary(args.execute)
+        if summary is None or not summary.get('complete'):
+            log.warning(f'Manifest "{args.execute}" is incomplete, only the attachments planned so far will be migrated')
+    if settings.incremental_sync:
+        if args.plan or args.execute:
+            log.warning('Incremental sync does not apply to --plan and --execute, running a full sync instead')
+        elif ctx.checkpoints is None:
+            log.warning('Incremental sync needs "checkpoint_file" to store its watermarks, running a full sync instead')
+        elif settings.async_mode:
+            log.warning('Incremental sync is not supported in async mode, running a full sync instead')
+        else:
+            ctx.sync = SyncTracker(ctx.checkpoints)
+    exporter = None
+    if settings.metrics_textfile or settings.metrics_port:
+        ctx.metrics = cloud.metrics = server.metrics = Metrics()
+        exporter = MetricsExporter(ctx.metrics, settings.metrics_textfile, settings.metrics_port,
+                                   settings.metrics_interval)
+        exporter.start()
+    if settings.trace_file:
+        ctx.tracer = Tracer(settings.trace_file)
+    cache = None
+    if settings.http_cache_file:
+        cache = cloud.cache = server.cache = HTTPCache(settings.http_cache_file, settings.http_cache_max_bytes)
+    if ctx.shard is not None and ctx.checkpoints is not None and not args.plan:
+        ctx.progress = ShardProgress(ctx.shard, ctx.checkpoints)
+        ctx.progress.report(force=True)
+    status = 'failed'
+    try:
+        if args.plan:
+            plan_migration(ctx, args.plan)
+        elif args.execute:
+            work = manifest_work(ctx, args.execute)
+            if settings.async_mode:
+                log.warning('Async mode can not execute a manifest, running in pipeline mode instead')
+            if settings.pipeline_mode or settings.async_mode:
+                run_pipeline(ctx, work)
+            else:
+                run_serial(ctx, work)
+        elif settings.async_mode:
+            ignored = settings.ignored_by_async_mode()
+            if ignored:
+                log.warning(f'Async mode does not support {", ".join(map(repr, ignored))}, ignoring them')
+            asyncio.run(run_async_driver(ctx))
+        elif settings.pipeline_mode:
+            run_pipeline(ctx)
+        else:
+            run_serial(ctx)
+        if ctx.sync is not None:
+            ctx.sync.commit()
+        status = 'finished'
+    finally:
+        if ctx.progress is not None:
+            ctx.progress.report(status, force=True)
+        if exporter is not None:
+            exporter.stop()
+        if ctx.tracer is not None:
+            ctx.tracer.close()
+        if cache is not None:
+            cache.close()
+        if ctx.checkpoints is not None:
+            ctx.checkpoints.close()
+        stop_logging()
 
     log.info('Done. Closing...')
     exit()
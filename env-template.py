@@ -18,3 +18,133 @@ cloud_username = ''
 cloud_password = ''
 # Your cloud workspace ID/slug https://support.atlassian.com/bitbucket-cloud/docs/change-a-workspace-id/
 cloud_workspace = ''
+
+# Run discovery, attachment extraction, download, upload and comment as a concurrent pipeline
+# rather than one attachment at a time. Each stage gets its own pool of worker threads.
+pipeline_mode = False
+# Worker threads per pipeline stage. Any stage left out uses its default.
+pipeline_workers = {'discovery': 2, 'extraction': 4, 'download': 8, 'upload': 4, 'comment': 2}
+# Max items waiting between two stages. Keeps discovery from outrunning the uploaders and
+# bounds how many downloaded attachments sit on disk at once.
+pipeline_queue_size = 50
+
+# Run on a single asyncio event loop instead of threads, keeping many requests in flight at once.
+# Requires "pip3 install aiohttp". Takes precedence over pipeline_mode. Only migrates server_project_name and
+# ignores all_projects, deduplicate_attachments, streaming_mode, upload_batch_size, consolidate_comments,
+# cloud_index, page_prefetch, stream_pages, http_cache_file, download_chunk_size, download_budget_bytes,
+# metrics_textfile, metrics_port and trace_file.
+async_mode = False
+# Max concurrent requests per host (and PRs being processed) in async mode
+async_max_in_flight = 200
+
+# Relay each attachment from server straight into the cloud upload in chunks instead of saving it
+# to the working directory first. Keeps memory use to a few chunks and never touches local disk.
+# Applies to the serial and pipeline modes.
+streaming_mode = False
+
+# Download/upload every unique attachment only once per cloud repo, matching both repeated
+# references to the same attachment and identical content, and link every comment to that one upload
+deduplicate_attachments = True
+
+# SQLite file recording how far every attachment got. A rerun skips attachments that were fully migrated
+# (so no duplicate comments) and resumes the rest at the stage they stopped at. Set to None to disable.
+checkpoint_file = 'migration-state.sqlite3'
+
+# List the cloud workspace's repos and each repo's PRs once, in large pages, and check existence locally
+# rather than sending one request per repo and per PR
+cloud_index = True
+
+# Requests per second sent to each host (None for no limit) and how many may go out back to back.
+# These are starting points: the script follows the rate limit headers each host returns, slows down
+# before being throttled, and waits only as long as a 429's Retry-After asks.
+server_rate_limit = 20.0
+cloud_rate_limit = 10.0
+rate_limit_burst = 10
+
+# Connections kept alive per host. None sizes the pool to the number of workers.
+http_pool_size = None
+# Seconds to wait for a connection and for response data before the attempt counts as failed
+connect_timeout = 10.0
+read_timeout = 120.0
+# Times a request is resent after a connection error or 5xx response, with jittered exponential backoff
+max_retries = 5
+
+# Fetch the next page of a listing in the background while the current page is being worked on
+page_prefetch = True
+
+# Only look at PRs updated since the previous run. Each repo's high-water mark is kept in checkpoint_file,
+# PRs are listed newest first and listing stops at the first PR that hasn't changed since.
+incremental_sync = False
+
+# Parse listing pages (ex: PR activities carrying large diffs) item by item as they download so memory
+# stays flat whatever the page size. Pages are then read one after another, so page_prefetch has no effect.
+stream_pages = False
+
+# Post one comment per PR linking all of its migrated attachments instead of one comment per attachment.
+# Reruns check the PR's comments first and only link attachments that aren't linked yet.
+consolidate_comments = False
+
+# Upload up to this many attachments (and at most this many bytes) to a cloud repo's downloads in one request.
+# If a combined upload fails its files are retried one by one. 1 uploads each attachment on its own,
+# ex: 20 sends up to 20 attachments per request.
+upload_batch_size = 1
+upload_batch_bytes = 50 * 1024 * 1024
+
+# Split the repos between several workers, on one machine or several, and only migrate this worker's share.
+# Usually set per worker on the command line instead: python3 bitbucket_api.py --shard 0/4
+shard_index = 0
+shard_count = 1
+
+# Prometheus metrics: request counts, latency histograms, bytes, status codes, retries and rate limit waits
+# per endpoint, plus attachments per second and pipeline queue depths. Write them to a file for the
+# node_exporter textfile collector (ex: '/var/lib/node_exporter/bitbucket_migration.prom') and/or serve
+# them on http://127.0.0.1:<metrics_port>/metrics. None disables either.
+# Sharded workers add their shard index to the port and the file name (ex: 'bitbucket_migration.shard1.prom').
+metrics_textfile = None
+metrics_port = None
+metrics_interval = 15.0
+
+# Write a timeline of every PR listing, activities page, download, upload and comment, tagged with the
+# project/repo/PR/attachment it worked on, to this file. Open it in chrome://tracing or https://ui.perfetto.dev
+# Sharded workers write 'trace.shard<index>.json' instead of 'trace.json'.
+trace_file = None
+
+# Time estimates of "python3 bitbucket_api.py --plan manifest.jsonl" assume every download and upload
+# moves this many bytes per second
+estimate_bandwidth = 5 * 1024 * 1024
+
+# Keep listing responses in this SQLite file between runs (ex: 'http-cache.sqlite3') so reruns only download
+# what changed, and merged or declined PR activities not at all. None disables the cache.
+http_cache_file = None
+http_cache_max_bytes = 256 * 1024 * 1024
+
+# Attachments larger than download_chunk_size are downloaded in chunks, download_chunk_workers at a time,
+# into spool_dir (None = the system temp directory) and resume from their finished chunks after a failure.
+download_chunk_size = 16 * 1024 * 1024
+download_chunk_workers = 4
+spool_dir = None
+# Most bytes of downloaded attachments held at once (in progress or waiting for their upload), None for no limit
+download_budget_bytes = 1024 * 1024 * 1024
+
+# Results of the startup checks (server SSL mode, cloud workspace, access to both) are reused for
+# preflight_cache_ttl seconds so reruns and sharded workers start straight away. None disables the file.
+preflight_cache_file = '.preflight-cache.json'
+preflight_cache_ttl = 3600.0
+
+# Migrate every server project instead of server_project_name. Include/exclude patterns are globs matched
+# against project keys and names, ex: ['CORE', 'TEAM-*']. Priorities, ex: {'CORE': 10}, go first (others are 0).
+# Within a priority the largest repos are migrated first.
+all_projects = False
+project_include = None
+project_exclude = None
+project_priorities = None
+
+# Log records are written by a background thread so workers never wait on the log file. log_json writes
+# bitbucket-api.log as JSON lines (ex: for a log shipper), log_file_level is the least severe level it keeps.
+# A message repeated more than log_rate_limit_burst times within log_rate_limit_interval seconds is counted
+# instead of shown on the console, None disables this. Errors are always shown, the log file keeps everything.
+async_logging = True
+log_json = False
+log_file_level = 'DEBUG'
+log_rate_limit_interval = 10.0
+log_rate_limit_burst = 5
@@ -1,10 +1,21 @@
-from requests import Session, Response
-from typing import Generator
-from time import sleep
+import json
+from requests import Request, Session, Response
+from requests.exceptions import RequestException
+from typing import Generator, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import sleep, perf_counter
 from sys import exit
 
+from resources.rate_limit import RateLimiter
+from resources.transport import Transport
+from resources.json_stream import JSONPageStream
+from resources.metrics import Metrics
+from resources.http_cache import HTTPCache
 from resources.logger import log
 
+_prefetch_lock = Lock()
+
 class Base_API:
     '''
     Do not Instantiate this class directly.
@@ -12,6 +23,19 @@ class Base_API:
     resources.server_api.Server() class as they inherit
     from this base class.
     '''
+    _prefetch_pool: ThreadPoolExecutor = None
+    prefetch_pages: bool = True
+    # Largest page size the host serves, used unless a call asks for another
+    max_page_size: int = 100
+    # Whether the host accepts a "fields" query param to trim responses
+    supports_fields: bool = False
+    # Parse listing pages value by value as they download, see _get_streamed_pages
+    stream_pages: bool = False
+    stream_chunk_size: int = 64 * 1024
+    # Every request is reported here when set, see resources.metrics
+    metrics: Metrics = None
+    # GET responses are cached between runs here when set, see _get_json
+    cache: HTTPCache = None
 
     def __init__(self) -> None:
         self.session: Session = None
@@ -20,78 +44,259 @@ class Base_API:
         self.pagination_marker: str = None
         self.pagination_page: str = None
         self.pagination_per_page: str = None
+        self.rate_limiter: RateLimiter = None
+        self.transport: Transport = None
+        self.prefetch_pages: bool = True
+
+    def _request(self, method: str, endpoint: str, **kwargs) -> Response:
+        '''
+        Every call to the host goes through here. Requests are paced by self.rate_limiter and
+        a throttled (429) request is retried as is once the host's requested wait has passed.
+        Connection errors and 5xx responses are retried with backoff as self.transport allows.
+
+        endpoint may also be a full url. A callable "data" or "files" is treated as a factory
+        for a one-shot body (ex: a stream or open file) and called again for every attempt.
+        '''
+        url = self._url(endpoint)
+        data = kwargs.pop('data', None)
+        files = kwargs.pop('files', None)
 
-    def _get_api(self, endpoint: str, params: dict=None, headers: dict=None) -> dict:
-        endpoint = self._validate_endpoint(endpoint)
-        url = f'{self.base_url}{endpoint}'
+        metrics = self.metrics
+        attempt = 0
+        while True:
+            body = data() if callable(data) else data
+            body_files = files() if callable(files) else files
+            waited = perf_counter()
+            self.rate_limiter.acquire()
+            started = perf_counter()
+            if metrics is not None:
+                metrics.observe_rate_limit_wait(url, started - waited)
+            try:
+                r = self.session.request(method, url, data=body, files=body_files, verify=self.ssl_verify,
+                                         timeout=self.transport.timeout, **kwargs)
+            except RequestException as e:
+                if metrics is not None:
+                    metrics.observe_request(method, url, 'error', perf_counter() - started, 0, 0)
+                if not self.transport.should_retry_error(method, e, attempt):
+                    raise
+                if metrics is not None:
+                    metrics.observe_retry(method, url, type(e).__name__)
+                delay = self.transport.delay(attempt)
+                attempt += 1
+                log.warning('%s "%s" failed with %r, retry %s of %s in %.1f seconds', method, url, e, attempt,
+                            self.transport.max_retries, delay)
+                sleep(delay)
+                continue
+            if metrics is not None:
+                self._observe(metrics, method, url, r, perf_counter() - started, kwargs.get('stream'))
+            # A Retry-After of 0 (or a date already past) pauses nobody but is still retried
+            self.rate_limiter.update(r)
+            if r.status_code == 429:
+                if metrics is not None:
+                    metrics.observe_retry(method, url, str(r.status_code))
+                r.close()
+                continue
+            if self.transport.should_retry_status(method, r.status_code, attempt):
+                if metrics is not None:
+                    metrics.observe_retry(method, url, str(r.status_code))
+                delay = self.transport.delay(attempt)
+                attempt += 1
+                log.warning('%s "%s" returned %s, retry %s of %s in %.1f seconds', method, url, r.status_code, attempt,
+                            self.transport.max_retries, delay)
+                r.close()
+                sleep(delay)
+                continue
+            if self._authorized(r.status_code):
+                return r
 
-        r = self.session.get(url, params=params, headers=headers, verify=self.ssl_verify)
+    @staticmethod
+    def _observe(metrics: Metrics, method: str, url: str, r: Response, seconds: float, stream: bool) -> None:
+        sent = r.request.headers.get('Content-Length')
+        received = r.headers.get('Content-Length')
+        if received is None and not stream:
+            received = len(r.content)
+        metrics.observe_request(method, url, r.status_code, seconds, int(sent or 0), int(received or 0))
+
+    def _url(self, endpoint: str) -> str:
+        if endpoint.startswith(('http://', 'https://')):
+            return endpoint
+        return f'{self.base_url}{self._validate_endpoint(endpoint)}'
+
+    def _get_json(self, endpoint: str, params: dict=None, headers: dict=None, immutable: str=None) -> dict:
+        '''
+        GETs endpoint's json body, through self.cache when set: a cached response is revalidated with
+        its ETag/Last-Modified and served again on a 304, or served without a request at all when it
+        was stored under the same immutable version. See _get_paged_api for immutable.
+        '''
+        cache = self.cache
+        if cache is None:
+            return self._request('GET', endpoint, params=params, headers=headers).json()
+        # The url as requests will send it, params included, identifies the response
+        url = Request('GET', self._url(endpoint), params=params).prepare().url
+        cached = cache.get(url, immutable)
+        if cached is not None:
+            if cached.fresh:
+                return json.loads(cached.body)
+            headers = {**(headers or {}), **cached.validators()}
+        r = self._request('GET', url, headers=headers)
+        if r.status_code == 304 and cached is not None:
+            cache.touch(url)
+            return json.loads(cached.body)
+        if r.status_code == 200:
+            cache.put(url, r.content, r.headers.get('ETag'), r.headers.get('Last-Modified'), immutable)
         return r.json()
 
+    def _get_api(self, endpoint: str, params: dict=None, headers: dict=None,
+                 fields: Iterable[str]=None, immutable: str=None) -> dict:
+        '''
+        fields = dotted paths of the only keys wanted in the response, see _get_paged_api
+        immutable = see _get_paged_api
+        '''
+        if fields:
+            params = {**(params or {}), **self._fields_params(fields, paged=False)}
+        r_json = self._get_json(endpoint, params, headers, immutable)
+        if fields and not r_json.get('error'):
+            return self._project(r_json, fields)
+        return r_json
+
     def _get_paged_api(self, endpoint: str, params: dict=None, headers: dict=None,
-                       page: int=None) -> Generator[dict, None, None]:
-        endpoint = self._validate_endpoint(endpoint)
-        url = f'{self.base_url}{endpoint}'
+                       page: int=None, fields: Iterable[str]=None,
+                       page_size: int=None, immutable: str=None) -> Generator[dict, None, None]:
+        '''
+        Yields every value of every page. page = where to start, defaults to the first page.
 
-        while True:
-            if params is None:
-                params = {self.pagination_page: page, self.pagination_per_page: 100}
-            elif isinstance(params, dict):
-                # Persist whatever params are passed in, only overwriting/appending page specifically
-                params[self.pagination_page] = page
-
-            r = self.session.get(url, params=params, headers=headers, verify=self.ssl_verify)
-
-            if not self._api_rate_limited(r.status_code) and self._authorized(r.status_code):
-                r_json = r.json()
-                for value in r_json.get('values'):
-                    yield value
-            
-            # not 'next' cloud, 'isLastPage' server
-            if self.base_url == 'https://api.bitbucket.org':
-                next_page_present = r.json().get(self.pagination_marker)
-            else:
-                # TODO verify isLastPage always exists for server responses
-                next_page_present = not r.json().get(self.pagination_marker)
-            page = self._page_handler(page, next_page_present)
+        fields = dotted paths (ex: "project.key") of the only keys each value needs. Hosts that
+        support it (Cloud) are asked to leave everything else out of the response, and any
+        other keys are dropped before the value is yielded.
+        page_size = values per page, defaults to the largest page the host serves (self.max_page_size)
+        immutable = a version (ex: a merged PR's updated date) under which the listing can no longer
+        change. With self.cache set, pages cached under the same version are served without a request.
 
-            if page is None:
-                # Breaks out of while True when the last page's content has already been yielded
-                return
+        While the values of one page are being consumed the next page is already requested
+        in the background (when self.prefetch_pages is set), so paging through a large
+        listing doesn't wait on every page in turn.
+        '''
+        # Copy so the caller's dict isn't changed as we page through
+        params = dict(params or {})
+        params.setdefault(self.pagination_per_page, page_size or self.max_page_size)
+        if fields:
+            params.update(self._fields_params(fields, paged=True))
+        if page is not None:
+            params[self.pagination_page] = page
 
-    def _put_api(self, endpoint: str, params: dict=None, headers: dict=None, 
-                 json: dict=None, data: dict=None) -> Response:
-        endpoint = self._validate_endpoint(endpoint)
-        url = f'{self.base_url}{endpoint}'
+        if self.stream_pages:
+            # Pages are never held whole in this mode, so they aren't cached either
+            yield from self._get_streamed_pages(endpoint, params, headers, fields)
+            return
 
-        while True:
-            r = self.session.put(url, params=params, headers=headers, json=json,
-                                 data=data, verify=self.ssl_verify)
+        next_page = (endpoint, params)
+        pending = None
+        try:
+            while next_page is not None:
+                if pending is None:
+                    r_json = self._get_page(*next_page, headers, immutable)
+                else:
+                    r_json = pending.result()
+                    pending = None
+                next_page = self._next_page(endpoint, params, r_json)
+                if next_page is not None and self.prefetch_pages:
+                    pending = self._prefetch_executor().submit(self._get_page, *next_page, headers, immutable)
+                if fields:
+                    for value in r_json.get('values', []):
+                        yield self._project(value, fields)
+                else:
+                    yield from r_json.get('values', [])
+        finally:
+            if pending is not None:
+                # The caller stopped early, the prefetched page isn't needed
+                pending.cancel()
 
-            if not self._api_rate_limited(r.status_code) and self._authorized(r.status_code):
-                return r
+    def _get_streamed_pages(self, endpoint: str, params: dict, headers: dict,
+                            fields: Iterable[str]) -> Generator[dict, None, None]:
+        '''
+        _get_paged_api for self.stream_pages: values are parsed one by one as the body arrives
+        (see resources.json_stream) instead of loading the whole page first. The pagination
+        marker is read in the same pass, which means the next page can only be requested once
+        the current one has been read to the end, so pages aren't prefetched in this mode.
+        '''
+        next_page = (endpoint, params)
+        while next_page is not None:
+            r = self._request('GET', next_page[0], params=next_page[1], headers=headers, stream=True)
+            with r:
+                page = JSONPageStream(r.iter_content(self.stream_chunk_size))
+                for value in page:
+                    yield self._project(value, fields) if fields else value
+            next_page = self._next_page(endpoint, params, page.fields)
 
-    def _post_api(self, endpoint: str, params: dict=None, headers: dict=None,
-                  json: dict=None, data: dict=None, files: dict=None) -> Response:
-        endpoint = self._validate_endpoint(endpoint)
-        url = f'{self.base_url}{endpoint}'
+    def _get_page(self, endpoint: str, params: dict, headers: dict, immutable: str=None) -> dict:
+        return self._get_json(endpoint, params, headers, immutable)
 
-        while True:
-            r = self.session.post(url, params=params, headers=headers, json=json,
-                                  data=data, files=files, verify=self.ssl_verify)
+    def _next_page(self, endpoint: str, params: dict, r_json: dict) -> tuple[str, dict]:
+        '''
+        returns (endpoint, params) of the page after r_json or None if it is the last one
 
-            if not self._api_rate_limited(r.status_code) and self._authorized(r.status_code):
-                return r
+        Cloud hands back the full url of the next page in "next". Server pages by item
+        offset: "nextPageStart" is the start of the next page unless "isLastPage" is set.
+        '''
+        if self.pagination_marker == 'next':
+            next_url = r_json.get('next')
+            return (next_url, None) if next_url else None
+        # A missing isLastPage is treated as the last page rather than risk looping forever
+        if r_json.get(self.pagination_marker, True) or r_json.get('nextPageStart') is None:
+            return None
+        return endpoint, {**params, self.pagination_page: r_json.get('nextPageStart')}
 
-    def _delete_api(self, endpoint: str, params: dict=None, headers: dict=None) -> Response:
-        endpoint = self._validate_endpoint(endpoint)
-        url = f'{self.base_url}{endpoint}'
+    def _fields_params(self, fields: Iterable[str], paged: bool) -> dict:
+        '''
+        Query params asking the host to only send fields, empty if the host can't filter
+        '''
+        if not self.supports_fields:
+            return {}
+        if paged:
+            # Keep the pagination marker so paging still works
+            return {'fields': ','.join([self.pagination_marker, *(f'values.{field}' for field in fields)])}
+        return {'fields': ','.join(fields)}
 
-        while True:
-            r = self.session.delete(url, params=params, headers=headers, verify=self.ssl_verify)
+    @staticmethod
+    def _project(value: dict, fields: Iterable[str]) -> dict:
+        '''
+        Example:
+        in: {"id": 1, "name": "x", "project": {"key": "P", "links": {...}}}, ["id", "project.key"]
+        out: {"id": 1, "project": {"key": "P"}}
+        '''
+        projected = {}
+        for field in fields:
+            *parents, leaf = field.split('.')
+            source, target = value, projected
+            for key in parents:
+                source = source.get(key)
+                if not isinstance(source, dict):
+                    break
+                target = target.setdefault(key, {})
+            else:
+                if leaf in source:
+                    target[leaf] = source[leaf]
+        return projected
 
-            if not self._api_rate_limited(r.status_code) and self._authorized(r.status_code):
-                return r
+    @staticmethod
+    def _prefetch_executor() -> ThreadPoolExecutor:
+        # Shared by every client, created on first use
+        with _prefetch_lock:
+            if Base_API._prefetch_pool is None:
+                Base_API._prefetch_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix='page-prefetch')
+            return Base_API._prefetch_pool
+
+    def _put_api(self, endpoint: str, params: dict=None, headers: dict=None, 
+                 json: dict=None, data: dict=None) -> Response:
+        return self._request('PUT', endpoint, params=params, headers=headers, json=json, data=data)
+
+    def _post_api(self, endpoint: str, params: dict=None, headers: dict=None,
+                  json: dict=None, data: dict=None, files: dict=None) -> Response:
+        return self._request('POST', endpoint, params=params, headers=headers, json=json,
+                             data=data, files=files)
+
+    def _delete_api(self, endpoint: str, params: dict=None, headers: dict=None) -> Response:
+        return self._request('DELETE', endpoint, params=params, headers=headers)
 
     @staticmethod
     def _validate_endpoint(endpoint) -> str:
@@ -100,14 +305,6 @@ class Base_API:
             endpoint = f'/{endpoint}'
         return endpoint
 
-    @staticmethod
-    def _api_rate_limited(status_code: int) -> bool:
-        if status_code == 429:
-            log.info('Hit api rate limit, sleeping for 1 minute then attempting to resume...')
-            sleep(60)
-            return True
-        return False
-
     @staticmethod
     def _authorized(status_code: int) -> bool:
         if status_code == 401:
@@ -120,14 +317,3 @@ class Base_API:
                          'Closing...')
             exit()
         return True
-
-    @staticmethod
-    def _page_handler(next_page: int, next_page_present: bool):
-        if not next_page_present:
-            return None
-
-        if next_page is None:
-            next_page = 1
-        next_page = next_page + 1
-
-        return next_page
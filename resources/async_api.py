@@ -0,0 +1,126 @@
+from asyncio import sleep, create_task
+from typing import AsyncGenerator, Callable
+
+from aiohttp import ClientSession, ClientResponse, FormData
+
+from resources.api import Base_API
+from resources.logger import lazy
+from resources.rate_limit import RateLimiter
+
+class Async_Base_API:
+    '''
+    asyncio counterpart of resources.api.Base_API.
+
+    Do not Instantiate this class directly.
+    Instead, create a resources.async_cloud_api.AsyncCloud() or
+    resources.async_server_api.AsyncServer() class as they inherit
+    from this base class.
+
+    Requires the optional "aiohttp" package.
+    '''
+
+    def __init__(self) -> None:
+        self.session: ClientSession = None
+        self.base_url: str = None
+        self.ssl_verify: bool = None
+        self.pagination_marker: str = None
+        self.pagination_page: str = None
+        self.pagination_per_page: str = None
+        self.rate_limiter: RateLimiter = None
+
+    @property
+    def _ssl(self):
+        # aiohttp uses None for default verification and False to skip it
+        return None if self.ssl_verify else False
+
+    async def _request(self, method: str, endpoint: str, stream: bool=False, **kwargs) -> ClientResponse:
+        '''
+        Sends the request, paced by self.rate_limiter (see resources.rate_limit.RateLimiter), and
+        retries a throttled (429) request once the host's requested wait has passed.
+
+        The body is read before returning so the connection goes straight back to the pool, unless
+        stream is set, then the caller reads it and must release the response (async with r).
+        A callable "data" is treated as a factory for a one-shot body (ex: FormData over an open
+        file, which aiohttp closes once sent) and called again for every attempt.
+        '''
+        if endpoint.startswith(('http://', 'https://')):
+            url = endpoint
+        else:
+            url = f'{self.base_url}{Base_API._validate_endpoint(endpoint)}'
+        data = kwargs.pop('data', None)
+
+        while True:
+            while (wait := self.rate_limiter.reserve()) > 0:
+                await sleep(wait)
+            body = data() if callable(data) else data
+            r = await self.session.request(method, url, ssl=self._ssl, data=body, **kwargs)
+            self.rate_limiter.observe(r.headers, r.status, url)
+            if r.status == 429:
+                r.release()
+                continue
+            if not stream:
+                try:
+                    await r.read()
+                finally:
+                    r.release()
+            if Base_API._authorized(r.status):
+                return r
+
+    @staticmethod
+    def _text(r: ClientResponse) -> lazy:
+        '''
+        Log argument decoding the body of r (already read, ex: by _request) only if the message is written
+        '''
+        return lazy(lambda: (r._body or b'').decode(r.charset or 'utf-8', errors='replace'))
+
+    async def _get_api(self, endpoint: str, params: dict=None, headers: dict=None) -> dict:
+        r = await self._request('GET', endpoint, params=params, headers=headers)
+        return await r.json(content_type=None)
+
+    async def _get_paged_api(self, endpoint: str, params: dict=None, headers: dict=None,
+                             page: int=None) -> AsyncGenerator[dict, None]:
+        '''
+        See Base_API._get_paged_api, the next page is requested as a task while
+        the current page's values are consumed.
+        '''
+        if params is None:
+            params = {self.pagination_per_page: 100}
+        else:
+            params = dict(params)
+        if page is not None:
+            params[self.pagination_page] = page
+
+        next_page = (endpoint, params)
+        pending = None
+        try:
+            while next_page is not None:
+                if pending is None:
+                    r_json = await self._get_page(*next_page, headers)
+                else:
+                    r_json = await pending
+                    pending = None
+                next_page = Base_API._next_page(self, endpoint, params, r_json)
+                if next_page is not None:
+                    pending = create_task(self._get_page(*next_page, headers))
+                for value in r_json.get('values', []):
+                    yield value
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    async def _get_page(self, endpoint: str, params: dict, headers: dict) -> dict:
+        # aiohttp rejects None query values where requests silently drops them
+        query = {key: value for key, value in (params or {}).items() if value is not None}
+        r = await self._request('GET', endpoint, params=query, headers=headers)
+        return await r.json(content_type=None)
+
+    async def _put_api(self, endpoint: str, params: dict=None, headers: dict=None,
+                       json: dict=None, data: dict=None) -> ClientResponse:
+        return await self._request('PUT', endpoint, params=params, headers=headers, json=json, data=data)
+
+    async def _post_api(self, endpoint: str, params: dict=None, headers: dict=None,
+                        json: dict=None, data: FormData | Callable[[], FormData]=None) -> ClientResponse:
+        return await self._request('POST', endpoint, params=params, headers=headers, json=json, data=data)
+
+    async def _delete_api(self, endpoint: str, params: dict=None, headers: dict=None) -> ClientResponse:
+        return await self._request('DELETE', endpoint, params=params, headers=headers)
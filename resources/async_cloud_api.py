@@ -0,0 +1,78 @@
+from pathlib import Path
+
+from aiohttp import ClientSession, FormData
+
+from resources.async_api import Async_Base_API
+from resources.rate_limit import RateLimiter
+from resources.cloud_objects import Workspace, Repository
+from resources.logger import log
+
+
+class AsyncCloudSessionHandler(Async_Base_API):
+    def __init__(self, session: ClientSession, workspace: Workspace, base_url: str='https://api.bitbucket.org',
+                 rate_limiter: RateLimiter=None):
+        '''
+        workspace must already be resolved, reuse resources.cloud_api.Cloud(...).workspace
+        rate_limiter = shared with the synchronous client of the same host, if any
+        '''
+        self.session = session
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.workspace = workspace
+        self.base_url = base_url.rstrip('/')
+        self.ssl_verify = True
+        self.pagination_marker = 'next'
+        self.pagination_page = 'page'
+        self.pagination_per_page = 'pagelen'
+
+
+class AsyncCloud(AsyncCloudSessionHandler):
+    # Async mirror of resources.cloud_api.Cloud, see there for endpoint documentation
+
+    async def repo_exists(self, workspace: Workspace, repo: Repository) -> bool:
+        endpoint = f'/2.0/repositories/{workspace.slug}/{repo.slug}'
+        r_json = await self._get_api(endpoint)
+        if r_json.get('error'):
+            return False
+        return True
+
+    async def pr_exists(self, workspace: Workspace, repo: Repository, pr_id: int) -> bool:
+        endpoint = f'/2.0/repositories/{workspace.slug}/{repo.slug}/pullrequests/{pr_id}'
+        r_json = await self._get_api(endpoint)
+        if r_json.get('error'):
+            return False
+        return True
+
+    async def add_pr_comment(self, workspace: Workspace, repo: Repository, pr_id: int, attachment=Path) -> bool:
+        '''
+        returns True if successful, else False
+        '''
+        headers = {'Content-type': 'application/json'}
+        endpoint = f'/2.0/repositories/{workspace.slug}/{repo.slug}/pullrequests/{pr_id}/comments'
+        file_url = f'https://bitbucket.org/{workspace.slug}/{repo.slug}/downloads/{attachment}'
+        message = f'[{attachment}]({file_url})'
+        payload = {'content': {'raw': message}}
+        r = await self._post_api(endpoint, json=payload, headers=headers)
+        r_json: dict = await r.json(content_type=None)
+        if r.status != 201 or r_json.get('error'):
+            log.debug('Failed to create comment on pr "%s" in repo "%s" with message:\n%s\nStatus_code: %s\nText: %s',
+                      pr_id, repo.slug, message, r.status, self._text(r))
+            return False
+        log.debug('Successfully added comment on pr "%s" in repo "%s" for "%s"', pr_id, repo.slug, attachment)
+        return True
+
+    async def upload_attachment_to_downloads(self, workspace: Workspace, repo: Repository, attachment: Path) -> bool:
+        endpoint = f'/2.0/repositories/{workspace.slug}/{repo.slug}/downloads'
+
+        def files() -> FormData:
+            # aiohttp closes the file once sent, so a retried upload needs it opened again
+            form = FormData()
+            form.add_field('files', open(attachment, 'rb'), filename=Path(attachment).name)
+            return form
+
+        r = await self._post_api(endpoint, data=files)
+        if r.status == 201:
+            log.debug('Successfully uploaded "%s" to repo "%s"', attachment, repo.name)
+            return True
+        log.debug('Failed to upload "%s" for repo "%s" due to the following error:\n\t%s\n\t%s', attachment, repo.name,
+                  r.status, self._text(r))
+        return False
@@ -0,0 +1,104 @@
+import logging
+from typing import AsyncGenerator
+from pathlib import Path
+
+from aiohttp import ClientSession
+
+from resources.async_api import Async_Base_API
+from resources.rate_limit import RateLimiter
+from resources.server_api import ServerUtils
+from resources.server_objects import Project, Repository, PullRequest
+from resources.logger import log
+
+
+class AsyncServerSessionHandler(Async_Base_API):
+    def __init__(self, session: ClientSession, base_url: str, ssl_verify: bool, rate_limiter: RateLimiter=None):
+        '''
+        ssl_verify is taken as given rather than probed, reuse
+        resources.server_api.Server(...).ssl_verify to detect it.
+        rate_limiter = shared with the synchronous client of the same host, if any
+        '''
+        self.session = session
+        self.rate_limiter = rate_limiter or RateLimiter()
+        while base_url.endswith('/'):
+            base_url = base_url[:-1]
+        self.base_url = base_url
+        self.ssl_verify = ssl_verify
+        self.pagination_marker = 'isLastPage'
+        self.pagination_page = 'start'
+        self.pagination_per_page = 'limit'
+
+    async def download(self, endpoint: str, filename: str, pr_id: int, chunk_size: int=1024 * 1024) -> Path:
+        fs_filename = ServerUtils.unique_filename(filename, pr_id)
+        log.debug('Attempting to download attachment "%s" as "%s" to prevent duplicate name collision.', filename, fs_filename)
+
+        url = f'{self.base_url}{endpoint}'
+        r = await self._request('GET', endpoint, stream=True)
+        async with r:
+            if r.status != 200:
+                if log.isEnabledFor(logging.WARNING):
+                    # Streamed, so the body is only read when the message will be written
+                    await r.read()
+                log.warning('Unable to download "%s" from "%s" with\n\tStatus_code: %s\n\t%s', filename, url, r.status,
+                            self._text(r))
+                return None
+            with open(fs_filename, 'wb') as local_file:
+                async for chunk in r.content.iter_chunked(chunk_size):
+                    local_file.write(chunk)
+        log.debug('Download of "%s" successful', filename)
+        return Path(fs_filename)
+
+
+class AsyncServer(AsyncServerSessionHandler):
+    # Async mirror of resources.server_api.Server, see there for endpoint documentation
+
+    async def get_projects_by_name(self, project_name: str) -> AsyncGenerator[Project, None]:
+        endpoint = '/rest/api/latest/projects'
+        async for value in self._get_paged_api(endpoint, params={'name': project_name}):
+            project = Project(value.get('key'),
+                              value.get('name'),
+                              value.get('id'),
+                              value.get('description'),
+                              value.get('public'))
+            yield project
+
+    async def get_repos(self, project: Project) -> AsyncGenerator[Repository, None]:
+        endpoint = f'/rest/api/latest/projects/{project.key}/repos'
+        async for value in self._get_paged_api(endpoint):
+            repo = Repository(value.get('slug'),
+                              value.get('id'),
+                              value.get('name'),
+                              value.get('description'),
+                              project=project)
+            yield repo
+
+    async def get_pull_requests(self, project: Project, repo: Repository) -> AsyncGenerator[PullRequest, None]:
+        endpoint = f'/rest/api/latest/projects/{project.key}/repos/{repo.slug}/pull-requests'
+        async for value in self._get_paged_api(endpoint, params={'state': 'ALL'}):
+            pr = PullRequest(value.get('id'),
+                             value.get('title'),
+                             value.get('description'),
+                             value.get('state'),
+                             value.get('createdDate'),
+                             value.get('updatedDate'),
+                             repo=repo)
+            yield pr
+
+    async def get_pull_request_attachments(self, project: Project, repo: Repository,
+                                           pr: PullRequest) -> AsyncGenerator[tuple[int, str, int], None]:
+        '''
+        Same as resources.server_api.Server.get_pull_request_attachments
+        '''
+        endpoint = f'/rest/api/latest/projects/{project.key}/repos/{repo.slug}/pull-requests/{pr.id}/activities'
+        # Only the comments are kept while paging, activities also carry whole diffs and commits
+        activities = [{'action': value.get('action'), 'comment': value.get('comment')}
+                      async for value in self._get_paged_api(endpoint)]
+        for attachment in ServerUtils.strip_attachments_from_pull_request(pr.description, activities):
+            yield attachment
+
+    async def download_repo_attachment(self, project: Project, repo: Repository, attachment_id: int,
+                                       filename: str, pr_id: int) -> Path:
+        endpoint = f'/rest/api/latest/projects/{project.key}/repos/{repo.slug}/attachments/{attachment_id}'
+        log.debug('Attempting to download "%s" from server at URI "%s"', filename, endpoint)
+        attachment = await self.download(endpoint, filename, pr_id)
+        return attachment
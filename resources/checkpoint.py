@@ -0,0 +1,154 @@
+import sqlite3
+from dataclasses import dataclass
+from enum import IntEnum
+from threading import Lock
+from time import monotonic, time
+
+from resources.logger import log
+
+
+class Stage(IntEnum):
+    DISCOVERED = 1
+    DOWNLOADED = 2
+    UPLOADED = 3
+    COMMENTED = 4
+
+
+@dataclass
+class Checkpoint:
+    '''
+    Last recorded state of one attachment reference.
+    key = (server project key, server repo slug, pr id, attachment id)
+    '''
+    key: tuple
+    repo_id: int
+    stage: Stage
+    local_path: str = None
+    cloud_filename: str = None
+    digest: str = None
+
+
+class CheckpointStore:
+    '''
+    SQLite backed record of how far every attachment got, so a rerun can skip finished
+    work and pick unfinished attachments up at the stage they stopped at.
+
+    All rows are loaded into memory on open so lookups are a dict hit. Writes are
+    queued and committed in batches, either every batch_size changes or once
+    flush_interval seconds have passed, whichever comes first. Safe to share between
+    worker threads, and between sharded worker processes as each one only writes the rows
+    of its own repos.
+    '''
+
+    def __init__(self, path: str, batch_size: int=500, flush_interval: float=2.0) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._lock = Lock()
+        self._pending: dict[tuple, Checkpoint] = {}
+        self._last_flush = monotonic()
+        # Other processes may hold the write lock for a moment when running sharded
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS attachments (
+                project_key TEXT NOT NULL,
+                repo_slug TEXT NOT NULL,
+                pr_id INTEGER NOT NULL,
+                attachment_id INTEGER NOT NULL,
+                repo_id INTEGER,
+                stage INTEGER NOT NULL,
+                local_path TEXT,
+                cloud_filename TEXT,
+                digest TEXT,
+                PRIMARY KEY (project_key, repo_slug, pr_id, attachment_id)
+            )''')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS watermarks (
+                project_key TEXT NOT NULL,
+                repo_slug TEXT NOT NULL,
+                updated_date INTEGER NOT NULL,
+                PRIMARY KEY (project_key, repo_slug)
+            )''')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS shards (
+                shard_index INTEGER NOT NULL,
+                shard_count INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                repos_done INTEGER NOT NULL,
+                attachments_done INTEGER NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (shard_index, shard_count)
+            )''')
+        self._connection.commit()
+        self._watermarks: dict[tuple, int] = {tuple(row[:2]): row[2] for row in
+                                              self._connection.execute('SELECT * FROM watermarks')}
+        self._checkpoints: dict[tuple, Checkpoint] = {}
+        for row in self._connection.execute('SELECT * FROM attachments'):
+            checkpoint = Checkpoint(tuple(row[:4]), row[4], Stage(row[5]), *row[6:])
+            self._checkpoints[checkpoint.key] = checkpoint
+        log.info(f'Loaded {len(self._checkpoints)} attachment checkpoints from "{path}"')
+
+    def get(self, key: tuple) -> Checkpoint:
+        return self._checkpoints.get(key)
+
+    def __iter__(self):
+        return iter(list(self._checkpoints.values()))
+
+    def mark(self, key: tuple, repo_id: int, stage: Stage, local_path: str=None,
+             cloud_filename: str=None, digest: str=None) -> None:
+        checkpoint = Checkpoint(key, repo_id, stage, local_path, cloud_filename, digest)
+        with self._lock:
+            self._checkpoints[key] = checkpoint
+            self._pending[key] = checkpoint
+            due = (len(self._pending) >= self.batch_size
+                   or monotonic() - self._last_flush >= self.flush_interval)
+            if due:
+                self._flush_locked()
+
+    def get_watermark(self, repo_key: tuple) -> int:
+        '''
+        repo_key = (server project key, server repo slug)
+        returns the updatedDate (epoch milliseconds) up to which every PR of the repo has been migrated, or None
+        '''
+        return self._watermarks.get(repo_key)
+
+    def set_watermark(self, repo_key: tuple, updated_date: int) -> None:
+        '''
+        Written straight away along with any queued checkpoints, this happens once per repo at most
+        '''
+        with self._lock:
+            self._flush_locked()
+            self._watermarks[repo_key] = updated_date
+            with self._connection:
+                self._connection.execute('INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?)', (*repo_key, updated_date))
+
+    def report_shard(self, shard_index: int, shard_count: int, status: str,
+                     repos_done: int, attachments_done: int) -> None:
+        '''
+        Publishes a sharded worker's progress, see resources.sharding
+        '''
+        with self._lock:
+            with self._connection:
+                self._connection.execute('INSERT OR REPLACE INTO shards VALUES (?, ?, ?, ?, ?, ?)',
+                                         (shard_index, shard_count, status, repos_done, attachments_done, time()))
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush_locked()
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_locked()
+            self._connection.close()
+
+    def _flush_locked(self) -> None:
+        self._last_flush = monotonic()
+        if not self._pending:
+            return
+        rows = [(*checkpoint.key, checkpoint.repo_id, int(checkpoint.stage), checkpoint.local_path,
+                 checkpoint.cloud_filename, checkpoint.digest) for checkpoint in self._pending.values()]
+        with self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO attachments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        log.debug(f'Committed {len(rows)} attachment checkpoints')
+        self._pending.clear()
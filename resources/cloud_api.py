@@ -1,27 +1,44 @@
+from contextlib import ExitStack
 from pathlib import Path
+from uuid import uuid4
 from resources.api import Base_API
-from resources.logger import log
-from typing import Generator, Iterable, Tuple
+from resources.rate_limit import RateLimiter
+from resources.transport import Transport
+from resources.logger import lazy, log
+from typing import Callable, Generator, Iterable, Iterator, Tuple
 from resources.cloud_objects import Workspace, User, Group, Repository, Project
 from requests import Session
 
+from resources.streaming import MultipartStream
+
+# Hidden markdown line tagging the comments that link migrated attachments
+ATTACHMENTS_COMMENT_MARKER = '[//]: # (migrated-pr-attachments)'
+
 
 class CloudSessionHandler(Base_API):
-    def __init__(self, session: Session, workspace: str):
+    def __init__(self, session: Session, workspace: str, rate_limiter: RateLimiter=None,
+                 transport: Transport=None, base_url: str='https://api.bitbucket.org'):
         self.session = session
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.transport = transport or Transport()
         self.workspace = workspace
-        self.base_url = 'https://api.bitbucket.org'
+        self.base_url = base_url.rstrip('/')
         self.ssl_verify = True
         self.pagination_marker = 'next'
         self.pagination_page = 'page'
         self.pagination_per_page = 'pagelen'
+        self.max_page_size = 100
+        self.supports_fields = True
 
 
 class Cloud(CloudSessionHandler):
     # Rest 2.0 https://developer.atlassian.com/cloud/bitbucket/rest/intro/
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        if self.workspace is not None:
+        if isinstance(self.workspace, Workspace):
+            # Already looked up, ex: by the preflight
+            pass
+        elif self.workspace is not None:
             self.workspace = self.get_workspace(self.workspace)
         else:
             self.workspace = self.choose_workspace()
@@ -57,7 +74,9 @@ class Cloud(CloudSessionHandler):
         endpoint = '/2.0/workspaces'
         params = {'q': filters}
 
-        for value in self._get_paged_api(endpoint, params=params):
+        fields = ('uuid', 'slug', 'name')
+
+        for value in self._get_paged_api(endpoint, params=params, fields=fields):
             workspace = Workspace(value.get('uuid'),
                                   value.get('slug'),
                                   value.get('name'))
@@ -77,6 +96,23 @@ class Cloud(CloudSessionHandler):
                               json.get('name'))
         return workspace
 
+    def check_access(self, workspace: Workspace) -> str:
+        '''
+        GET /2.0/user/permissions/workspaces
+
+        returns the user's permission on workspace ("owner", "collaborator" or "member"),
+        fails fast if the user has none
+        '''
+        endpoint = '/2.0/user/permissions/workspaces'
+        params = {'q': f'workspace.uuid="{workspace.uuid}"'}
+        permissions = [value.get('permission') for value in
+                       self._get_paged_api(endpoint, params=params, fields=('permission',))]
+        if not permissions:
+            log.critical(f'This user has no permission on cloud workspace "{workspace.slug}", '
+                         'please check "cloud_workspace" and your permissions. Closing...')
+            exit()
+        return permissions[0]
+
     def create_workspace(self, workspace_name: str):
         '''
         
@@ -90,8 +126,10 @@ class Cloud(CloudSessionHandler):
         https://developer.atlassian.com/cloud/bitbucket/rest/api-group-workspaces/#api-workspaces-workspace-permissions-repositories-get
         '''
         endpoint = f'/2.0/workspaces/{workspace.slug}/permissions/repositories'
+        fields = ('user.display_name', 'user.uuid', 'permission',
+                  'repository.name', 'repository.full_name', 'repository.uuid')
         
-        for value in self._get_paged_api(endpoint):
+        for value in self._get_paged_api(endpoint, fields=fields):
             user = User(value.get('user').get('display_name'),
                         value.get('user').get('uuid'))
             permission = value.get('permission')
@@ -105,8 +143,9 @@ class Cloud(CloudSessionHandler):
         GET /2.0/repositories/{workspace}
         '''
         endpoint = f'/2.0/repositories/{workspace.slug}'
+        fields = ('name', 'full_name', 'uuid', 'is_private', 'project.name', 'project.key')
         
-        for value in self._get_paged_api(endpoint):
+        for value in self._get_paged_api(endpoint, fields=fields):
             repository = Repository(value.get('name'),
                                     value.get('full_name'),
                                     value.get('uuid'),
@@ -122,7 +161,8 @@ class Cloud(CloudSessionHandler):
         GET /2.0/workspaces/{workspace}/projects
         '''
         endpoint = f'/2.0/workspaces/{workspace.slug}/projects'
-        for value in self._get_paged_api(endpoint):
+        fields = ('uuid', 'is_private', 'key', 'name', 'has_publicly_visible_repos')
+        for value in self._get_paged_api(endpoint, fields=fields):
             project = Project(value.get('uuid'),
                               value.get('is_private'),
                               value.get('key'),
@@ -138,7 +178,7 @@ class Cloud(CloudSessionHandler):
         https://developer.atlassian.com/cloud/bitbucket/rest/api-group-repositories/#api-repositories-workspace-repo-slug-get
         '''
         endpoint = f'/2.0/repositories/{workspace.slug}/{repo.slug}'
-        r_json = self._get_api(endpoint)
+        r_json = self._get_api(endpoint, fields=('uuid',))
         if r_json.get('error'):
             return False
         return True
@@ -150,11 +190,25 @@ class Cloud(CloudSessionHandler):
         https://developer.atlassian.com/cloud/bitbucket/rest/api-group-pullrequests/#api-repositories-workspace-repo-slug-pullrequests-pull-request-id-get
         '''
         endpoint = f'/2.0/repositories/{workspace.slug}/{repo.slug}/pullrequests/{pr_id}'
-        r_json = self._get_api(endpoint)
+        r_json = self._get_api(endpoint, fields=('id',))
         if r_json.get('error'):
             return False
         return True
 
+    def get_pull_request_ids(self, workspace: Workspace, repo: Repository,
+                             states: Iterable[str]=('OPEN', 'MERGED', 'DECLINED', 'SUPERSEDED')) -> Generator[int, None, None]:
+        '''
+        GET /2.0/repositories/{workspace}/{repo_slug}/pullrequests
+
+        https://developer.atlassian.com/cloud/bitbucket/rest/api-group-pullrequests/#api-repositories-workspace-repo-slug-pullrequests-get
+        '''
+        endpoint = f'/2.0/repositories/{workspace.slug}/{repo.slug}/pullrequests'
+        # The state param may be repeated
+        params = {'state': list(states)}
+        # 50 is the largest page this endpoint serves
+        for value in self._get_paged_api(endpoint, params=params, fields=('id',), page_size=50):
+            yield value.get('id')
+
     def add_pr_comment(self, workspace: Workspace, repo: Repository, pr_id: int, attachment=Path) -> bool:
         '''
         returns True if successful, else False
@@ -164,19 +218,74 @@ class Cloud(CloudSessionHandler):
         '''
         headers = {'Content-type': 'application/json'}
         endpoint = f'/2.0/repositories/{workspace.slug}/{repo.slug}/pullrequests/{pr_id}/comments'
-        file_url = f'https://bitbucket.org/{workspace.slug}/{repo.slug}/downloads/{attachment}'
-        message = f'[{attachment}]({file_url})'
+        message = f'[{attachment}]({self.download_url(workspace, repo, attachment)})'
+        payload = {'content': {'raw': message}}
+        r = self._post_api(endpoint, json=payload, headers=headers)
+        r_json: dict = r.json()
+        if r.status_code != 201 or r_json.get('error'):
+            log.debug('Failed to create comment on pr "%s" in repo "%s" with message:\n%s\nStatus_code: %s\nText: %s',
+                      pr_id, repo.slug, message, r.status_code, lazy(lambda: r.text))
+            return False
+        log.debug('Successfully added comment on pr "%s" in repo "%s" for "%s"', pr_id, repo.slug, attachment)
+        return True
+
+    def get_pr_comments(self, workspace: Workspace, repo: Repository, pr_id: int) -> Generator[str, None, None]:
+        '''
+        Yields the raw markdown of every comment on the PR that hasn't been deleted
+        GET /2.0/repositories/{workspace}/{repo_slug}/pullrequests/{pull_request_id}/comments
+
+        https://developer.atlassian.com/cloud/bitbucket/rest/api-group-pullrequests/#api-repositories-workspace-repo-slug-pullrequests-pull-request-id-comments-get
+        '''
+        endpoint = f'/2.0/repositories/{workspace.slug}/{repo.slug}/pullrequests/{pr_id}/comments'
+        for value in self._get_paged_api(endpoint, fields=('deleted', 'content.raw')):
+            if not value.get('deleted'):
+                yield value.get('content', {}).get('raw') or ''
+
+    def add_pr_attachments_comment(self, workspace: Workspace, repo: Repository, pr_id: int,
+                                   attachments: Iterable[str]) -> bool:
+        '''
+        Posts one comment linking every attachment, ex:
+        [//]: # (migrated-pr-attachments)
+        Attachments migrated from Bitbucket Server:
+        - [image.png](https://bitbucket.org/{workspace}/{repo}/downloads/image.png)
+
+        Comments already carrying ATTACHMENTS_COMMENT_MARKER are checked first, attachments they
+        link to are left out and nothing is posted if none are left, so reruns don't repeat links.
+        returns True if every attachment is linked from the PR, else False
+        POST /2.0/repositories/{workspace}/{repo_slug}/pullrequests/{pull_request_id}/comments
+
+        https://developer.atlassian.com/cloud/bitbucket/rest/api-group-pullrequests/#api-repositories-workspace-repo-slug-pullrequests-pull-request-id-comments-post
+        '''
+        marked = [text for text in self.get_pr_comments(workspace, repo, pr_id) if ATTACHMENTS_COMMENT_MARKER in text]
+        attachments = [attachment for attachment in dict.fromkeys(attachments)
+                       if not any(f'/downloads/{attachment})' in text for text in marked)]
+        if not attachments:
+            log.debug('Attachments on pr "%s" in repo "%s" are already linked from a comment', pr_id, repo.slug)
+            return True
+
+        headers = {'Content-type': 'application/json'}
+        endpoint = f'/2.0/repositories/{workspace.slug}/{repo.slug}/pullrequests/{pr_id}/comments'
+        links = [f'- [{attachment}]({self.download_url(workspace, repo, attachment)})' for attachment in attachments]
+        message = '\n'.join([ATTACHMENTS_COMMENT_MARKER, 'Attachments migrated from Bitbucket Server:', *links])
         payload = {'content': {'raw': message}}
         r = self._post_api(endpoint, json=payload, headers=headers)
         r_json: dict = r.json()
         if r.status_code != 201 or r_json.get('error'):
-            log.debug(f'Failed to create comment on pr "{pr_id}" in repo "{repo.slug}" with message:\n{message}\nStatus_code: {r.status_code}\nText: {r.text}')
+            log.debug('Failed to create comment on pr "%s" in repo "%s" with message:\n%s\nStatus_code: %s\nText: %s',
+                      pr_id, repo.slug, message, r.status_code, lazy(lambda: r.text))
             return False
-        log.debug(f'Successfully added comment on pr "{pr_id}" in repo "repo.slug" for "{attachment}"')
+        log.debug('Successfully added comment on pr "%s" in repo "%s" for %s attachments', pr_id, repo.slug, len(attachments))
         return True
 
-    def upload_attachment_to_downloads(self, workspace: Workspace, repo: Repository, attachment: Path) -> bool:
+    @staticmethod
+    def download_url(workspace: Workspace, repo: Repository, filename: str) -> str:
+        return f'https://bitbucket.org/{workspace.slug}/{repo.slug}/downloads/{filename}'
+
+    def upload_attachment_to_downloads(self, workspace: Workspace, repo: Repository, attachment: Path,
+                                       filename: str=None) -> bool:
         '''
+        filename = name to store the file under, defaults to the local file's name
+
         POST /2.0/repositories/{workspace}/{repo_slug}/downloads
 
         https://developer.atlassian.com/cloud/bitbucket/rest/api-group-downloads/?utm_source=%2Fbitbucket%2Fapi%2F2%2Freference%2Fresource%2Frepositories%2F%257Bworkspace%257D%2F%257Brepo_slug%257D%2Fdownloads&utm_medium=302#post
@@ -185,10 +294,91 @@ class Cloud(CloudSessionHandler):
         #headers = {'Content-type': 'multipart/form-data', 'Accept': 'appliction/json'}
         headers = {}
         with open(attachment, 'rb') as byte_file:
-            files = {'files': byte_file}
+            def files() -> dict:
+                # Rewind so a retried request sends the whole file again
+                byte_file.seek(0)
+                return {'files': (filename or Path(attachment).name, byte_file)}
             r = self._post_api(endpoint, headers=headers, files=files)
         if r.status_code == 201:
-            log.debug(f'Successfully uploaded "{attachment}" to repo "{repo.name}"')
+            log.debug('Successfully uploaded "%s" to repo "%s"', attachment, repo.name)
+            return True
+        log.debug('Failed to upload "%s" for repo "%s" due to the following error:\n\t%s\n\t%s', attachment, repo.name,
+                  r.status_code, lazy(lambda: r.text))
+        return False
+
+    def upload_attachments_to_downloads(self, workspace: Workspace, repo: Repository,
+                                        attachments: Iterable[Tuple[Path, str]]) -> dict[str, bool]:
+        '''
+        Uploads several files in one multipart request, one "files" part each.
+        attachments = (local path, name to store the file under) pairs
+        returns {name: True if the file is in the repo's downloads, else False}
+
+        If the combined request fails each file is sent again on its own, so one bad file
+        doesn't fail the rest.
+
+        POST /2.0/repositories/{workspace}/{repo_slug}/downloads
+
+        https://developer.atlassian.com/cloud/bitbucket/rest/api-group-downloads/#api-repositories-workspace-repo-slug-downloads-post
+        '''
+        # A name can only be stored once, later duplicates would overwrite the first
+        paths = {filename: path for path, filename in attachments}
+        if len(paths) == 1:
+            (filename, path), = paths.items()
+            return {filename: self.upload_attachment_to_downloads(workspace, repo, path, filename)}
+
+        endpoint = f'/2.0/repositories/{workspace.slug}/{repo.slug}/downloads'
+        headers = {}
+        with ExitStack() as stack:
+            byte_files = [(filename, stack.enter_context(open(path, 'rb'))) for filename, path in paths.items()]
+            def files() -> list:
+                # Rewind so a retried request sends every file again
+                for _filename, byte_file in byte_files:
+                    byte_file.seek(0)
+                return [('files', (filename, byte_file)) for filename, byte_file in byte_files]
+            r = self._post_api(endpoint, headers=headers, files=files)
+        if r.status_code == 201:
+            log.debug('Successfully uploaded %s files to repo "%s"', len(paths), repo.name)
+            return {filename: True for filename in paths}
+        log.debug('Failed to upload %s files for repo "%s" in one request, uploading them one at a time. '
+                  'Error:\n\t%s\n\t%s', len(paths), repo.name, r.status_code, lazy(lambda: r.text))
+        return {filename: self.upload_attachment_to_downloads(workspace, repo, path, filename)
+                for filename, path in paths.items()}
+
+    def upload_stream_to_downloads(self, workspace: Workspace, repo: Repository, filename: str,
+                                   open_stream: Callable[[], Tuple[Iterator[bytes], int]]) -> bool:
+        '''
+        Uploads a file to downloads straight from a stream of byte chunks, nothing is written to disk.
+
+        open_stream is called for every attempt (a consumed stream can't be resent after a rate limit)
+        and must return (chunk iterator, length or None) or None if the source could not be opened.
+
+        POST /2.0/repositories/{workspace}/{repo_slug}/downloads
+        '''
+        endpoint = f'/2.0/repositories/{workspace.slug}/{repo.slug}/downloads'
+        # The boundary has to be fixed up front since it is part of the Content-Type header
+        boundary = uuid4().hex
+        headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+        opened = [open_stream()]
+        if opened[0] is None:
+            log.debug(f'Unable to stream "{filename}" to repo "{repo.name}" as the source could not be opened')
+            return False
+
+        def body() -> MultipartStream:
+            # First attempt uses the stream opened above, retries reopen the source
+            source = opened.pop() if opened else open_stream()
+            if source is None:
+                raise IOError(f'Source of "{filename}" could not be reopened for retry')
+            chunks, length = source
+            return MultipartStream('files', filename, chunks, length, boundary)
+
+        try:
+            r = self._post_api(endpoint, headers=headers, data=body)
+        except IOError as e:
+            log.debug(f'Failed to stream "{filename}" for repo "{repo.name}": {e}')
+            return False
+        if r.status_code == 201:
+            log.debug('Successfully streamed "%s" to repo "%s"', filename, repo.name)
             return True
-        log.debug(f'Failed to upload "{attachment}" for repo "{repo.name}" due to the following error:\n\t{r.status_code}\n\t{r.text}')
+        log.debug('Failed to stream "%s" for repo "%s" due to the following error:\n\t%s\n\t%s', filename, repo.name,
+                  r.status_code, lazy(lambda: r.text))
         return False
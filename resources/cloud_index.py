@@ -0,0 +1,51 @@
+from threading import Lock
+
+from resources.cloud_api import Cloud
+from resources.logger import log
+
+
+class CloudIndex:
+    '''
+    Answers Cloud.repo_exists/pr_exists from local sets instead of one GET per repo and per PR.
+
+    The workspace's repositories are listed once, on first use. Each repo's pull request ids are
+    listed once, in large pages, the first time a PR of that repo is checked. Safe to share
+    between worker threads.
+    '''
+
+    def __init__(self, cloud: Cloud) -> None:
+        self.cloud = cloud
+        self._repo_slugs: set[str] = None
+        self._pr_ids: dict[str, set[int]] = {}
+        self._lock = Lock()
+        self._repo_locks: dict[str, Lock] = {}
+
+    def repo_exists(self, repo) -> bool:
+        with self._lock:
+            if self._repo_slugs is None:
+                self._repo_slugs = {cloud_repo.slug for cloud_repo in
+                                    self.cloud.get_workspace_repositories(self.cloud.workspace)}
+                log.info(f'Indexed {len(self._repo_slugs)} repositories in cloud workspace "{self.cloud.workspace.slug}"')
+        return repo.slug in self._repo_slugs
+
+    def pr_exists(self, repo, pr_id: int) -> bool:
+        return pr_id in self._get_pr_ids(repo)
+
+    def forget(self, repo) -> None:
+        '''
+        Drops a repo's PR ids once it has been processed
+        '''
+        with self._lock:
+            self._pr_ids.pop(repo.slug, None)
+
+    def _get_pr_ids(self, repo) -> set[int]:
+        with self._lock:
+            repo_lock = self._repo_locks.setdefault(repo.slug, Lock())
+        with repo_lock:
+            pr_ids = self._pr_ids.get(repo.slug)
+            if pr_ids is None:
+                pr_ids = set(self.cloud.get_pull_request_ids(self.cloud.workspace, repo))
+                log.info(f'Indexed {len(pr_ids)} pull requests in cloud repo "{repo.slug}"')
+                with self._lock:
+                    self._pr_ids[repo.slug] = pr_ids
+            return pr_ids
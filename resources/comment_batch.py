@@ -0,0 +1,38 @@
+from threading import Lock
+
+from resources import server_objects as SO
+
+
+class CommentBatch:
+    '''
+    Gathers the attachments of one PR that made it to Cloud so they can all be linked from a
+    single comment instead of one comment each.
+
+    add() is called for every attachment extracted from the PR, then finish() once per attachment
+    when it was uploaded or has failed, and close() once extraction is over. Whichever of
+    finish()/close() completes the batch returns True, that happens exactly once, and the caller
+    then posts the comment. Safe to share between worker threads.
+    '''
+
+    def __init__(self, pr: SO.PullRequest) -> None:
+        self.pr = pr
+        self.uploaded: list[SO.Attachment] = []
+        self._pending = 0
+        self._closed = False
+        self._lock = Lock()
+
+    def add(self) -> None:
+        with self._lock:
+            self._pending += 1
+
+    def finish(self, attachment: SO.Attachment, uploaded: bool) -> bool:
+        with self._lock:
+            self._pending -= 1
+            if uploaded:
+                self.uploaded.append(attachment)
+            return self._closed and self._pending == 0
+
+    def close(self) -> bool:
+        with self._lock:
+            self._closed = True
+            return self._pending == 0
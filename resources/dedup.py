@@ -0,0 +1,118 @@
+from hashlib import sha256
+from pathlib import Path
+from threading import Condition
+from typing import Callable, Hashable, Iterable, Iterator
+
+# Marks a key that a worker has claimed but not yet resolved
+_IN_FLIGHT = object()
+
+
+class AttachmentDedup:
+    '''
+    Remembers which cloud download every attachment ended up as, so each unique blob is
+    transferred once per cloud repo and every later reference reuses the same download.
+
+    Two kinds of keys are used:
+    source_key = (server repo id, attachment id), known before downloading
+    content_key = (cloud repo slug, sha256 of the content), known once the bytes are seen
+
+    Safe to share between worker threads. The first worker to claim() a key owns it
+    and must resolve() it, any other worker claiming the same key waits for the result.
+    '''
+
+    def __init__(self) -> None:
+        self._uploads: dict[Hashable, object] = {}
+        self._waiting: dict[Hashable, int] = {}
+        self._changed = Condition()
+
+    @staticmethod
+    def source_key(repo_id: int, attachment_id: int) -> tuple:
+        return ('source', repo_id, attachment_id)
+
+    @staticmethod
+    def content_key(cloud_repo_slug: str, digest: str) -> tuple:
+        return ('content', cloud_repo_slug, digest)
+
+    def claim(self, key: Hashable, on_wait: Callable[[], None]=None) -> str:
+        '''
+        returns the cloud filename if key was already uploaded, otherwise None
+        and the caller is now responsible for resolving key
+
+        on_wait = called (without blocking other callers) before waiting on another worker's
+        claim of key, ex: to send an upload batch the claimed attachment is held back in
+        '''
+        with self._changed:
+            if self._uploads.get(key) is _IN_FLIGHT:
+                self._waiting[key] = self._waiting.get(key, 0) + 1
+                try:
+                    if on_wait is not None:
+                        self._changed.release()
+                        try:
+                            on_wait()
+                        finally:
+                            self._changed.acquire()
+                    while self._uploads.get(key) is _IN_FLIGHT:
+                        self._changed.wait()
+                finally:
+                    self._waiting[key] -= 1
+                    if not self._waiting[key]:
+                        del self._waiting[key]
+            cloud_filename = self._uploads.get(key)
+            if cloud_filename is None:
+                self._uploads[key] = _IN_FLIGHT
+            return cloud_filename
+
+    def has_waiters(self, keys: Iterable[Hashable]) -> bool:
+        '''
+        returns True if any worker is waiting on one of keys to be resolved
+        '''
+        with self._changed:
+            return any(key in self._waiting for key in keys)
+
+    def resolve(self, key: Hashable, cloud_filename: str) -> None:
+        '''
+        Records the outcome of a claimed key. Pass None if the transfer failed so the
+        next claim gets a chance to retry it.
+        '''
+        with self._changed:
+            if cloud_filename is None:
+                self._uploads.pop(key, None)
+            else:
+                self._uploads[key] = cloud_filename
+            self._changed.notify_all()
+
+    def remember(self, key: Hashable, cloud_filename: str) -> None:
+        '''
+        Records an upload for a key that was never claimed (ex: a content hash only known after streaming)
+        '''
+        with self._changed:
+            if self._uploads.get(key) is None:
+                self._uploads[key] = cloud_filename
+                self._changed.notify_all()
+
+
+def file_digest(path: Path, chunk_size: int=1024 * 1024) -> str:
+    digest = sha256()
+    with open(path, 'rb') as byte_file:
+        while (chunk := byte_file.read(chunk_size)):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HashingIterator:
+    '''
+    Passes chunks through untouched while hashing them, hexdigest is complete once exhausted
+    '''
+
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        self._chunks = chunks
+        self._digest = sha256()
+
+    def __iter__(self) -> Iterator[bytes]:
+        for chunk in self._chunks:
+            self._digest.update(chunk)
+            yield chunk
+
+    @property
+    def hexdigest(self) -> str:
+        return self._digest.hexdigest()
@@ -0,0 +1,157 @@
+import hashlib
+import sqlite3
+from dataclasses import dataclass
+from threading import Lock
+from time import time
+
+from resources.logger import log
+
+
+@dataclass
+class CachedResponse:
+    '''
+    A cached GET response body and what's needed to revalidate it.
+    fresh = the body was stored as immutable under the version asked for, no need to revalidate it
+    '''
+    body: bytes
+    etag: str = None
+    last_modified: str = None
+    fresh: bool = False
+
+    def validators(self) -> dict:
+        '''
+        returns the headers that make a request conditional on this body being out of date
+        '''
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class HTTPCache:
+    '''
+    SQLite backed cache of GET response bodies kept between runs, see Base_API._get_json.
+
+    Responses carrying an ETag or Last-Modified are stored with them so a rerun can ask the host
+    whether they changed (a 304 costs no body), responses known to be immutable are stored with a
+    version and served without asking at all. Every body is stored with its sha256 digest, checked
+    on every read so a damaged entry is dropped rather than served, and compared on every store so
+    an unchanged body is never rewritten. Once the bodies add up to more than max_bytes the least
+    recently used are evicted. Safe to share between worker threads and sharded worker processes.
+    '''
+
+    def __init__(self, path: str, max_bytes: int=256 * 1024 * 1024) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._lock = Lock()
+        # Other processes may hold the write lock for a moment when running sharded
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                version TEXT,
+                digest TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                body BLOB NOT NULL,
+                accessed_at REAL NOT NULL
+            )''')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)')
+        self._connection.commit()
+        self._size = self._stored_bytes()
+
+    def get(self, url: str, version: str=None) -> CachedResponse:
+        '''
+        returns the cached response for url, None if there is none (or it was damaged)
+        version = the version (ex: a merged PR's updated date) under which the response is
+        immutable, if it was stored under the same one it is fresh
+        '''
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT etag, last_modified, version, digest, body FROM responses WHERE url = ?', (url,)).fetchone()
+            if row is None:
+                return None
+            etag, last_modified, stored_version, digest, body = row
+            if hashlib.sha256(body).hexdigest() != digest:
+                log.warning(f'Dropping damaged cache entry for "{url}"')
+                self._delete(url)
+                self._connection.commit()
+                return None
+            fresh = version is not None and stored_version == version
+            if fresh:
+                self.hits += 1
+                self._connection.execute('UPDATE responses SET accessed_at = ? WHERE url = ?', (time(), url))
+                self._connection.commit()
+        return CachedResponse(body, etag, last_modified, fresh)
+
+    def put(self, url: str, body: bytes, etag: str=None, last_modified: str=None, version: str=None) -> None:
+        '''
+        Stores body as the response for url, fetched from the host. Bodies that can neither be
+        revalidated (no etag or last_modified) nor are immutable (no version) are of no use later
+        and aren't stored.
+        '''
+        with self._lock:
+            self.misses += 1
+        if not (etag or last_modified or version):
+            return
+        if len(body) > self.max_bytes:
+            return
+        digest = hashlib.sha256(body).hexdigest()
+        with self._lock:
+            row = self._connection.execute('SELECT digest, size FROM responses WHERE url = ?', (url,)).fetchone()
+            if row is not None and row[0] == digest:
+                # Same body, only the validators may have changed
+                self._connection.execute(
+                    'UPDATE responses SET etag = ?, last_modified = ?, version = ?, accessed_at = ? WHERE url = ?',
+                    (etag, last_modified, version, time(), url))
+            else:
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (url, etag, last_modified, version, digest, len(body), body, time()))
+                self._size += len(body) - (row[1] if row is not None else 0)
+                if self._size > self.max_bytes:
+                    self._evict()
+            self._connection.commit()
+
+    def touch(self, url: str) -> None:
+        '''
+        Records that the host confirmed (304) the cached response for url is still current
+        '''
+        with self._lock:
+            self.revalidated += 1
+            self._connection.execute('UPDATE responses SET accessed_at = ? WHERE url = ?', (time(), url))
+            self._connection.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+        log.info(f'HTTP cache: {self.hits} responses served without a request, {self.revalidated} revalidated, '
+                 f'{self.misses} fetched')
+
+    def _evict(self) -> None:
+        # Other processes sharing the file may have added to it too
+        self._size = self._stored_bytes()
+        # Evict down to 90% of the budget so every store near the limit doesn't trigger an eviction
+        target = self.max_bytes * 0.9
+        evicted = 0
+        cursor = self._connection.execute('SELECT url, size FROM responses ORDER BY accessed_at')
+        for url, size in cursor.fetchall():
+            if self._size <= target:
+                break
+            self._delete(url)
+            self._size -= size
+            evicted += 1
+        log.debug(f'Evicted {evicted} least recently used responses from the HTTP cache')
+
+    def _delete(self, url: str) -> None:
+        self._connection.execute('DELETE FROM responses WHERE url = ?', (url,))
+
+    def _stored_bytes(self) -> int:
+        return self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
@@ -0,0 +1,77 @@
+from datetime import datetime
+from threading import Lock
+
+from resources.checkpoint import CheckpointStore
+from resources.server_objects import PullRequest
+from resources.logger import log
+
+
+def to_epoch_ms(date: datetime) -> int:
+    return int(date.timestamp() * 1000)
+
+
+class SyncTracker:
+    '''
+    Keeps each repo's high-water mark: the updatedDate up to which every PR has been migrated.
+
+    During a run it notes, per repo, the most recent PR update seen and the least recent update
+    of any PR that had a failure. When the run ends, the mark of every repo whose PR listing was
+    read to the end moves up to the newest PR seen, but never past a PR that failed, so the
+    next incremental run only looks at PRs that changed or still need work.
+    '''
+
+    def __init__(self, checkpoints: CheckpointStore) -> None:
+        self.checkpoints = checkpoints
+        self._newest_seen: dict[tuple, int] = {}
+        self._oldest_failed: dict[tuple, int] = {}
+        self._completed: set[tuple] = set()
+        self._lock = Lock()
+
+    def watermark(self, repo_key: tuple) -> int:
+        return self.checkpoints.get_watermark(repo_key)
+
+    def is_unchanged(self, repo_key: tuple, pr: PullRequest) -> bool:
+        watermark = self.watermark(repo_key)
+        if watermark is None or pr.updated_date is None:
+            return False
+        return to_epoch_ms(pr.updated_date) <= watermark
+
+    def seen(self, repo_key: tuple, pr: PullRequest) -> None:
+        if pr.updated_date is None:
+            return
+        updated = to_epoch_ms(pr.updated_date)
+        with self._lock:
+            self._newest_seen[repo_key] = max(updated, self._newest_seen.get(repo_key, updated))
+
+    def failed(self, repo_key: tuple, pr: PullRequest) -> None:
+        if pr.updated_date is None:
+            # Without a date the repo's mark can't safely move at all
+            updated = 0
+        else:
+            updated = to_epoch_ms(pr.updated_date)
+        with self._lock:
+            self._oldest_failed[repo_key] = min(updated, self._oldest_failed.get(repo_key, updated))
+
+    def completed(self, repo_key: tuple) -> None:
+        '''
+        Call once every PR of the repo newer than its mark has been listed
+        '''
+        with self._lock:
+            self._completed.add(repo_key)
+
+    def commit(self) -> None:
+        '''
+        Moves the marks forward, call only once all work of the run has finished
+        '''
+        with self._lock:
+            for repo_key in self._completed:
+                newest = self._newest_seen.get(repo_key)
+                if newest is None:
+                    continue
+                if repo_key in self._oldest_failed:
+                    newest = min(newest, self._oldest_failed[repo_key] - 1)
+                current = self.watermark(repo_key)
+                if current is not None and newest <= current:
+                    continue
+                self.checkpoints.set_watermark(repo_key, newest)
+                log.info(f'Repo "{repo_key[1]}" is now synced up to {datetime.fromtimestamp(newest / 1000)}')
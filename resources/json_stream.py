@@ -0,0 +1,120 @@
+from codecs import getincrementaldecoder
+from json import JSONDecoder, JSONDecodeError
+from typing import Any, Iterable, Iterator
+
+_WHITESPACE = ' \t\n\r'
+# What may follow a complete number or literal
+_DELIMITERS = _WHITESPACE + ',]}'
+
+
+class JSONPageStream:
+    '''
+    Parses one paged API response, ex: {"isLastPage": false, "values": [...], "nextPageStart": 25},
+    straight from the response body as it arrives.
+
+    Iterating yields the items of the array_key list one at a time, so only the item being
+    parsed is held in memory rather than the whole page. Every other top-level key ends up in
+    "fields" as it is passed, all of them are there once iteration has finished.
+
+    Example:
+    page = JSONPageStream(response.iter_content(65536))
+    for value in page:
+        ...
+    page.fields.get('isLastPage')
+    '''
+
+    # Drop consumed text from the buffer once this much has piled up
+    _compact_at = 1 << 16
+
+    def __init__(self, chunks: Iterable[bytes], array_key: str='values') -> None:
+        self.array_key = array_key
+        self.fields: dict[str, Any] = {}
+        self._chunks = iter(chunks)
+        self._text_decoder = getincrementaldecoder('utf-8')()
+        self._json_decoder = JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def __iter__(self) -> Iterator[Any]:
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            if not isinstance(key, str):
+                raise ValueError(f'Expected an object key but found {key!r}')
+            self._expect(':')
+            if key == self.array_key and self._peek() == '[':
+                self._pos += 1
+                yield from self._array_items()
+            else:
+                self.fields[key] = self._value()
+            if self._expect(',', '}') == '}':
+                return
+
+    def _array_items(self) -> Iterator[Any]:
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._expect(',', ']') == ']':
+                return
+
+    def _value(self) -> Any:
+        '''
+        Decodes the next complete JSON value, reading more of the body until it is complete
+        '''
+        self._peek()
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buffer, self._pos)
+                # A number may still continue in the next chunk, ex: "10." decodes as 10. Only a
+                # string, object or array ends itself, anything else needs a delimiter after it
+                if self._eof or (end < len(self._buffer) and (
+                        self._buffer[end - 1] in '"]}' or self._buffer[end] in _DELIMITERS)):
+                    self._pos = end
+                    self._compact()
+                    return value
+            except JSONDecodeError:
+                if self._eof:
+                    raise
+            # At least double the unparsed text so a large value isn't re-parsed once per chunk
+            self._read(max(len(self._buffer) - self._pos, 1))
+
+    def _peek(self) -> str:
+        '''
+        returns the next non-whitespace character without consuming it
+        '''
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if self._eof:
+                raise ValueError('Response body ended before the JSON document was complete')
+            self._read(1)
+
+    def _expect(self, *characters: str) -> str:
+        character = self._peek()
+        if character not in characters:
+            raise ValueError(f'Expected one of {characters} but found {character!r} at position {self._pos}')
+        self._pos += 1
+        return character
+
+    def _read(self, at_least: int) -> None:
+        target = len(self._buffer) + at_least
+        while len(self._buffer) < target and not self._eof:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._buffer += self._text_decoder.decode(b'', final=True)
+                self._eof = True
+            else:
+                self._buffer += self._text_decoder.decode(chunk)
+
+    def _compact(self) -> None:
+        if self._pos >= self._compact_at:
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
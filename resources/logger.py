@@ -1,9 +1,26 @@
+import atexit
+import json
 import logging
+import re
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from threading import Lock
+from time import monotonic
+from typing import Callable
+
+
+class _ConsoleFormatter(logging.Formatter):
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        # See RateLimitFilter
+        suppressed = getattr(record, 'suppressed', 0)
+        message = super().formatMessage(record)
+        return f'{message} ({suppressed} similar messages suppressed)' if suppressed else message
+
 
 log = logging.getLogger("helper")
 
 # Necessary for debug/info messages to be processed by their respective handlers
-log.setLevel(logging.DEBUG) 
+log.setLevel(logging.DEBUG)
 
 # Outputs logs at debug level to log file
 file_handler = logging.FileHandler('bitbucket-api.log')
@@ -12,7 +29,7 @@ file_handler.setFormatter(file_handler_format)
 file_handler.setLevel(logging.DEBUG)
 
 stream_handler = logging.StreamHandler()
-stream_handler_format = logging.Formatter('%(asctime)s | %(levelname)s | %(message)s')
+stream_handler_format = _ConsoleFormatter('%(asctime)s | %(levelname)s | %(message)s')
 stream_handler.setFormatter(stream_handler_format)
 stream_handler.setLevel(logging.INFO)
 
@@ -20,3 +37,156 @@ log.addHandler(file_handler)
 log.addHandler(stream_handler)
 
 log.debug('Starting runtime...')
+
+
+class lazy:
+    '''
+    Defers building an expensive log argument until the message is actually written.
+
+    Example:
+    log.warning('Upload failed with %s: %s', r.status_code, lazy(lambda: r.text))
+    '''
+    __slots__ = ('_build',)
+
+    def __init__(self, build: Callable[[], object]) -> None:
+        self._build = build
+
+    def __str__(self) -> str:
+        return str(self._build())
+
+    __repr__ = __str__
+
+
+class JSONFormatter(logging.Formatter):
+    '''
+    One JSON object per line: time, level, thread, message and the unformatted template (which
+    groups repeats of the same message), plus anything passed as extra={'fields': {...}}
+    '''
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'thread': record.threadName,
+                 'message': record.getMessage(), 'template': getattr(record, 'template', str(record.msg))}
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    '''
+    Lets through at most burst records with the same template (the message before its arguments
+    are filled in) and level every interval seconds. The first record let through after some were
+    dropped says how many. Errors and anything more severe are never dropped.
+    Only meant for the console, the log file keeps every record.
+    '''
+    # Past this many templates tracked, the windows that ended are forgotten
+    max_templates = 10000
+
+    def __init__(self, interval: float=10.0, burst: int=5) -> None:
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        # (level, template) -> [window start, records let through, records dropped]
+        self._windows: dict[tuple, list] = {}
+        self._lock = Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.ERROR:
+            return True
+        key = (record.levelno, self._template(record))
+        now = monotonic()
+        with self._lock:
+            if len(self._windows) > self.max_templates:
+                self._windows = {template: window for template, window in self._windows.items()
+                                 if now - window[0] < self.interval}
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                dropped = window[2] if window is not None else 0
+                self._windows[key] = [now, 1, 0]
+                # Written out by the console's formatter, the record itself is shared with the log file
+                record.suppressed = dropped
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+    @staticmethod
+    def _template(record: logging.LogRecord) -> str:
+        template = getattr(record, 'template', None)
+        if template is None:
+            template = str(record.msg)
+        if template == record.getMessage():
+            # Built with an f-string, quoted names and numbers are what tell repeats apart
+            template = re.sub(r'"[^"]*"|\d+', '#', template)
+        return template
+
+
+class _DeferredQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only the message is filled in here (arguments may not outlive the call, ex: a closed
+        # response), timestamps and formatting are left to the listener thread
+        if not hasattr(record, 'template'):
+            record.template = str(record.msg)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+_listener: QueueListener = None
+_rate_limit: RateLimitFilter = None
+
+
+def configure_logging(async_logging: bool=True, json_format: bool=False, file_level: str='DEBUG',
+                      rate_limit_interval: float=10.0, rate_limit_burst: int=5) -> None:
+    '''
+    async_logging = worker threads only queue their records, a background thread formats and writes them
+    json_format = write the log file as JSON lines, see JSONFormatter
+    file_level = least severe level written to the log file
+    rate_limit_interval/rate_limit_burst = see RateLimitFilter, None disables it
+    '''
+    global _listener, _rate_limit
+    stop_logging()
+    if json_format:
+        file_handler.setFormatter(JSONFormatter())
+    file_handler.setLevel(file_level)
+    # Records no handler would write are dropped before anything (ex: a lazy argument) is built
+    log.setLevel(min(file_handler.level, stream_handler.level))
+    if _rate_limit is not None:
+        stream_handler.removeFilter(_rate_limit)
+        _rate_limit = None
+    if rate_limit_interval:
+        _rate_limit = RateLimitFilter(rate_limit_interval, rate_limit_burst)
+        stream_handler.addFilter(_rate_limit)
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+    if async_logging:
+        queue = SimpleQueue()
+        _listener = QueueListener(queue, file_handler, stream_handler, respect_handler_level=True)
+        _listener.start()
+        log.addHandler(_DeferredQueueHandler(queue))
+    else:
+        log.addHandler(file_handler)
+        log.addHandler(stream_handler)
+
+
+def stop_logging() -> None:
+    '''
+    Writes out every queued record and stops the background thread of async logging
+    '''
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+        for handler in list(log.handlers):
+            if isinstance(handler, QueueHandler):
+                log.removeHandler(handler)
+        log.addHandler(file_handler)
+        log.addHandler(stream_handler)
+
+
+# Records still queued when the script exits (ex: through exit()) are written out first
+atexit.register(stop_logging)
@@ -0,0 +1,201 @@
+import json
+from dataclasses import dataclass
+from math import ceil
+from threading import Lock
+from typing import BinaryIO, Generator, Iterable, Iterator, TextIO
+
+from resources import server_objects as SO
+from resources.settings import Settings
+
+
+class ManifestWriter:
+    '''
+    Writes the work a migration involves as JSON lines, in the order it was found:
+
+    {"repo": 0, "project": {"key": "P", "name": "Project", "id": 1}, "slug": "r", "id": 5, "name": "Repo"}
+    {"pr": 7, "repo": 0, "updated": 1700000000000}
+    {"attachment": 12, "repo": 0, "pr": 7, "filename": "image.png", "comment": 3, "size": 2048}
+    ...
+    {"summary": {"repos": 1, "prs": 1, "attachments": 1, "bytes": 2048, ...}}
+
+    A repo line always comes before its PRs and a PR line before its attachments. Safe to
+    share between worker threads as long as each PR's lines come from one thread.
+    '''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.repos = 0
+        self.prs = 0
+        self.attachments = 0
+        self.bytes = 0
+        self.unknown_sizes = 0
+        self._repo_index: dict[tuple, int] = {}
+        self._lock = Lock()
+        self._file: TextIO = open(path, 'w')
+
+    def repo(self, server_repo: SO.Repository) -> None:
+        project = server_repo.project
+        with self._lock:
+            index = self._repo_index[(project.key, server_repo.slug)] = len(self._repo_index)
+            self.repos += 1
+            self._write({'repo': index, 'project': {'key': project.key, 'name': project.name, 'id': project.id},
+                         'slug': server_repo.slug, 'id': server_repo.id, 'name': server_repo.name})
+
+    def pull_request(self, server_pr: SO.PullRequest, attachments: list[tuple[int, str, int, int]]) -> None:
+        '''
+        attachments = [(attachment id, filename, source comment id or None, size in bytes or None), ...]
+        '''
+        repo = server_pr.repo
+        updated = int(server_pr.updated_date.timestamp() * 1000) if server_pr.updated_date else None
+        with self._lock:
+            index = self._repo_index[(repo.project.key, repo.slug)]
+            self.prs += 1
+            self._write({'pr': server_pr.id, 'repo': index, 'updated': updated})
+            for attachment_id, filename, comment_id, size in attachments:
+                self.attachments += 1
+                if size is None:
+                    self.unknown_sizes += 1
+                else:
+                    self.bytes += size
+                self._write({'attachment': attachment_id, 'repo': index, 'pr': server_pr.id,
+                             'filename': filename, 'comment': comment_id, 'size': size})
+
+    def close(self, **summary) -> dict:
+        '''
+        Adds the totals (plus anything passed in) as the last line, returns them
+        '''
+        summary = {'repos': self.repos, 'prs': self.prs, 'attachments': self.attachments,
+                   'bytes': self.bytes, 'unknown_sizes': self.unknown_sizes, **summary}
+        with self._lock:
+            self._write({'summary': summary})
+            self._file.close()
+        return summary
+
+    def _write(self, record: dict) -> None:
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+
+@dataclass
+class ManifestRepo:
+    '''
+    A repo of a manifest, its totals and the offset of its first line, see index_manifest
+    '''
+    offset: int
+    repo: SO.Repository
+    prs: int = 0
+    attachments: int = 0
+    size: int = 0
+
+
+def index_manifest(path: str) -> list[ManifestRepo]:
+    '''
+    returns every repo of the manifest in file order, with its totals, from one pass over it
+    '''
+    repos = []
+    offset = 0
+    with open(path, 'rb') as manifest:
+        for line in manifest:
+            record = json.loads(line)
+            if 'slug' in record:
+                repos.append(ManifestRepo(offset, _repository(record)))
+            elif 'attachment' in record:
+                repos[-1].attachments += 1
+                repos[-1].size += record.get('size') or 0
+            elif 'pr' in record:
+                repos[-1].prs += 1
+            offset += len(line)
+    return repos
+
+
+def read_manifest(path: str, offsets: Iterable[int]=None) -> Generator[tuple[SO.Repository, Iterator[tuple[SO.PullRequest, list]]], None, None]:
+    '''
+    Yields (repo, pull requests), pull requests being [(pr, [(attachment id, filename, source comment id), ...]), ...].
+    Only one repo is held in memory at a time.
+
+    offsets = where the repos to read start (see index_manifest), in the order to read them,
+    None reads every repo in manifest order
+    '''
+    with open(path, 'rb') as manifest:
+        if offsets is None:
+            yield from _read_repos(manifest)
+            return
+        for offset in offsets:
+            manifest.seek(offset)
+            yield from _read_repos(manifest, first_only=True)
+
+
+def _read_repos(manifest: BinaryIO, first_only: bool=False):
+    server_repo, pull_requests = None, []
+    for line in manifest:
+        record = json.loads(line)
+        if 'slug' in record:
+            if server_repo is not None:
+                yield server_repo, iter(pull_requests)
+                if first_only:
+                    return
+            server_repo = _repository(record)
+            pull_requests = []
+        elif 'attachment' in record:
+            pull_requests[-1][1].append((record['attachment'], record['filename'], record.get('comment')))
+        elif 'pr' in record:
+            server_pr = SO.PullRequest(record['pr'], None, None, None, None, record.get('updated'), server_repo)
+            pull_requests.append((server_pr, []))
+    if server_repo is not None:
+        yield server_repo, iter(pull_requests)
+
+
+def _repository(record: dict) -> SO.Repository:
+    project = SO.Project(record['project']['key'], record['project']['name'], record['project']['id'], None, None)
+    return SO.Repository(record['slug'], record['id'], record['name'], None, project)
+
+
+def read_summary(path: str) -> dict:
+    '''
+    returns the summary line of a finished manifest, None if planning never finished
+    '''
+    last = None
+    with open(path) as manifest:
+        for line in manifest:
+            last = line
+    record = json.loads(last) if last else {}
+    return record.get('summary')
+
+
+def estimate_seconds(settings: Settings, attachments: int, prs: int, size: int, latency: float,
+                     bandwidth: float) -> float:
+    '''
+    Rough duration of migrating attachments (size bytes in total) from prs pull requests.
+
+    latency = seconds per request, as seen while planning
+    bandwidth = bytes per second one transfer manages
+
+    Every request costs latency (spread over the workers in pipeline mode) unless the host's rate
+    limit is slower, and every byte is moved twice, server to here and here to cloud.
+    '''
+    server_requests = attachments
+    if settings.streaming_mode or settings.upload_batch_size <= 1:
+        upload_requests = attachments
+    else:
+        upload_requests = ceil(attachments / settings.upload_batch_size)
+    # Consolidated comments list the PR's comments before posting once
+    comment_requests = 2 * prs if settings.consolidate_comments else attachments
+    cloud_requests = upload_requests + comment_requests
+
+    if settings.pipeline_mode:
+        workers = settings.pipeline_workers
+        server_workers = workers['download']
+        cloud_workers = workers['upload'] + workers['comment']
+    else:
+        server_workers = cloud_workers = 1
+
+    def host_seconds(requests: int, workers: int, rate: float) -> float:
+        seconds = requests * latency / workers
+        return max(seconds, requests / rate) if rate else seconds
+
+    server_seconds = host_seconds(server_requests, server_workers, settings.server_rate_limit)
+    cloud_seconds = host_seconds(cloud_requests, cloud_workers, settings.cloud_rate_limit)
+    transfer_seconds = 2 * size / bandwidth
+    if settings.pipeline_mode:
+        # Stages overlap, the slowest one sets the pace
+        return max(server_seconds, cloud_seconds, transfer_seconds / server_workers)
+    return server_seconds + cloud_seconds + transfer_seconds
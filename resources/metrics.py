@@ -0,0 +1,229 @@
+import os
+import re
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Callable
+from urllib.parse import urlsplit
+
+from resources.logger import log
+
+# Logical endpoint of a request, the first (method, path pattern) that matches names it
+ENDPOINTS = (
+    ('status', None, r'/status'),
+    ('projects', None, r'/rest/api/[^/]+/projects'),
+    ('repos', None, r'/rest/api/[^/]+/projects/[^/]+/repos'),
+    ('pr_list', None, r'/rest/api/[^/]+/projects/[^/]+/repos/[^/]+/pull-requests'),
+    ('activities', None, r'/rest/api/[^/]+/projects/[^/]+/repos/[^/]+/pull-requests/\d+/activities'),
+    ('attachment_download', None, r'/rest/api/[^/]+/projects/[^/]+/repos/[^/]+/attachments/\d+'),
+    ('workspace', None, r'/2\.0/workspaces/[^/]+'),
+    ('cloud_repos', None, r'/2\.0/repositories/[^/]+'),
+    ('cloud_repo', None, r'/2\.0/repositories/[^/]+/[^/]+'),
+    ('cloud_pr_list', None, r'/2\.0/repositories/[^/]+/[^/]+/pullrequests'),
+    ('cloud_pr', None, r'/2\.0/repositories/[^/]+/[^/]+/pullrequests/\d+'),
+    ('downloads_upload', 'POST', r'/2\.0/repositories/[^/]+/[^/]+/downloads'),
+    ('comment', 'POST', r'/2\.0/repositories/[^/]+/[^/]+/pullrequests/\d+/comments'),
+    ('comment_list', 'GET', r'/2\.0/repositories/[^/]+/[^/]+/pullrequests/\d+/comments'),
+)
+_ENDPOINT_PATTERNS = [(name, method, re.compile(f'{pattern}/?')) for name, method, pattern in ENDPOINTS]
+
+# Seconds, upper bounds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def endpoint_name(method: str, url: str) -> str:
+    '''
+    Example:
+    in: "GET", "https://host/rest/api/latest/projects/P/repos/r/pull-requests/7/activities"
+    out: "activities"
+    '''
+    path = urlsplit(url).path
+    for name, endpoint_method, pattern in _ENDPOINT_PATTERNS:
+        if (endpoint_method is None or endpoint_method == method.upper()) and pattern.fullmatch(path):
+            return name
+    return 'other'
+
+
+class Metrics:
+    '''
+    Request and progress counters for one run, shared by every client and worker thread.
+
+    Base_API._request reports every request (by host and logical endpoint, see ENDPOINTS),
+    every retry and the time spent waiting on the rate limiter. render() returns it all in
+    the Prometheus text format, see MetricsExporter to publish it.
+    '''
+
+    def __init__(self) -> None:
+        self.started = monotonic()
+        self._lock = Lock()
+        # name -> (type, help)
+        self._meta: dict[str, tuple[str, str]] = {}
+        # name -> {labels: value}
+        self._values: dict[str, dict[tuple, float]] = {}
+        # name -> {labels: [bucket counts..., +Inf count, sum]}
+        self._histograms: dict[str, dict[tuple, list]] = {}
+        # name -> (label name, callback returning {label value: value})
+        self._gauges: dict[str, tuple[str, Callable[[], dict]]] = {}
+        self.attachments_done = 0
+
+    def observe_request(self, method: str, url: str, status: str, seconds: float,
+                        bytes_sent: int, bytes_received: int) -> None:
+        labels = (('host', urlsplit(url).netloc), ('endpoint', endpoint_name(method, url)))
+        with self._lock:
+            self._add('bitbucket_http_requests_total', 'counter', 'HTTP requests sent',
+                      labels + (('status', str(status)),), 1)
+            self._add('bitbucket_http_bytes_sent_total', 'counter', 'Request body bytes sent', labels, bytes_sent)
+            self._add('bitbucket_http_bytes_received_total', 'counter', 'Response body bytes received',
+                      labels, bytes_received)
+            self._observe('bitbucket_http_request_seconds', 'Time until the response headers arrived',
+                          labels, seconds)
+
+    def observe_retry(self, method: str, url: str, reason: str) -> None:
+        labels = (('host', urlsplit(url).netloc), ('endpoint', endpoint_name(method, url)), ('reason', reason))
+        with self._lock:
+            self._add('bitbucket_http_retries_total', 'counter', 'Requests sent again after a 429, 5xx or connection error',
+                      labels, 1)
+
+    def observe_rate_limit_wait(self, url: str, seconds: float) -> None:
+        with self._lock:
+            self._add('bitbucket_rate_limit_wait_seconds_total', 'counter', 'Time spent waiting on the rate limiter',
+                      (('host', urlsplit(url).netloc),), seconds)
+
+    def attachment_done(self) -> None:
+        with self._lock:
+            self.attachments_done += 1
+
+    def gauge(self, name: str, help: str, label: str, callback: Callable[[], dict]) -> None:
+        '''
+        Registers a gauge read at render time, callback returns {label value: value}
+        '''
+        with self._lock:
+            self._meta[name] = ('gauge', help)
+            self._gauges[name] = (label, callback)
+
+    def render(self) -> str:
+        elapsed = max(monotonic() - self.started, 1e-9)
+        lines = []
+        with self._lock:
+            gauges = dict(self._gauges)
+            lines += self._render_value('bitbucket_attachments_migrated_total', 'counter',
+                                        'Attachments linked from their cloud PR', {(): self.attachments_done})
+            lines += self._render_value('bitbucket_attachments_per_second', 'gauge',
+                                        'Attachments migrated per second since the run started',
+                                        {(): round(self.attachments_done / elapsed, 3)})
+            for name, values in self._values.items():
+                lines += self._render_value(name, *self._meta[name], values)
+            for name, histograms in self._histograms.items():
+                lines += self._render_histogram(name, self._meta[name][1], histograms)
+        for name, (label, callback) in gauges.items():
+            try:
+                values = {((label, str(key)),): value for key, value in callback().items()}
+            except Exception:
+                log.exception(f'Failed to read gauge "{name}"')
+                continue
+            lines += self._render_value(name, *self._meta[name], values)
+        return '\n'.join(lines) + '\n'
+
+    def _add(self, name: str, kind: str, help: str, labels: tuple, amount: float) -> None:
+        self._meta.setdefault(name, (kind, help))
+        values = self._values.setdefault(name, {})
+        values[labels] = values.get(labels, 0) + amount
+
+    def _observe(self, name: str, help: str, labels: tuple, seconds: float) -> None:
+        self._meta.setdefault(name, ('histogram', help))
+        histogram = self._histograms.setdefault(name, {}).setdefault(labels, [0] * (len(LATENCY_BUCKETS) + 2))
+        histogram[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+    @staticmethod
+    def _labels(labels: tuple) -> str:
+        if not labels:
+            return ''
+        escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels]
+        return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+    def _render_value(self, name: str, kind: str, help: str, values: dict) -> list[str]:
+        lines = [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+        lines += [f'{name}{self._labels(labels)} {value}' for labels, value in values.items()]
+        return lines
+
+    def _render_histogram(self, name: str, help: str, histograms: dict) -> list[str]:
+        lines = [f'# HELP {name} {help}', f'# TYPE {name} histogram']
+        for labels, counts in histograms.items():
+            cumulative = 0
+            for bound, count in zip((*LATENCY_BUCKETS, '+Inf'), counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{self._labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{self._labels(labels)} {counts[-1]}')
+            lines.append(f'{name}_count{self._labels(labels)} {cumulative}')
+        return lines
+
+
+class MetricsExporter:
+    '''
+    Publishes Metrics.render() for Prometheus, either or both of:
+    textfile = path rewritten every interval seconds, for the node_exporter textfile collector
+    port = serves /metrics on this local port
+    '''
+
+    def __init__(self, metrics: Metrics, textfile: str=None, port: int=None, interval: float=15.0) -> None:
+        self.metrics = metrics
+        self.textfile = textfile
+        self.port = port
+        self.interval = interval
+        self._stop = Event()
+        self._server: ThreadingHTTPServer = None
+        self._writer: Thread = None
+
+    def start(self) -> None:
+        if self.port is not None:
+            metrics = self.metrics
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self) -> None:
+                    if self.path.split('?')[0] != '/metrics':
+                        self.send_error(404)
+                        return
+                    body = metrics.render().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args) -> None:
+                    pass
+
+            self._server = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+            self._server.daemon_threads = True
+            Thread(target=self._server.serve_forever, name='metrics-http', daemon=True).start()
+            log.info(f'Serving metrics on http://127.0.0.1:{self.port}/metrics')
+        if self.textfile is not None:
+            self._writer = Thread(target=self._write_periodically, name='metrics-textfile', daemon=True)
+            self._writer.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._writer is not None:
+            self._writer.join()
+        if self.textfile is not None:
+            # Final numbers of the run
+            self.write_textfile()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def write_textfile(self) -> None:
+        # Written aside then renamed so the collector never reads a half written file
+        temporary = f'{self.textfile}.tmp'
+        with open(temporary, 'w') as textfile:
+            textfile.write(self.metrics.render())
+        os.replace(temporary, self.textfile)
+
+    def _write_periodically(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.write_textfile()
+            except OSError:
+                log.exception(f'Failed to write metrics to "{self.textfile}"')
@@ -0,0 +1,121 @@
+from dataclasses import dataclass, field
+from queue import Queue
+from threading import Thread
+from typing import Callable, Iterable, Any
+
+from resources.logger import log
+
+# Placed on a stage's queue once per worker to signal no more work is coming
+_STOP = object()
+
+
+@dataclass
+class Stage:
+    '''
+    name = label used in log messages and thread names
+    func = callable taking one item and returning an iterable of items for the next stage (or None)
+    workers = number of threads pulling from this stage's queue
+    queue_size = max items waiting on this stage before upstream producers block
+    drain = optional callable run once after the stage's last item, returning any items it held back
+    '''
+    name: str
+    func: Callable[[Any], Iterable[Any]]
+    workers: int = 1
+    queue_size: int = 50
+    drain: Callable[[], Iterable[Any]] = None
+    queue: Queue = field(init=False, repr=False)
+    threads: list = field(default_factory=lambda: [], init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self.workers = max(1, int(self.workers))
+        self.queue = Queue(maxsize=max(1, int(self.queue_size)))
+
+
+class Pipeline:
+    '''
+    Runs a chain of stages, each with its own worker pool, connected by bounded queues.
+
+    Every stage's output is handed to the next stage's queue. Because the queues are
+    bounded, a fast stage (ex: PR discovery) blocks once the slower stage after it
+    (ex: upload) has a full backlog instead of racing ahead and using up memory or disk.
+    '''
+
+    def __init__(self) -> None:
+        self.stages: list[Stage] = []
+        # First error a stage can't skip past (ex: the SystemExit of exit() on a 401), see run()
+        self.aborted: BaseException = None
+
+    def add_stage(self, name: str, func: Callable[[Any], Iterable[Any]],
+                  workers: int=1, queue_size: int=50,
+                  drain: Callable[[], Iterable[Any]]=None) -> 'Pipeline':
+        self.stages.append(Stage(name, func, workers, queue_size, drain))
+        return self
+
+    def run(self, source: Iterable[Any]) -> None:
+        '''
+        Feeds every item of source into the first stage and blocks until all stages have drained.
+        If a worker raises anything that isn't an Exception (ex: SystemExit), no more items are fed
+        in, the items still queued are dropped and it is raised again here once every worker stopped.
+        '''
+        if not self.stages:
+            return
+        self.aborted = None
+        for index, stage in enumerate(self.stages):
+            next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+            for num in range(stage.workers):
+                thread = Thread(target=self._worker, args=(stage, next_stage),
+                                name=f'{stage.name}-{num}', daemon=True)
+                stage.threads.append(thread)
+                thread.start()
+
+        first_stage = self.stages[0]
+        try:
+            for item in source:
+                if self.aborted is not None:
+                    break
+                first_stage.queue.put(item)
+        finally:
+            # Shut stages down in order so each one finishes its backlog before the next is told to stop
+            for index, stage in enumerate(self.stages):
+                for _ in range(stage.workers):
+                    stage.queue.put(_STOP)
+                for thread in stage.threads:
+                    thread.join()
+                if self.aborted is None:
+                    next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+                    self._drain(stage, next_stage)
+        if self.aborted is not None:
+            raise self.aborted
+
+    @staticmethod
+    def _drain(stage: Stage, next_stage: Stage) -> None:
+        if stage.drain is None:
+            return
+        try:
+            for result in stage.drain():
+                if next_stage is not None:
+                    next_stage.queue.put(result)
+        except Exception:
+            log.exception(f'Pipeline stage "{stage.name}" failed to drain')
+
+    def _worker(self, stage: Stage, next_stage: Stage) -> None:
+        while True:
+            item = stage.queue.get()
+            if item is _STOP:
+                return
+            if self.aborted is not None:
+                # Still taken off the queue so nothing upstream blocks on a full one
+                continue
+            try:
+                results = stage.func(item)
+                if results is None:
+                    continue
+                for result in results:
+                    if next_stage is not None:
+                        next_stage.queue.put(result)
+            except Exception:
+                log.exception(f'Pipeline stage "{stage.name}" failed to process {item}')
+            except BaseException as e:
+                log.error(f'Pipeline stage "{stage.name}" aborted the run while processing {item}: {e!r}')
+                if self.aborted is None:
+                    self.aborted = e
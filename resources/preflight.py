@@ -0,0 +1,87 @@
+import json
+import os
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from threading import Lock
+from time import time
+from typing import Any, Callable
+
+from resources.logger import log
+
+
+class ProbeCache:
+    '''
+    Results of the startup probes (ex: whether the server's certificate verifies, the cloud
+    workspace's uuid) kept in a small JSON file for ttl seconds, so the next run, or every
+    sharded worker started after the first, can skip them. Without a path nothing is kept.
+
+    Example file:
+    {"server_ssl|https://bitbucket.example.com": {"value": true, "at": 1700000000.0}}
+    '''
+
+    def __init__(self, path: str=None, ttl: float=3600.0) -> None:
+        self.path = path
+        self.ttl = ttl
+        self._lock = Lock()
+
+    def get(self, key: str) -> Any:
+        '''
+        returns the value stored under key, None if there is none or it is older than ttl
+        '''
+        entry = self._load().get(key)
+        if entry is None or time() - entry.get('at', 0) > self.ttl:
+            return None
+        return entry.get('value')
+
+    def set(self, key: str, value: Any) -> None:
+        if self.path is None:
+            return
+        with self._lock:
+            # Reloaded so probes stored meanwhile (by another thread or worker) are kept
+            entries = self._load()
+            entries[key] = {'value': value, 'at': time()}
+            # Written aside then renamed so a concurrent reader never sees a half written file
+            temporary = f'{self.path}.{os.getpid()}.tmp'
+            try:
+                with open(temporary, 'w') as cache_file:
+                    json.dump(entries, cache_file)
+                os.replace(temporary, self.path)
+            except OSError:
+                log.warning(f'Unable to save startup probe results to "{self.path}"')
+
+    def probe(self, key: str, probe: Callable[[], Any]) -> Any:
+        '''
+        returns the cached value of key, or runs probe and caches what it returns
+        '''
+        value = self.get(key)
+        if value is None:
+            value = probe()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def _load(self) -> dict:
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path) as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+
+def preflight(*steps: Callable[[], Any]) -> list:
+    '''
+    Runs every step at the same time, returns their results in order.
+    The first step to fail (or exit) ends the preflight straight away, its error is raised
+    without waiting for the other steps.
+    '''
+    executor = ThreadPoolExecutor(len(steps), thread_name_prefix='preflight')
+    futures = [executor.submit(step) for step in steps]
+    try:
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in futures:
+            if future in done and future.exception() is not None:
+                raise future.exception()
+        return [future.result() for future in futures]
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
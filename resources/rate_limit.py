@@ -0,0 +1,140 @@
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from threading import Lock
+from time import monotonic, sleep
+from typing import Mapping
+
+from requests import Response
+
+from resources.logger import log
+
+
+class RateLimiter:
+    '''
+    Token bucket pacing every request sent to one host, shared by all threads using that host.
+
+    rate = requests per second allowed when the host hasn't said otherwise, None for no limit
+    burst = how many requests may go out back to back before pacing kicks in
+
+    The bucket adapts to what the host reports:
+    - Bitbucket Server sends X-RateLimit-Limit, X-RateLimit-FillRate and X-RateLimit-Interval-Seconds
+      describing its own token bucket, which is mirrored here so we never outrun it.
+    - Bitbucket Cloud sends X-RateLimit-NearLimit when less than 20% of the hourly X-RateLimit-Limit
+      is left, at which point requests are paced down to the sustainable hourly rate.
+    - X-RateLimit-Remaining, if sent, caps the tokens we think are left.
+    - A 429 pauses every caller until Retry-After (or an escalating default) has passed.
+    '''
+
+    # Used on 429 responses that don't carry a Retry-After header
+    default_backoff = 10.0
+    max_backoff = 60.0
+
+    def __init__(self, rate: float=None, burst: int=10) -> None:
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._last_refill = monotonic()
+        self._blocked_until = 0.0
+        self._consecutive_throttles = 0
+        self._lock = Lock()
+
+    def acquire(self) -> None:
+        '''
+        Blocks until a request may be sent
+        '''
+        while (wait := self.reserve()) > 0:
+            sleep(wait)
+
+    def reserve(self) -> float:
+        '''
+        Takes a token and returns 0 if a request may be sent now, otherwise returns the seconds to
+        wait before asking again. For callers that can't block the thread (ex: asyncio), see acquire.
+        '''
+        with self._lock:
+            now = monotonic()
+            self._refill(now)
+            wait = self._blocked_until - now
+            if wait > 0:
+                return wait
+            if self.rate is None or self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def update(self, response: Response) -> float:
+        '''
+        Adjusts pacing from the response's rate limit headers.
+        returns the number of seconds callers are paused for if the response was a 429, else 0
+        '''
+        return self.observe(response.headers, response.status_code, response.url)
+
+    def observe(self, headers: Mapping[str, str], status_code: int, url: str) -> float:
+        '''
+        Same as update for responses of other HTTP clients (ex: aiohttp)
+        '''
+        with self._lock:
+            now = monotonic()
+            limit = self._number(headers.get('X-RateLimit-Limit'))
+            fill_rate = self._number(headers.get('X-RateLimit-FillRate'))
+            interval = self._number(headers.get('X-RateLimit-Interval-Seconds'))
+            remaining = self._number(headers.get('X-RateLimit-Remaining'))
+            near_limit = headers.get('X-RateLimit-NearLimit', '').lower() == 'true'
+
+            if fill_rate and interval:
+                self.max_rate = fill_rate / interval
+                self.rate = self.max_rate
+                if limit:
+                    self.burst = max(1, int(limit))
+            elif near_limit and limit:
+                self.rate = min(self.rate or limit / 3600, limit / 3600)
+            elif self.rate is not None and self.max_rate is not None and self.rate < self.max_rate:
+                # Ease back up once the host stops warning us
+                self.rate = min(self.max_rate, self.rate * 1.1)
+            elif self.max_rate is None:
+                self.rate = None
+            if remaining is not None:
+                self._tokens = min(self._tokens, remaining)
+
+            if status_code != 429:
+                self._consecutive_throttles = 0
+                return 0.0
+
+            self._consecutive_throttles += 1
+            delay = self._retry_after(headers.get('Retry-After'))
+            if delay is None:
+                delay = min(self.max_backoff, self.default_backoff * 2 ** (self._consecutive_throttles - 1))
+            self._blocked_until = max(self._blocked_until, now + delay)
+            if self.rate is not None:
+                self.rate = max(self.rate / 2, 0.01)
+            self._tokens = 0.0
+        log.info(f'Hit api rate limit on "{url}", pausing requests for {delay:.1f} seconds then retrying...')
+        return delay
+
+    def _refill(self, now: float) -> None:
+        if self.rate is not None:
+            self._tokens = min(float(self.burst), self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    @staticmethod
+    def _number(value: str) -> float:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _retry_after(value: str) -> float:
+        '''
+        Retry-After may either be a number of seconds or an HTTP date
+        '''
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
@@ -0,0 +1,97 @@
+from dataclasses import dataclass
+from fnmatch import fnmatchcase
+from typing import Iterable
+
+from resources.manifest import estimate_seconds
+from resources.settings import Settings
+from resources import server_objects as SO
+
+# Seconds per request assumed when ranking repos, only the relative cost of repos matters
+NOMINAL_LATENCY = 0.1
+
+
+class ProjectFilter:
+    '''
+    Which server projects to migrate and in what order, from glob patterns matched
+    (case insensitively) against the project key or name.
+
+    include = only these projects, None for all of them
+    exclude = never these projects, even if included
+    priorities = {pattern: priority}, repos of higher priority projects go first, others are 0
+
+    Example:
+    ProjectFilter(include=['CORE', 'TEAM-*'], exclude=['*-ARCHIVE'], priorities={'CORE': 10})
+    '''
+
+    def __init__(self, include: Iterable[str]=None, exclude: Iterable[str]=None, priorities: dict=None) -> None:
+        self.include = list(include) if include is not None else None
+        self.exclude = list(exclude or [])
+        self.priorities = dict(priorities or {})
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> 'ProjectFilter':
+        return cls(settings.project_include, settings.project_exclude, settings.project_priorities)
+
+    def selects(self, project: SO.Project) -> bool:
+        if self.include is not None and not self._matches(project, self.include):
+            return False
+        return not self._matches(project, self.exclude)
+
+    def priority(self, project: SO.Project) -> int:
+        '''
+        returns the highest priority whose pattern matches project, 0 if none does
+        '''
+        matching = [priority for pattern, priority in self.priorities.items() if self._matches(project, [pattern])]
+        return max(matching, default=0)
+
+    @staticmethod
+    def _matches(project: SO.Project, patterns: list[str]) -> bool:
+        names = [name.upper() for name in (project.key, project.name) if name]
+        return any(fnmatchcase(name, pattern.upper()) for pattern in patterns for name in names)
+
+
+@dataclass
+class RepoWork:
+    '''
+    A repo to migrate and how much work it is expected to be.
+    attachments/size = known from a manifest (see resources.manifest), 0 when only the PR count is known
+    offset = where the repo starts in that manifest, see resources.manifest.index_manifest
+    '''
+    project: SO.Project
+    repo: SO.Repository
+    prs: int
+    attachments: int = 0
+    size: int = 0
+    priority: int = 0
+    offset: int = None
+
+    def cost(self, settings: Settings) -> float:
+        '''
+        Estimated seconds the repo takes on its own, see resources.manifest.estimate_seconds
+        '''
+        return estimate_seconds(settings, self.attachments, self.prs, self.size, NOMINAL_LATENCY,
+                                settings.estimate_bandwidth)
+
+
+def schedule(works: Iterable[RepoWork], settings: Settings) -> list[RepoWork]:
+    '''
+    Orders works by priority, then largest first. Worker pools take repos in this order, so the
+    longest repos start early and the short ones fill the gaps at the end instead of one large
+    repo finishing long after the rest (longest processing time first scheduling).
+    '''
+    return sorted(works, key=lambda work: (-work.priority, -work.cost(settings)))
+
+
+def balance(works: list[RepoWork], settings: Settings, count: int) -> list[int]:
+    '''
+    Splits scheduled works between count shards, each work going to the least loaded shard so far.
+    returns the shard index of every work. Deterministic, so every worker reading the same
+    manifest agrees on the split without talking to the others.
+    '''
+    loads = [0.0] * count
+    shards = []
+    for work in works:
+        shard = min(range(count), key=lambda index: loads[index])
+        loads[shard] += work.cost(settings)
+        shards.append(shard)
+    return shards
@@ -1,6 +1,11 @@
-from typing import Generator
-from requests import Session, get
-from requests.exceptions import SSLError
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+from threading import Lock
+from typing import Generator, Iterable, Iterator
+from requests import Session, Response
+from requests.exceptions import RequestException, SSLError
 from urllib3 import disable_warnings
 from urllib3.exceptions import InsecureRequestWarning
 from re import findall
@@ -9,52 +14,237 @@ from uuid import uuid4
 from urllib import parse
 
 from resources.api import Base_API
+from resources.rate_limit import RateLimiter
+from resources.transport import Transport
 from resources.server_objects import User, Project, Repository, PullRequest
-from resources.logger import log
+from resources.spool import ByteBudget, ChunkProgress
+from resources.logger import lazy, log
 
 
 class ServerSessionHandler(Base_API):
-    def __init__(self, session: Session, base_url: str):
+    # Attachments larger than one chunk are downloaded chunk by chunk with Range requests,
+    # download_chunk_workers at a time, into spool_dir (None = the system temp directory)
+    download_chunk_size: int = 16 * 1024 * 1024
+    download_chunk_workers: int = 4
+    spool_dir: str = None
+    # Bytes of downloaded attachments held at once when set, see release_download
+    download_budget: ByteBudget = None
+
+    def __init__(self, session: Session, base_url: str, rate_limiter: RateLimiter=None,
+                 transport: Transport=None, ssl_verify: bool=None):
+        '''
+        ssl_verify = whether the server's certificate verifies, probed (see _validate_ssl) when None
+        '''
         self.session = session
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.transport = transport or Transport()
         while base_url.endswith('/'):
             base_url = base_url[:-1]
         self.base_url = base_url
-        self.ssl_verify = self._validate_ssl(base_url)
+        self.ssl_verify = self._validate_ssl(base_url) if ssl_verify is None else ssl_verify
+        if not self.ssl_verify:
+            # Also when taken from a cached probe, every request would warn otherwise
+            disable_warnings(InsecureRequestWarning)
         self.pagination_marker = 'isLastPage'
         self.pagination_page = 'start'
         self.pagination_per_page = 'limit'
+        # Server caps page size at its page.max.limit anyway, which defaults to 1000
+        self.max_page_size = 1000
 
-    @staticmethod
-    def _validate_ssl(base_url: str) -> bool:
+    def _validate_ssl(self, base_url: str) -> bool:
         endpoint = f'{base_url}/status'
         try:
-            r = get(endpoint)
+            self.session.get(endpoint, timeout=self.transport.timeout)
             return True
         except SSLError:
-            disable_warnings(InsecureRequestWarning)
             return False
 
     def download(self, endpoint: str, filename: str, pr_id: int) -> Path:
-        _name, _extension = filename.split('.')
-        _name_without_spaces = _name.replace(' ', '_')
-        _uuid = f'_PR-{pr_id}_{str(uuid4())[:8]}'
-        _name_with_hash = f'{_name_without_spaces}-{_uuid}'
-        fs_filename = f'{_name_with_hash}.{_extension}'
-        log.debug(f'Attempting to download attachment "{filename}" as "{fs_filename}" to prevent duplicate name collision.')
+        '''
+        The first chunk is asked for with a Range request. A file that fits in it is streamed from that
+        response to the working directory, a larger one continues in _download_chunked.
+        Every downloaded file holds its size in self.download_budget until release_download.
+        '''
+        fs_filename = ServerUtils.unique_filename(filename, pr_id)
+        log.debug('Attempting to download attachment "%s" as "%s" to prevent duplicate name collision.', filename, fs_filename)
 
         url = f'{self.base_url}{endpoint}'
-        with open(fs_filename, 'wb') as local_file:
-            r = self.session.get(url)
+        r = self._request('GET', endpoint, headers={'Range': f'bytes=0-{self.download_chunk_size - 1}'}, stream=True)
+        if r.status_code == 416:
+            # Empty files have no byte 0 to ask for
+            r.close()
+            r = self._request('GET', endpoint, stream=True)
+        if r.status_code not in (200, 206):
+            log.warning('Unable to download "%s" from "%s" with\n\tStatus_code: %s\n\t%s', filename, url, r.status_code,
+                        lazy(lambda: r.text))
+            r.close()
+            return None
+        size = self._content_size(r)
+        if r.status_code == 206 and size is not None and size > self.download_chunk_size:
+            return self._download_chunked(endpoint, filename, pr_id, fs_filename, r, size)
+        if r.status_code == 206 and size is None:
+            # The server won't say how large the file is, so it can't be split up
+            r.close()
+            r = self._request('GET', endpoint, stream=True)
+
+        path = Path(fs_filename)
+        if not self._hold_download(path, size or int(r.headers.get('Content-Length') or 0), r):
+            r = self._request('GET', endpoint, stream=True)
             if r.status_code != 200:
-                log.warning(f'Unable to download "{filename}" from "{url}" with\n\tStatus_code: {r.status_code}\n\t{r.text}')
+                log.warning('Unable to download "%s" from "%s" with\n\tStatus_code: %s\n\t%s', filename, url,
+                            r.status_code, lazy(lambda: r.text))
+                r.close()
+                self.release_download(path)
                 return None
-            local_file.write(r.content)
-        log.debug(f'Download of "{filename}" successful')
-        return Path(fs_filename)
+        try:
+            with r, open(path, 'wb') as local_file:
+                for chunk in r.iter_content(1024 * 1024):
+                    local_file.write(chunk)
+        except BaseException:
+            self.release_download(path)
+            path.unlink(missing_ok=True)
+            raise
+        log.debug('Download of "%s" successful', filename)
+        return path
+
+    def release_download(self, path: Path) -> None:
+        '''
+        Gives the bytes a downloaded file held back to self.download_budget, call once its local copy is gone
+        '''
+        if self.download_budget is not None:
+            self.download_budget.release(str(path))
+
+    def _hold_download(self, path: Path, size: int, r: Response) -> bool:
+        '''
+        Holds size bytes of self.download_budget for path.
+        returns False if r had to be closed unread to wait for room, the caller then asks for the body
+        again. A response left open while waiting would keep its pooled connection, and enough of
+        them would starve every other request of one.
+        '''
+        if self.download_budget is None or self.download_budget.try_acquire(str(path), size):
+            return True
+        r.close()
+        self.download_budget.acquire(str(path), size)
+        return False
+
+    @staticmethod
+    def _content_size(r: Response) -> int:
+        '''
+        Example:
+        in: response with "Content-Range: bytes 0-16777215/1073741824"
+        out: 1073741824
+        '''
+        if r.status_code != 206:
+            content_length = r.headers.get('Content-Length')
+            return int(content_length) if content_length else None
+        total = r.headers.get('Content-Range', '').rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+
+    def _download_chunked(self, endpoint: str, filename: str, pr_id: int, fs_filename: str,
+                          first: Response, size: int) -> Path:
+        '''
+        Fetches the rest of a large attachment with parallel Range requests into a part file in
+        self.spool_dir. Finished chunks are recorded next to it (see resources.spool.ChunkProgress)
+        so if any chunk fails, the next attempt at the same attachment only fetches what is missing.
+        '''
+        spool_dir = Path(self.spool_dir or tempfile.gettempdir())
+        spool_dir.mkdir(parents=True, exist_ok=True)
+        # Named after the attachment rather than fs_filename (random) so every attempt finds it
+        part_path = spool_dir / f'PR-{pr_id}-{sha1(endpoint.encode()).hexdigest()[:16]}.part'
+        etag = first.headers.get('ETag')
+        progress = ChunkProgress(part_path, size, self.download_chunk_size, etag)
+        progress.load()
+        if progress.done:
+            log.info(f'Resuming download of "{filename}" with {len(progress.done)} of {progress.chunks} chunks done')
+
+        path = spool_dir / fs_filename
+        if not self._hold_download(path, size, first):
+            # Fetched along with the other chunks instead
+            first = None
+        try:
+            write_lock = Lock()
+            with open(part_path, 'r+b' if progress.done else 'wb') as part:
+                def write(index: int, content: bytes) -> None:
+                    with write_lock:
+                        part.seek(index * progress.chunk_size)
+                        part.write(content)
+                        part.flush()
+                        progress.done.add(index)
+                        progress.save()
+
+                if first is not None:
+                    with first:
+                        if 0 not in progress.done:
+                            write(0, first.content)
+                # A changed file (different ETag) is sent whole instead of the range, which fails the chunk
+                headers = {'If-Range': etag} if etag else {}
+                with ThreadPoolExecutor(self.download_chunk_workers, thread_name_prefix='download-chunk') as executor:
+                    fetched = list(executor.map(lambda index: self._download_chunk(endpoint, progress, index, headers, write),
+                                                progress.missing()))
+            if not all(fetched):
+                log.warning(f'Unable to download {fetched.count(False)} chunks of "{filename}", '
+                            f'{len(progress.done)} of {progress.chunks} are kept in "{part_path}" for the next attempt')
+                self.release_download(path)
+                return None
+            os.replace(part_path, path)
+            progress.remove()
+        except BaseException:
+            self.release_download(path)
+            raise
+        log.debug(f'Chunked download of "{filename}" ({size} bytes in {progress.chunks} chunks) successful')
+        return path
+
+    def _download_chunk(self, endpoint: str, progress: ChunkProgress, index: int, headers: dict, write) -> bool:
+        first, last = progress.byte_range(index)
+        expected = last - first + 1
+        try:
+            # Streamed so a server answering with the whole file (ex: a failed If-Range) is never read
+            r = self._request('GET', endpoint, headers={**headers, 'Range': f'bytes={first}-{last}'}, stream=True)
+            with r:
+                if r.status_code != 206:
+                    log.warning('Chunk %s (bytes %s-%s) of "%s" returned status_code %s', index, first, last,
+                                endpoint, r.status_code)
+                    return False
+                content = bytearray()
+                for piece in r.iter_content(1024 * 1024):
+                    content += piece
+                    if len(content) > expected:
+                        break
+        except RequestException as e:
+            log.warning('Chunk %s (bytes %s-%s) of "%s" failed with %r', index, first, last, endpoint, e)
+            return False
+        if len(content) != expected:
+            log.warning('Chunk %s (bytes %s-%s) of "%s" returned %s bytes', index, first, last, endpoint, len(content))
+            return False
+        write(index, bytes(content))
+        return True
+
+    def stream(self, endpoint: str, filename: str, chunk_size: int=1024 * 1024) -> tuple[Iterator[bytes], int]:
+        '''
+        returns (chunk iterator, content length or None) or None if the request failed
+
+        The body is only read as the iterator is consumed, and the connection is
+        released once it is exhausted or closed.
+        '''
+        url = f'{self.base_url}{endpoint}'
+        r = self._request('GET', endpoint, stream=True)
+        if r.status_code != 200:
+            log.warning('Unable to stream "%s" from "%s" with\n\tStatus_code: %s\n\t%s', filename, url, r.status_code,
+                        lazy(lambda: r.text))
+            r.close()
+            return None
+        content_length = r.headers.get('Content-Length')
+
+        def chunks() -> Iterator[bytes]:
+            with r:
+                yield from r.iter_content(chunk_size)
+
+        return chunks(), int(content_length) if content_length else None
 
 
 class Server(ServerSessionHandler):
     # https://developer.atlassian.com/server/bitbucket/reference/rest-api/
+    project_fields = ('key', 'name', 'id', 'description', 'public')
 
     def get_users(self) -> Generator[User, None, None]:
         '''
@@ -62,7 +252,8 @@ class Server(ServerSessionHandler):
         https://docs.atlassian.com/bitbucket-server/rest/7.18.0/bitbucket-rest.html#idp16
         '''
         endpoint = '/rest/api/1.0/admin/users'
-        for value in self._get_paged_api(endpoint):
+        fields = ('slug', 'displayName', 'emailAddress')
+        for value in self._get_paged_api(endpoint, fields=fields):
             user = User(value.get('slug'),
                         value.get('displayName'),
                         value.get('emailAddress'))
@@ -75,7 +266,7 @@ class Server(ServerSessionHandler):
         https://docs.atlassian.com/bitbucket-server/rest/7.19.1/bitbucket-rest.html#idp149
         '''
         endpoint = "/rest/api/latest/projects"
-        for value in self._get_paged_api(endpoint):
+        for value in self._get_paged_api(endpoint, fields=self.project_fields):
             project = Project(value.get('key'),
                               value.get('name'),
                               value.get('id'),
@@ -83,13 +274,32 @@ class Server(ServerSessionHandler):
                               value.get('public'))
             yield project
 
+    def check_access(self, project_name: str=None) -> bool:
+        '''
+        Fails fast (see Base_API._authorized) unless the credentials are valid and can see
+        project_name, or any project when None
+        GET /rest/api/latest/projects
+        '''
+        r = self._request('GET', '/rest/api/latest/projects', params={'name': project_name, 'limit': 1})
+        if r.status_code != 200:
+            log.critical(f'Unable to list projects on "{self.base_url}", status_code: {r.status_code}. Closing...')
+            exit()
+        if not r.json().get('values') and project_name is None:
+            log.critical(f'No project is visible to this user on "{self.base_url}", please check your permissions. Closing...')
+            exit()
+        if not r.json().get('values'):
+            log.critical(f'No project named "{project_name}" is visible to this user on "{self.base_url}", '
+                         'please check "server_project_name" and your permissions. Closing...')
+            exit()
+        return True
+
     def get_projects_by_name(self, project_name ) -> Generator[Project, None, None]:
         '''
         GET /rest/api/latest/projects
         https://docs.atlassian.com/bitbucket-server/rest/7.19.1/bitbucket-rest.html#idp149
         '''
         endpoint =  "/rest/api/latest/projects?name="+parse.quote(project_name)
-        for value in self._get_paged_api(endpoint):
+        for value in self._get_paged_api(endpoint, fields=self.project_fields):
             project = Project(value.get('key'),
                               value.get('name'),
                               value.get('id'),
@@ -102,7 +312,8 @@ class Server(ServerSessionHandler):
         https://docs.atlassian.com/bitbucket-server/rest/7.21.0/bitbucket-rest.html#idp177
         '''
         endpoint = f'/rest/api/latest/projects/{project.key}/repos'
-        for value in self._get_paged_api(endpoint):
+        fields = ('slug', 'id', 'name', 'description')
+        for value in self._get_paged_api(endpoint, fields=fields):
             repo = Repository(value.get('slug'),
                               value.get('id'),
                               value.get('name'),
@@ -110,14 +321,17 @@ class Server(ServerSessionHandler):
                               project=project)
             yield repo
 
-    def get_pull_requests(self, project: Project, repo: Repository) -> Generator[PullRequest, None, None]:
+    def get_pull_requests(self, project: Project, repo: Repository, order: str=None) -> Generator[PullRequest, None, None]:
         '''
+        order = "NEWEST" (most recently updated first) or "OLDEST", defaults to the server's ordering
         https://docs.atlassian.com/bitbucket-server/rest/7.21.0/bitbucket-rest.html#idp300
         '''
         endpoint = f'/rest/api/latest/projects/{project.key}/repos/{repo.slug}/pull-requests?state=ALL'
         print(endpoint)
+        fields = ('id', 'title', 'description', 'state', 'createdDate', 'updatedDate')
+        params = {'order': order} if order else None
 
-        for value in self._get_paged_api(endpoint):
+        for value in self._get_paged_api(endpoint, params=params, fields=fields):
             pr = PullRequest(value.get('id'),
                              value.get('title'),
                              value.get('description'),
@@ -127,29 +341,134 @@ class Server(ServerSessionHandler):
                              repo=repo)
             yield pr
 
-    def get_pull_request_attachments(self, project: Project, repo: Repository, pr: PullRequest) -> Generator[dict, None, None]:
+    def count_pull_requests(self, project: Project, repo: Repository) -> int:
+        '''
+        returns how many PRs (of any state) repo has, found with one item pages, about
+        2 * log2(count) requests, instead of listing every PR
+        '''
+        endpoint = f'/rest/api/latest/projects/{project.key}/repos/{repo.slug}/pull-requests?state=ALL'
+
+        def exists(index: int) -> bool:
+            return bool(self._get_api(endpoint, params={'start': index, 'limit': 1}).get('values'))
+
+        if not exists(0):
+            return 0
+        # Double until past the end, then bisect between the last index found and the first missing one
+        found, missing = 0, 1
+        while exists(missing):
+            found, missing = missing, missing * 2
+        while missing - found > 1:
+            middle = (found + missing) // 2
+            if exists(middle):
+                found = middle
+            else:
+                missing = middle
+        return found + 1
+
+    def get_pull_request_attachments(self, project: Project, repo: Repository, pr: PullRequest) -> Generator[tuple[int, str, int], None, None]:
         '''
+        Yields (attachment id, filename, id of the comment linking it or None for the description)
+        for every attachment of pr once, see ServerUtils.strip_attachments_from_pull_request
         https://docs.atlassian.com/bitbucket-server/rest/7.21.0/bitbucket-rest.html#idp331
         '''
         endpoint = f"/rest/api/latest/projects/{project.key}/repos/{repo.slug}/pull-requests/{pr.id}/activities"
-        for value in self._get_paged_api(endpoint):
-            if value.get('action') == "COMMENTED":
-                if (comment := value.get('comment')):
-                    comment: dict
-                    if (text := comment.get('text')):
-                        for attachment_id, filename in ServerUtils.strip_attachment_from_text(text):
-                            yield attachment_id, filename
+        # Activities carry whole diffs and commits, only the comments (replies included) are of any use here
+        fields = ('action', 'comment.id', 'comment.text', 'comment.comments')
+        # A merged or declined PR's activities only change along with its updated date
+        immutable = None
+        if pr.state in ('MERGED', 'DECLINED') and pr.updated_date is not None:
+            immutable = f'{pr.state}:{pr.updated_date.isoformat()}'
+        activities = self._get_paged_api(endpoint, fields=fields, immutable=immutable)
+        yield from ServerUtils.strip_attachments_from_pull_request(pr.description, activities)
 
     def download_repo_attachment(self, project: Project, repo: Repository, attachment_id: int, filename: str, pr_id: int) -> Path:
         '''
         https://docs.atlassian.com/bitbucket-server/rest/7.21.0/bitbucket-rest.html#idp206
         '''
         endpoint = f'/rest/api/latest/projects/{project.key}/repos/{repo.slug}/attachments/{attachment_id}'
-        log.debug(f'Attempting to download "{filename}" from server at URI "{endpoint}"')
+        log.debug('Attempting to download "%s" from server at URI "%s"', filename, endpoint)
         attachment = self.download(endpoint, filename, pr_id)
         return attachment
 
+    def get_repo_attachment_size(self, project: Project, repo: Repository, attachment_id: int) -> int:
+        '''
+        returns the attachment's size in bytes from a HEAD request, None if the server doesn't say
+        https://docs.atlassian.com/bitbucket-server/rest/7.21.0/bitbucket-rest.html#idp206
+        '''
+        endpoint = f'/rest/api/latest/projects/{project.key}/repos/{repo.slug}/attachments/{attachment_id}'
+        r = self._request('HEAD', endpoint)
+        content_length = r.headers.get('Content-Length')
+        if r.status_code != 200 or not content_length:
+            log.debug('No size for attachment "%s" in repo "%s", status_code: %s', attachment_id, repo.slug, r.status_code)
+            return None
+        return int(content_length)
+
+    def stream_repo_attachment(self, project: Project, repo: Repository, attachment_id: int,
+                               filename: str) -> tuple[Iterator[bytes], int]:
+        '''
+        Same as download_repo_attachment without touching disk, see ServerSessionHandler.stream
+        https://docs.atlassian.com/bitbucket-server/rest/7.21.0/bitbucket-rest.html#idp206
+        '''
+        endpoint = f'/rest/api/latest/projects/{project.key}/repos/{repo.slug}/attachments/{attachment_id}'
+        log.debug('Attempting to stream "%s" from server at URI "%s"', filename, endpoint)
+        return self.stream(endpoint, filename)
+
 class ServerUtils:
+    @staticmethod
+    def unique_filename(filename: str, pr_id: int, digest: str=None) -> str:
+        '''
+        Example:
+        in: "my file.png", 12
+        out: "my_file-_PR-12_1a2b3c4d.png"
+
+        Spaces become underscores (as cloud would do on upload anyway) and the PR id plus
+        an 8 character hash are appended so the name can't collide in downloads. The hash is
+        taken from digest (the content hash) when given, otherwise it is random.
+        '''
+        _name, _dot, _extension = filename.rpartition('.')
+        if not _dot:
+            _name, _extension = _extension, ''
+        _name_without_spaces = _name.replace(' ', '_')
+        _hash = digest[:8] if digest else str(uuid4())[:8]
+        _uuid = f'_PR-{pr_id}_{_hash}'
+        _name_with_hash = f'{_name_without_spaces}-{_uuid}'
+        if not _dot:
+            return _name_with_hash
+        return f'{_name_with_hash}.{_extension}'
+
+    @staticmethod
+    def strip_attachments_from_pull_request(description: str, activities: Iterable[dict]) -> Generator[tuple[int, str, int], None, None]:
+        '''
+        Single pass over a PR's description and the comments of its activities, replies
+        (comment.comments, nested to any depth) included, so no comment needs a request of its own.
+        Every attachment is yielded once, from the first place linking it.
+
+        Example:
+        in: "see ![a.png](attachment:1/12)", [{"action": "COMMENTED", "comment": {"id": 3, "text": "...",
+            "comments": [{"id": 4, "text": "![b.log](attachment:1/13) ![a.png](attachment:1/12)", "comments": []}]}}]
+        out: (12, "a.png", None), (13, "b.log", 4)
+        '''
+        seen = set()
+
+        def unseen(text: str, comment_id: int) -> Generator[tuple[int, str, int], None, None]:
+            for attachment_id, filename in ServerUtils.strip_attachment_from_text(text):
+                if attachment_id not in seen:
+                    seen.add(attachment_id)
+                    yield attachment_id, filename, comment_id
+
+        if description:
+            yield from unseen(description, None)
+        for activity in activities:
+            if activity.get('action') != 'COMMENTED' or not activity.get('comment'):
+                continue
+            # Depth first in thread order, without recursion as reply chains can run deep
+            comments = [activity['comment']]
+            while comments:
+                comment: dict = comments.pop()
+                if (text := comment.get('text')):
+                    yield from unseen(text, comment.get('id'))
+                comments.extend(reversed(comment.get('comments') or []))
+
     @staticmethod
     def strip_attachment_from_text(text: str) -> Generator[tuple[int, str], None, None]:
         '''
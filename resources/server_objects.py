@@ -1,5 +1,6 @@
-from dataclasses import dataclass
-from datetime import datetime
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
 
 @dataclass
 class User:
@@ -34,11 +35,33 @@ class PullRequest:
     repo: Repository
 
     def __post_init__(self):
-        #self.created_date = self.datetime_from_int(self.created_date)
-        #self.updated_date = self.datetime_from_int(self.updated_date)
-        ...
+        self.created_date = self.datetime_from_int(self.created_date)
+        self.updated_date = self.datetime_from_int(self.updated_date)
 
     @staticmethod
     def datetime_from_int(raw_time: int) -> datetime:
-        #return datetime.fromtimestamp(raw_time)
-        ...
\ No newline at end of file
+        # Server reports times as milliseconds since the epoch
+        if isinstance(raw_time, datetime) or raw_time is None:
+            return raw_time
+        if not isinstance(raw_time, (int, float)):
+            return None
+        return datetime.fromtimestamp(raw_time / 1000, tz=timezone.utc)
+
+@dataclass
+class Attachment:
+    id: int
+    filename: str
+    pr: PullRequest
+    local_path: Path = None
+    # Server comment linking the attachment, None if it is linked from the PR description
+    comment_id: int = None
+    # Name the file was stored under in the cloud repo's downloads
+    cloud_filename: str = None
+    # sha256 of the content, once known
+    digest: str = None
+    # resources.checkpoint.Stage reached so far, 0 if not started
+    stage: int = 0
+    # resources.dedup.AttachmentDedup keys claimed for this attachment and not yet resolved
+    dedup_keys: list = field(default_factory=lambda: [])
+    # resources.comment_batch.CommentBatch of the PR when comments are consolidated, until settled
+    comment_batch: object = None
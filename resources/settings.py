@@ -0,0 +1,153 @@
+from dataclasses import dataclass, field, fields
+
+
+@dataclass
+class Settings:
+    '''
+    Run options read from "env.py". Anything not defined there falls back to the defaults below,
+    so older env.py files keep working as new options are added.
+    '''
+    server_project_name: str = None
+    server_repo_name: str = None
+
+    # Migrate every server project (filtered by project_include/project_exclude) instead of server_project_name,
+    # see resources.scheduler. Patterns are globs matched against project keys and names, ex: ['CORE', 'TEAM-*'].
+    # project_priorities = {pattern: priority}, higher priority projects go first, the rest are 0
+    all_projects: bool = False
+    project_include: list = None
+    project_exclude: list = None
+    project_priorities: dict = None
+
+    # Bitbucket Cloud REST API root, only changed to point the script at a stand-in (see benchmarks/)
+    cloud_api_url: str = 'https://api.bitbucket.org'
+
+    # Pipeline mode, see resources.pipeline
+    pipeline_mode: bool = False
+    pipeline_workers: dict = field(default_factory=lambda: {'discovery': 2,
+                                                            'extraction': 4,
+                                                            'download': 8,
+                                                            'upload': 4,
+                                                            'comment': 2})
+    pipeline_queue_size: int = 50
+
+    # asyncio mode, see resources.async_api. Needs the optional "aiohttp" package. Only migrates
+    # server_project_name, one attachment per upload and comment, without dedup, streaming, chunked
+    # downloads, the cloud index, page prefetch/streaming, the HTTP cache, metrics or tracing
+    async_mode: bool = False
+    async_max_in_flight: int = 200
+
+    # Relay attachments from server to cloud without writing them to disk, see resources.streaming
+    streaming_mode: bool = False
+
+    # Transfer each unique attachment once per cloud repo, see resources.dedup
+    deduplicate_attachments: bool = True
+
+    # SQLite file recording each attachment's progress so reruns resume, see resources.checkpoint.
+    # None disables checkpointing
+    checkpoint_file: str = 'migration-state.sqlite3'
+
+    # Check cloud repo/PR existence against lists fetched once per workspace/repo, see resources.cloud_index
+    cloud_index: bool = True
+
+    # Requests per second sent to each host until its rate limit headers say otherwise, None for no
+    # limit, see resources.rate_limit
+    server_rate_limit: float = 20.0
+    cloud_rate_limit: float = 10.0
+    rate_limit_burst: int = 10
+
+    # HTTP transport per host, see resources.transport. A pool size of None matches the worker count
+    http_pool_size: int = None
+    connect_timeout: float = 10.0
+    read_timeout: float = 120.0
+    max_retries: int = 5
+
+    # Request the next page of a listing while the current one is being processed
+    page_prefetch: bool = True
+    # Parse listing pages item by item as they download instead of loading whole pages, see resources.json_stream
+    stream_pages: bool = False
+
+    # Most attachments and bytes sent to a cloud repo's downloads in one request, see resources.upload_batch.
+    # A batch size of 1 (the default, so upgrading doesn't change how uploads are sent) uploads every attachment
+    # on its own. Not used in streaming or async mode
+    upload_batch_size: int = 1
+    upload_batch_bytes: int = 50 * 1024 * 1024
+
+    # Link all of a PR's attachments from one comment instead of one comment each, see resources.comment_batch.
+    # Off by default so upgrading doesn't change what gets posted
+    consolidate_comments: bool = False
+
+    # Only scan PRs updated since the last completed run, see resources.incremental. Needs checkpoint_file
+    incremental_sync: bool = False
+
+    # Split the repos between shard_count workers and only migrate those of shard_index (0 based),
+    # see resources.sharding. Usually given per worker with --shard INDEX/COUNT instead
+    shard_index: int = 0
+    shard_count: int = 1
+
+    # Publish per endpoint request metrics for Prometheus, see resources.metrics. metrics_textfile is
+    # rewritten every metrics_interval seconds, metrics_port serves http://127.0.0.1:<port>/metrics
+    metrics_textfile: str = None
+    metrics_port: int = None
+    metrics_interval: float = 15.0
+
+    # Chrome/Perfetto trace file timing every discovery, download, upload and comment step, see resources.tracing
+    trace_file: str = None
+
+    # Cache listing responses (projects, repos, PRs, activities) in this SQLite file between runs, see
+    # resources.http_cache. Up to http_cache_max_bytes of response bodies are kept, least recently used go first
+    http_cache_file: str = None
+    http_cache_max_bytes: int = 256 * 1024 * 1024
+
+    # Attachments larger than download_chunk_size are downloaded in chunks of that size, download_chunk_workers
+    # at a time, into spool_dir (None = the system temp directory). A failed download resumes from its
+    # finished chunks on the next attempt. Smaller attachments are fetched in one request as before.
+    download_chunk_size: int = 16 * 1024 * 1024
+    download_chunk_workers: int = 4
+    spool_dir: str = None
+    # Most bytes of downloaded attachments (in progress or waiting for their upload) held at once, None for no limit
+    download_budget_bytes: int = 1024 * 1024 * 1024
+
+    # Startup probes (server SSL mode, cloud workspace lookup, access checks) are cached in this JSON file
+    # for preflight_cache_ttl seconds so reruns and sharded workers skip them, see resources.preflight
+    preflight_cache_file: str = '.preflight-cache.json'
+    preflight_cache_ttl: float = 3600.0
+
+    # Worker threads only queue their log records, a background thread formats and writes them, see
+    # resources.logger. log_json writes the log file as JSON lines, log_file_level is the least severe level
+    # written to it. Past log_rate_limit_burst records of the same message within log_rate_limit_interval
+    # seconds, the rest are counted instead of shown on the console (None disables it, errors are always
+    # shown). The log file always gets every record.
+    async_logging: bool = True
+    log_json: bool = False
+    log_file_level: str = 'DEBUG'
+    log_rate_limit_interval: float = 10.0
+    log_rate_limit_burst: int = 5
+
+    # Bytes per second one download or upload is expected to manage, only used for the time estimate of --plan
+    estimate_bandwidth: float = 5 * 1024 * 1024
+
+    # Settings async mode doesn't act on -> the value it behaves as
+    async_mode_ignores = {'all_projects': False, 'deduplicate_attachments': False, 'streaming_mode': False,
+                          'upload_batch_size': 1, 'consolidate_comments': False, 'cloud_index': False,
+                          'page_prefetch': False, 'stream_pages': False, 'http_cache_file': None,
+                          'download_chunk_size': None, 'download_budget_bytes': None, 'metrics_textfile': None,
+                          'metrics_port': None, 'trace_file': None}
+
+    def ignored_by_async_mode(self) -> list[str]:
+        '''
+        returns the settings changed from their defaults that async mode won't honour
+        '''
+        defaults = Settings()
+        return [name for name, behaves_as in self.async_mode_ignores.items()
+                if getattr(self, name) not in (getattr(defaults, name), behaves_as)]
+
+    @classmethod
+    def from_env(cls, env) -> 'Settings':
+        values = {}
+        for setting in fields(cls):
+            if hasattr(env, setting.name):
+                values[setting.name] = getattr(env, setting.name)
+        settings = cls(**values)
+        # Allow env.py to override only some of the stage worker counts
+        settings.pipeline_workers = {**cls().pipeline_workers, **(settings.pipeline_workers or {})}
+        return settings
@@ -0,0 +1,111 @@
+import sqlite3
+from dataclasses import dataclass
+from threading import Lock
+from time import monotonic
+from zlib import crc32
+
+from resources.checkpoint import CheckpointStore, Stage
+
+
+@dataclass(frozen=True)
+class Shard:
+    '''
+    One of count slices of the (project, repo) work units. Every repo belongs to exactly one
+    shard, picked by a stable hash of its key, so count workers started with index 0..count-1
+    (on one machine or several) cover every repo once without talking to each other.
+
+    Example:
+    Shard.parse('1/4')
+    out: Shard(index=1, count=4)
+    '''
+    index: int = 0
+    count: int = 1
+
+    def __post_init__(self) -> None:
+        if self.count < 1 or not 0 <= self.index < self.count:
+            raise ValueError(f'Shard index must be between 0 and {self.count - 1}, got {self.index}')
+
+    @classmethod
+    def parse(cls, text: str) -> 'Shard':
+        index, _, count = text.partition('/')
+        return cls(int(index), int(count))
+
+    def owns(self, repo_key: tuple) -> bool:
+        '''
+        repo_key = (server project key, server repo slug)
+        '''
+        if self.count == 1:
+            return True
+        return crc32('/'.join(repo_key).encode()) % self.count == self.index
+
+    def path(self, path: str) -> str:
+        '''
+        Per shard name for an output file every worker would otherwise share
+
+        Example:
+        Shard(1, 4).path('out/metrics.prom')
+        out: 'out/metrics.shard1.prom'
+        '''
+        stem, dot, extension = path.rpartition('.')
+        if not dot or '/' in extension or '\\' in extension:
+            return f'{path}.shard{self.index}'
+        return f'{stem}.shard{self.index}.{extension}'
+
+    def __str__(self) -> str:
+        return f'{self.index}/{self.count}'
+
+
+class ShardProgress:
+    '''
+    Counts what this worker has finished and publishes it to the checkpoint store's shards
+    table, at most every report_interval seconds, for the coordinator to read.
+    '''
+
+    def __init__(self, shard: Shard, checkpoints: CheckpointStore, report_interval: float=5.0) -> None:
+        self.shard = shard
+        self.checkpoints = checkpoints
+        self.report_interval = report_interval
+        self.repos_done = 0
+        self.attachments_done = 0
+        self._last_report = 0.0
+        self._lock = Lock()
+
+    def repo_done(self) -> None:
+        with self._lock:
+            self.repos_done += 1
+        self.report()
+
+    def attachment_done(self) -> None:
+        with self._lock:
+            self.attachments_done += 1
+        self.report()
+
+    def report(self, status: str='running', force: bool=False) -> None:
+        with self._lock:
+            if not force and monotonic() - self._last_report < self.report_interval:
+                return
+            self._last_report = monotonic()
+            repos_done, attachments_done = self.repos_done, self.attachments_done
+        self.checkpoints.report_shard(self.shard.index, self.shard.count, status, repos_done, attachments_done)
+
+
+def read_progress(path: str) -> tuple[list[tuple], dict[Stage, int]]:
+    '''
+    Reads the progress of every shard from a checkpoint file without loading its checkpoints.
+    returns ([(shard index, shard count, status, repos done, attachments done, updated at), ...],
+             {stage: number of attachments at that stage})
+    '''
+    try:
+        connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=30)
+    except sqlite3.OperationalError:
+        # No worker has created the file yet
+        return [], {}
+    try:
+        shards = connection.execute('SELECT * FROM shards ORDER BY shard_count, shard_index').fetchall()
+        stages = {Stage(stage): count for stage, count in
+                  connection.execute('SELECT stage, COUNT(*) FROM attachments GROUP BY stage')}
+    except sqlite3.OperationalError:
+        return [], {}
+    finally:
+        connection.close()
+    return shards, stages
@@ -0,0 +1,132 @@
+import json
+import os
+from pathlib import Path
+from threading import Condition
+from typing import Callable
+
+from resources.logger import log
+
+
+class ByteBudget:
+    '''
+    Caps the bytes of attachments held at once (being downloaded or on disk waiting for their
+    upload) across every worker of the process.
+
+    acquire() blocks until the bytes fit. A file larger than the whole budget is let through on its
+    own once nothing else is held, so it can't block forever. on_wait is called (outside of the
+    lock) before blocking, to free whatever may be holding bytes back (ex: partly filled upload batches),
+    and whatever would hold bytes back later should check waiting first.
+    Safe to share between worker threads.
+    '''
+
+    def __init__(self, max_bytes: int, on_wait: Callable[[], None]=None) -> None:
+        self.max_bytes = max_bytes
+        self.on_wait = on_wait
+        self.held = 0
+        self.waiting = 0
+        self._holders: dict[str, int] = {}
+        self._condition = Condition()
+
+    def acquire(self, key: str, size: int) -> None:
+        with self._condition:
+            if self._fits(size):
+                self._hold(key, size)
+                return
+            # Counted before on_wait runs so nothing held back after it goes unnoticed
+            self.waiting += 1
+        try:
+            if self.on_wait is not None:
+                self.on_wait()
+            with self._condition:
+                if not self._fits(size):
+                    log.debug(f'Waiting for {size} bytes of the download budget, {self.held} of {self.max_bytes} held')
+                self._condition.wait_for(lambda: self._fits(size))
+                self._hold(key, size)
+        finally:
+            with self._condition:
+                self.waiting -= 1
+
+    def try_acquire(self, key: str, size: int) -> bool:
+        '''
+        Same as acquire without blocking, returns False (holding nothing) if size doesn't fit yet
+        '''
+        with self._condition:
+            if not self._fits(size):
+                return False
+            self._hold(key, size)
+            return True
+
+    def release(self, key: str) -> None:
+        '''
+        Frees the bytes held for key, nothing if it holds none (ex: a copy left by an earlier run)
+        '''
+        with self._condition:
+            size = self._holders.pop(key, None)
+            if size is not None:
+                self.held -= size
+                self._condition.notify_all()
+
+    def _fits(self, size: int) -> bool:
+        return self.held + size <= self.max_bytes or not self._holders
+
+    def _hold(self, key: str, size: int) -> None:
+        self._holders[key] = self._holders.get(key, 0) + size
+        self.held += size
+
+
+class ChunkProgress:
+    '''
+    Which chunks of a ranged download have been written to its part file, kept in a sidecar
+    file next to it so a later attempt (this run or the next) only fetches the missing ones.
+
+    Example sidecar "PR-7-1a2b3c4d5e6f7a8b.part.json":
+    {"size": 1073741824, "chunk_size": 16777216, "etag": "\\"abc\\"", "done": [0, 1, 5]}
+    '''
+
+    def __init__(self, part_path: Path, size: int, chunk_size: int, etag: str=None) -> None:
+        self.part_path = part_path
+        self.path = part_path.with_name(f'{part_path.name}.json')
+        self.size = size
+        self.chunk_size = chunk_size
+        self.etag = etag
+        self.done: set[int] = set()
+
+    @property
+    def chunks(self) -> int:
+        return -(-self.size // self.chunk_size)
+
+    def missing(self) -> list[int]:
+        return [index for index in range(self.chunks) if index not in self.done]
+
+    def byte_range(self, index: int) -> tuple[int, int]:
+        '''
+        returns the (first, last) byte of chunk index, both inclusive as in a Range header
+        '''
+        first = index * self.chunk_size
+        return first, min(first + self.chunk_size, self.size) - 1
+
+    def load(self) -> None:
+        '''
+        Picks up the chunks an earlier attempt finished, if it was downloading the same file the same way
+        '''
+        try:
+            with open(self.path) as sidecar:
+                saved = json.load(sidecar)
+        except (OSError, ValueError):
+            return
+        if (saved.get('size'), saved.get('chunk_size'), saved.get('etag')) != (self.size, self.chunk_size, self.etag):
+            log.debug(f'Discarding the partial download in "{self.part_path}", the file or chunk size changed')
+            return
+        if self.part_path.exists():
+            self.done = set(saved.get('done', []))
+
+    def save(self) -> None:
+        # Written aside then renamed so a crash never leaves a half written sidecar
+        temporary = self.path.with_name(f'{self.path.name}.tmp')
+        with open(temporary, 'w') as sidecar:
+            json.dump({'size': self.size, 'chunk_size': self.chunk_size, 'etag': self.etag,
+                       'done': sorted(self.done)}, sidecar)
+        os.replace(temporary, self.path)
+
+    def remove(self) -> None:
+        self.path.unlink(missing_ok=True)
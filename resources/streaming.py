@@ -0,0 +1,37 @@
+from typing import Iterable, Iterator
+from uuid import uuid4
+
+
+class MultipartStream:
+    '''
+    A multipart/form-data body holding a single file part whose content is pulled
+    lazily from an iterable of byte chunks, so a file can be relayed from one
+    response into another request without being held in memory or written to disk.
+
+    Pass it as "data=" to requests along with the content_type header. When the
+    length of the file is known the full body length is exposed through "len"
+    (which requests reads to set Content-Length), otherwise requests falls back
+    to chunked transfer encoding.
+    '''
+
+    def __init__(self, field_name: str, filename: str, chunks: Iterable[bytes],
+                 file_length: int=None, boundary: str=None) -> None:
+        self.boundary = boundary or uuid4().hex
+        self.chunks = chunks
+        self._head = (f'--{self.boundary}\r\n'
+                      f'Content-Disposition: form-data; name="{field_name}"; filename="{filename}"\r\n'
+                      f'Content-Type: application/octet-stream\r\n\r\n').encode()
+        self._tail = f'\r\n--{self.boundary}--\r\n'.encode()
+        if file_length is not None:
+            self.len = len(self._head) + file_length + len(self._tail)
+
+    @property
+    def content_type(self) -> str:
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield self._head
+        for chunk in self.chunks:
+            if chunk:
+                yield chunk
+        yield self._tail
@@ -0,0 +1,79 @@
+import json
+import os
+from contextlib import contextmanager
+from threading import Lock, current_thread, get_ident
+from time import perf_counter_ns
+from typing import Iterable, Iterator
+
+
+class Tracer:
+    '''
+    Records timed spans to a Chrome trace file, open it in chrome://tracing or https://ui.perfetto.dev
+    to see every worker thread's timeline.
+
+    Events are written as they finish (JSON array format, which the viewers accept without the
+    closing bracket) so a long run doesn't hold them in memory and a crash still leaves a usable file.
+    Safe to share between worker threads.
+
+    Example:
+    with tracer.span('download_repo_attachment', project='P', repo='r', pr=7, attachment=12):
+        ...
+    '''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._pid = os.getpid()
+        self._origin = perf_counter_ns()
+        self._named_threads: set[int] = set()
+        self._lock = Lock()
+        self._file = open(path, 'w')
+        self._file.write('[\n')
+
+    @contextmanager
+    def span(self, name: str, **args) -> Iterator[None]:
+        started = perf_counter_ns()
+        try:
+            yield
+        finally:
+            self._complete(name, started, perf_counter_ns(), args)
+
+    def iterate(self, name: str, iterable: Iterable, **args) -> Iterator:
+        '''
+        Yields from iterable with a span around fetching every item, so time spent by the caller
+        between items isn't counted (ex: a page request behind a lazy listing)
+        '''
+        iterator = iter(iterable)
+        try:
+            while True:
+                started = perf_counter_ns()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    self._complete(name, started, perf_counter_ns(), {**args, 'done': True})
+                    return
+                self._complete(name, started, perf_counter_ns(), args)
+                yield item
+        finally:
+            # The caller may stop early, let a generator clean up straight away
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.write(json.dumps({'name': 'process_name', 'ph': 'M', 'pid': self._pid,
+                                         'args': {'name': 'bitbucket_api'}}))
+            self._file.write('\n]\n')
+            self._file.close()
+
+    def _complete(self, name: str, started: int, ended: int, args: dict) -> None:
+        thread_id = get_ident()
+        event = {'name': name, 'ph': 'X', 'pid': self._pid, 'tid': thread_id,
+                 'ts': (started - self._origin) / 1000, 'dur': (ended - started) / 1000, 'args': args}
+        with self._lock:
+            if self._file.closed:
+                return
+            if thread_id not in self._named_threads:
+                self._named_threads.add(thread_id)
+                self._file.write(json.dumps({'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': thread_id,
+                                             'args': {'name': current_thread().name}}) + ',\n')
+            self._file.write(json.dumps(event, default=str) + ',\n')
@@ -0,0 +1,77 @@
+from dataclasses import dataclass
+from random import uniform
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, ConnectTimeout, Timeout, ChunkedEncodingError
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+# Methods that can be resent without risk of doing the work twice
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+
+@dataclass
+class Transport:
+    '''
+    HTTP settings for one host.
+
+    pool_size = connections kept alive to the host, should match the number of workers using it
+    connect_timeout/read_timeout = seconds before giving up on connecting/waiting for data
+    max_retries = times a request is resent after a connection error or 5xx before giving up
+    backoff/max_backoff = base and cap in seconds of the exponential, fully jittered, retry delay
+    '''
+    pool_size: int = 10
+    connect_timeout: float = 10.0
+    read_timeout: float = 120.0
+    max_retries: int = 5
+    backoff: float = 1.0
+    max_backoff: float = 30.0
+
+    # Failures worth retrying. 500 and 504 may mean the request was processed so they are only
+    # retried for idempotent methods, same for a connection lost once the request was sent
+    retry_statuses = (502, 503)
+    idempotent_retry_statuses = (500, 502, 503, 504)
+
+    @property
+    def timeout(self) -> tuple[float, float]:
+        return (self.connect_timeout, self.read_timeout)
+
+    def build_session(self, auth: tuple=None) -> Session:
+        session = Session()
+        session.auth = auth
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def should_retry_status(self, method: str, status_code: int, attempt: int) -> bool:
+        if attempt >= self.max_retries:
+            return False
+        if method.upper() in IDEMPOTENT_METHODS:
+            return status_code in self.idempotent_retry_statuses
+        return status_code in self.retry_statuses
+
+    def should_retry_error(self, method: str, error: Exception, attempt: int) -> bool:
+        if attempt >= self.max_retries:
+            return False
+        if not isinstance(error, (ConnectionError, Timeout, ChunkedEncodingError)):
+            return False
+        if method.upper() in IDEMPOTENT_METHODS:
+            return True
+        # Anything else may have reached the host already (ex: a comment posted twice)
+        return self._never_sent(error)
+
+    @staticmethod
+    def _never_sent(error: Exception) -> bool:
+        '''
+        True when no connection to the host was made, so the request can't have been acted on
+        '''
+        if isinstance(error, ConnectTimeout):
+            return True
+        reason = error.args[0] if error.args else None
+        if isinstance(reason, MaxRetryError):
+            reason = reason.reason
+        return isinstance(reason, NewConnectionError)
+
+    def delay(self, attempt: int) -> float:
+        return uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
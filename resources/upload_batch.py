@@ -0,0 +1,57 @@
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Any, Hashable
+
+
+@dataclass
+class _Batch:
+    items: list = field(default_factory=lambda: [])
+    size: int = 0
+
+
+class UploadBatcher:
+    '''
+    Groups files waiting to be uploaded per cloud repo so several can go out in one request.
+
+    max_files = most files sent in one request
+    max_bytes = most bytes sent in one request, a single file larger than this goes on its own
+
+    add() hands back every batch that is ready to send, pop()/drain() hand back what is left
+    once no more files are coming. Safe to share between worker threads.
+
+    Example:
+    batcher = UploadBatcher(max_files=2)
+    batcher.add('repo', 'a.png', 10)
+    out: []
+    batcher.add('repo', 'b.png', 10)
+    out: [['a.png', 'b.png']]
+    '''
+
+    def __init__(self, max_files: int=20, max_bytes: int=50 * 1024 * 1024) -> None:
+        self.max_files = max(1, max_files)
+        self.max_bytes = max_bytes
+        self._batches: dict[Hashable, _Batch] = {}
+        self._lock = Lock()
+
+    def add(self, key: Hashable, item: Any, size: int) -> list[list]:
+        ready = []
+        with self._lock:
+            batch = self._batches.setdefault(key, _Batch())
+            if batch.items and batch.size + size > self.max_bytes:
+                ready.append(self._batches.pop(key).items)
+                batch = self._batches.setdefault(key, _Batch())
+            batch.items.append(item)
+            batch.size += size
+            if len(batch.items) >= self.max_files or batch.size >= self.max_bytes:
+                ready.append(self._batches.pop(key).items)
+        return ready
+
+    def pop(self, key: Hashable) -> list:
+        with self._lock:
+            batch = self._batches.pop(key, None)
+        return batch.items if batch is not None else []
+
+    def drain(self) -> list[list]:
+        with self._lock:
+            batches, self._batches = self._batches, {}
+        return [batch.items for batch in batches.values()]
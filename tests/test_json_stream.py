@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+from resources.json_stream import JSONPageStream
+
+PAGE = {
+    'size': 6,
+    'values': [10.5, -3, 0, 1e-7, 2.5E+10, 123456789, {'id': 7, 'text': 'café ✓', 'score': -0.25},
+               [1, 2.0], True, False, None, 'a, "quoted" ] }'],
+    'isLastPage': False,
+    'nextPageStart': 1024,
+    'ratio': 0.125,
+}
+BODY = json.dumps(PAGE).encode('utf-8')
+
+
+def parse(chunks):
+    page = JSONPageStream(iter(chunks))
+    return list(page), page.fields
+
+
+def expected_fields():
+    return {key: value for key, value in PAGE.items() if key != 'values'}
+
+
+@pytest.mark.parametrize('split', range(1, len(BODY)))
+def test_split_at_every_position(split):
+    values, fields = parse([BODY[:split], BODY[split:]])
+    assert values == PAGE['values']
+    assert fields == expected_fields()
+
+
+def test_one_byte_at_a_time():
+    values, fields = parse([BODY[i:i + 1] for i in range(len(BODY))])
+    assert values == PAGE['values']
+    assert fields == expected_fields()
+
+
+@pytest.mark.parametrize('number', ['10.5', '-0.25', '1e-7', '2.5E+10', '123456789'])
+def test_number_split_inside(number):
+    body = ('{"values":[%s],"isLastPage":true,"limit":%s}' % (number, number)).encode()
+    for split in range(1, len(body)):
+        values, fields = parse([body[:split], body[split:]])
+        assert values == [json.loads(number)]
+        assert fields == {'isLastPage': True, 'limit': json.loads(number)}
+
+
+def test_number_at_end_of_body():
+    values, fields = parse([b'{"values":[],"limit":2', b'5', b'}'])
+    assert values == [] and fields == {'limit': 25}
+
+
+def test_empty_object():
+    assert parse([b' { ', b'} ']) == ([], {})
+
+
+def test_truncated_body():
+    with pytest.raises(ValueError):
+        parse([b'{"values":[1, 2'])